@@ -1,13 +1,20 @@
 import copy
+import functools
+import hmac
 import json
 import os
 import logging
 import uuid
 import httpx
 import asyncio
+import threading
+import time
+from contextlib import aclosing
+from datetime import date, datetime
 from quart import (
     Blueprint,
     Quart,
+    g,
     jsonify,
     make_response,
     request,
@@ -15,20 +22,42 @@ from quart import (
     render_template,
     current_app,
 )
+from quart.wrappers.response import IterableBody
 
-from openai import AsyncAzureOpenAI
-from azure.identity.aio import (
-    DefaultAzureCredential,
-    get_bearer_token_provider
-)
+from openai import AsyncAzureOpenAI, NotFoundError
 from backend.auth.auth_utils import get_authenticated_user_details
 from backend.security.ms_defender_utils import get_msdefender_user_json
-from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.memoryservice import InMemoryConversationClient
+from backend.history.citations import CitationStream, expand_citations, referenced_keys, split_citations
+from backend.history.message_cache import ConversationHistoryCache, chat_message
+from backend.history.instrumentation import (
+    get_request_diagnostics,
+    start_request_diagnostics,
+)
+from backend.metrics import (
+    REQUEST_LABELS,
+    EventLoopMonitor,
+    get_request_labels,
+    observe_phase,
+    registry as metrics_registry,
+    set_request_labels,
+    time_phase,
+)
+from backend.admission import AdmissionController
+from backend.cache import SqliteCacheBackend, set_shared_backend
+from backend.capture import CAPTURED_ROUTES, RequestCapture, sanitize_body
+from backend.loop_watchdog import LoopWatchdog
+from backend.profiler import MAX_SECONDS as MAX_PROFILE_SECONDS, ProfileStore, StackSampler
+from backend.token_cache import close_default_credential, default_credential
+from backend.stream_replay import ReplayBufferStore, StreamOffsetExpiredError
+from backend.usage import UsageAccumulator
+from backend.warmup import Warmup
 from backend.settings import (
     app_settings,
     MINIMUM_SUPPORTED_AZURE_OPENAI_PREVIEW_API_VERSION
 )
 from backend.utils import (
+    AssembledAnswer,
     format_as_ndjson,
     format_stream_response,
     format_non_streaming_response,
@@ -45,16 +74,41 @@ def create_app():
     app = Quart(__name__)
     app.register_blueprint(bp)
     app.config["TEMPLATES_AUTO_RELOAD"] = True
+    app.warmup = Warmup(app_settings.base_settings.warmup_timeout)
     
     @app.before_serving
     async def init():
+        loop_watchdog.start()
+        if app_settings.base_settings.metrics_enabled:
+            event_loop_monitor.start()
+        if app_settings.request_capture.enabled:
+            request_capture.start()
         try:
             app.cosmos_conversation_client = await init_cosmosdb_client()
             cosmos_db_ready.set()
+            if app.cosmos_conversation_client and app_settings.usage_metering.enabled:
+                usage_accumulator.start(app.cosmos_conversation_client)
         except Exception as e:
             logging.exception("Failed to initialize CosmosDB client")
             app.cosmos_conversation_client = None
             raise e
+        ## the worker accepts connections once this returns
+        await warm_up(app)
+
+    @app.after_serving
+    async def shutdown():
+        await event_loop_monitor.close()
+        await loop_watchdog.close()
+        request_profiles.close()
+        stream_replay.close()
+        await usage_accumulator.close()
+        await request_capture.close()
+        if app.cosmos_conversation_client:
+            await app.cosmos_conversation_client.close()
+        await close_openai_client()
+        await close_default_credential()
+        if shared_cache_backend:
+            await shared_cache_backend.close()
     
     return app
 
@@ -85,13 +139,17 @@ if DEBUG.lower() == "true":
 
 USER_AGENT = "GitHubSampleWebApp/AsyncAzureOpenAI/1.0.0"
 
+# Upper bound for the page_size accepted by /history/read
+MAX_HISTORY_PAGE_SIZE = 500
+
 
 # Frontend Settings via Environment Variables
 frontend_settings = {
     "auth_enabled": app_settings.base_settings.auth_enabled,
     "feedback_enabled": (
-        app_settings.chat_history and
-        app_settings.chat_history.enable_feedback
+        app_settings.chat_history_store.enable_feedback
+        if app_settings.chat_history_store.backend != "cosmosdb"
+        else app_settings.chat_history and app_settings.chat_history.enable_feedback
     ),
     "ui": {
         "title": app_settings.ui.title,
@@ -114,6 +172,80 @@ MS_DEFENDER_ENABLED = os.environ.get("MS_DEFENDER_ENABLED", "true").lower() == "
 azure_openai_tools = []
 azure_openai_available_tools = []
 
+# Concurrent /conversation requests per worker, MAX_CONCURRENT_CHAT_REQUESTS=0 means unbounded;
+# /conversation/batch items use the low priority lane, bounded by BATCH_MAX_CONCURRENT_REQUESTS
+chat_admission = AdmissionController(
+    "chat",
+    app_settings.base_settings.max_concurrent_chat_requests,
+    max_low_priority=app_settings.batch.max_concurrent_requests,
+)
+
+http_request_duration = metrics_registry.histogram(
+    "http_request_duration_seconds",
+    "Time until the response headers are sent; streamed bodies are covered by request_phase_duration_seconds",
+    ("route", "method", "status_code"),
+)
+stream_outcomes = metrics_registry.counter(
+    "chat_stream_outcomes_total",
+    "Streamed answers by outcome: completed, cancelled (the client went away) or error",
+    REQUEST_LABELS + ("outcome",),
+)
+completion_tokens_per_second = metrics_registry.histogram(
+    "chat_completion_tokens_per_second",
+    "Streamed content chunks per second after the first one, roughly the output tokens per second",
+    REQUEST_LABELS,
+    buckets=(5, 10, 20, 30, 50, 75, 100, 150, 200, 500),
+)
+
+# Event loop lag and memory of this worker, see /metrics
+event_loop_monitor = EventLoopMonitor()
+
+# Logs the stack of code blocking the event loop for longer than EVENT_LOOP_BLOCK_THRESHOLD seconds
+loop_watchdog = LoopWatchdog(app_settings.base_settings.event_loop_block_threshold)
+
+# Stack samples of single requests sent with X-Profile-Request, see /admin/profile
+request_profiles = ProfileStore()
+worker_profile_lock = asyncio.Lock()
+
+# The Azure OpenAI client shared by the worker's requests, see get_openai_client
+azure_openai_client = None
+openai_client_lock = asyncio.Lock()
+
+# Token usage per user and conversation, written to the chat history store every USAGE_METERING_FLUSH_INTERVAL seconds
+usage_accumulator = UsageAccumulator(app_settings.usage_metering.flush_interval)
+
+
+# The cache tier shared by the workers of the host, behind the conversation history and user group caches
+shared_cache_backend = (
+    SqliteCacheBackend(app_settings.shared_cache.path, app_settings.shared_cache.max_entries)
+    if app_settings.shared_cache.path
+    else None
+)
+set_shared_backend(shared_cache_backend)
+
+# The messages of recent conversations, for requests sending only their new message to /history/generate
+conversation_history_cache = ConversationHistoryCache(app_settings.chat_history_store.message_cache_size)
+
+
+# Streamed answers kept for STREAM_RESUME_TTL seconds so clients can resume them, see /conversation/resume
+stream_replay = ReplayBufferStore(
+    max_streams=app_settings.stream_resume.max_streams,
+    max_lines=app_settings.stream_resume.max_lines,
+    ttl=app_settings.stream_resume.ttl,
+    idle_timeout=app_settings.stream_resume.idle_timeout,
+)
+
+# Sanitized chat requests written to REQUEST_CAPTURE_DIRECTORY, for tools/replay_requests.py
+request_capture = RequestCapture(
+    app_settings.request_capture.directory,
+    sample_rate=app_settings.request_capture.sample_rate,
+    redact_content=app_settings.request_capture.redact_content,
+    max_file_bytes=int(app_settings.request_capture.max_file_mb * 2**20),
+    max_files=app_settings.request_capture.max_files,
+    flush_interval=app_settings.request_capture.flush_interval,
+)
+
+
 # Initialize Azure OpenAI Client
 async def init_openai_client():
     azure_openai_client = None
@@ -148,11 +280,12 @@ async def init_openai_client():
         ad_token_provider = None
         if not aoai_api_key:
             logging.debug("No AZURE_OPENAI_KEY found, using Azure Entra ID auth")
-            async with DefaultAzureCredential() as credential:
-                ad_token_provider = get_bearer_token_provider(
-                    credential,
-                    "https://cognitiveservices.azure.com/.default"
-                )
+            from azure.identity.aio import get_bearer_token_provider
+
+            ad_token_provider = get_bearer_token_provider(
+                default_credential(),
+                "https://cognitiveservices.azure.com/.default"
+            )
 
         # Deployment
         deployment = app_settings.azure_openai.model
@@ -169,9 +302,10 @@ async def init_openai_client():
                 response = await client.get(azure_functions_tools_url)
             response_status_code = response.status_code
             if response_status_code == httpx.codes.OK:
-                azure_openai_tools.extend(json.loads(response.text))
-                for tool in azure_openai_tools:
-                    azure_openai_available_tools.append(tool["function"]["name"])
+                ## replaced, not extended: the client is created again when an earlier attempt failed
+                tools = json.loads(response.text)
+                azure_openai_tools[:] = tools
+                azure_openai_available_tools[:] = [tool["function"]["name"] for tool in tools]
             else:
                 logging.error(f"An error occurred while getting OpenAI Function Call tools metadata: {response.status_code}")
 
@@ -190,6 +324,43 @@ async def init_openai_client():
         azure_openai_client = None
         raise e
 
+async def get_openai_client():
+    ## one client per worker, so the requests share its connections and Entra ID token;
+    ## kept in the module, not on the app, for callers outside of a request like tools/data_collection.py
+    global azure_openai_client
+    if azure_openai_client is None:
+        async with openai_client_lock:
+            if azure_openai_client is None:
+                azure_openai_client = await init_openai_client()
+    return azure_openai_client
+
+
+async def close_openai_client():
+    global azure_openai_client
+    if azure_openai_client is not None:
+        await azure_openai_client.close()
+        azure_openai_client = None
+
+
+async def warm_up(app):
+    """Connect to the configured dependencies before the worker serves its first request."""
+    async def warm_up_openai():
+        client = await get_openai_client()
+        try:
+            await client.models.list()
+        except NotFoundError:
+            ## answered, so the token was accepted and the connection is open
+            pass
+
+    if app_settings.azure_openai.endpoint or app_settings.azure_openai.resource:
+        app.warmup.add("azure_openai", warm_up_openai)
+    if app.cosmos_conversation_client:
+        app.warmup.add("chat_history", app.cosmos_conversation_client.ensure)
+    if app_settings.datasource:
+        app.warmup.add("datasource", app_settings.datasource.warm_up)
+    await app.warmup.run()
+
+
 async def openai_remote_azure_function_call(function_name, function_args):
     if app_settings.azure_openai.function_call_azure_functions_enabled is not True:
         return
@@ -200,34 +371,62 @@ async def openai_remote_azure_function_call(function_name, function_args):
         "tool_name": function_name,
         "tool_arguments": json.loads(function_args)
     }
-    async with httpx.AsyncClient() as client:
-        response = await client.post(azure_functions_tool_url, data=json.dumps(body), headers=headers)
+    with time_phase("tool_call"):
+        async with httpx.AsyncClient() as client:
+            response = await client.post(azure_functions_tool_url, data=json.dumps(body), headers=headers)
     response.raise_for_status()
 
     return response.text
 
 async def init_cosmosdb_client():
     cosmos_conversation_client = None
+    if app_settings.chat_history_store.backend == "sqlite":
+        from backend.history.sqliteservice import SqliteConversationClient
+
+        logging.debug(f"Using SQLite chat history at {app_settings.chat_history_store.sqlite_path}")
+        return SqliteConversationClient(
+            database_path=app_settings.chat_history_store.sqlite_path,
+            enable_message_feedback=app_settings.chat_history_store.enable_feedback,
+        )
+
+    if app_settings.chat_history_store.backend == "memory":
+        logging.debug("Using in-memory chat history")
+        return InMemoryConversationClient(
+            enable_message_feedback=app_settings.chat_history_store.enable_feedback,
+        )
+
     if app_settings.chat_history:
+        ## imported only when used, like the SQLite store: azure.cosmos and azure.identity slow down every worker's startup
+        from backend.history.cosmosdbservice import CosmosConversationClient
+        from backend.history.cosmosdbembeddedservice import CosmosEmbeddedConversationClient
+
         try:
             cosmos_endpoint = (
                 f"https://{app_settings.chat_history.account}.documents.azure.com:443/"
             )
 
             if not app_settings.chat_history.account_key:
-                async with DefaultAzureCredential() as cred:
-                    credential = cred
-                    
+                credential = default_credential()
             else:
                 credential = app_settings.chat_history.account_key
 
-            cosmos_conversation_client = CosmosConversationClient(
-                cosmosdb_endpoint=cosmos_endpoint,
-                credential=credential,
-                database_name=app_settings.chat_history.database,
-                container_name=app_settings.chat_history.conversations_container,
-                enable_message_feedback=app_settings.chat_history.enable_feedback,
-            )
+            if app_settings.chat_history.layout == "embedded":
+                cosmos_conversation_client = CosmosEmbeddedConversationClient(
+                    cosmosdb_endpoint=cosmos_endpoint,
+                    credential=credential,
+                    database_name=app_settings.chat_history.database,
+                    container_name=app_settings.chat_history.conversations_container,
+                    enable_message_feedback=app_settings.chat_history.enable_feedback,
+                    embedded_max_bytes=app_settings.chat_history.embedded_max_bytes,
+                )
+            else:
+                cosmos_conversation_client = CosmosConversationClient(
+                    cosmosdb_endpoint=cosmos_endpoint,
+                    credential=credential,
+                    database_name=app_settings.chat_history.database,
+                    container_name=app_settings.chat_history.conversations_container,
+                    enable_message_feedback=app_settings.chat_history.enable_feedback,
+                )
         except Exception as e:
             logging.exception("Exception in CosmosDB initialization", e)
             cosmos_conversation_client = None
@@ -238,7 +437,9 @@ async def init_cosmosdb_client():
     return cosmos_conversation_client
 
 
-def prepare_model_args(request_body, request_headers):
+async def prepare_model_args(request_body, request_headers, stream=None):
+    ## complete_chat_request asks for a complete answer even when AZURE_OPENAI_STREAM is on
+    stream = app_settings.azure_openai.stream if stream is None else stream
     request_messages = request_body.get("messages", [])
     messages = []
     if not app_settings.datasource:
@@ -287,20 +488,25 @@ def prepare_model_args(request_body, request_headers):
         "max_tokens": app_settings.azure_openai.max_tokens,
         "top_p": app_settings.azure_openai.top_p,
         "stop": app_settings.azure_openai.stop_sequence,
-        "stream": app_settings.azure_openai.stream,
+        "stream": stream,
         "model": app_settings.azure_openai.model
     }
 
+    if stream and app_settings.azure_openai.stream_include_usage:
+        ## the last chunk of the stream then carries the usage of the whole completion
+        model_args["stream_options"] = {"include_usage": True}
+
     if len(messages) > 0:
         if messages[-1]["role"] == "user":
             if app_settings.azure_openai.function_call_azure_functions_enabled and len(azure_openai_tools) > 0:
                 model_args["tools"] = azure_openai_tools
 
             if app_settings.datasource:
+                filter_string = await app_settings.datasource.get_request_filter(request_headers)
                 model_args["extra_body"] = {
                     "data_sources": [
                         app_settings.datasource.construct_payload_configuration(
-                            request=request
+                            filter_string=filter_string
                         )
                     ]
                 }
@@ -418,7 +624,36 @@ async def process_function_call(response):
     
     return None
 
-async def send_chat_request(request_body, request_headers):
+def record_usage(request_headers, conversation_id, usage):
+    if not app_settings.usage_metering.enabled:
+        return
+
+    user_id = get_authenticated_user_details(request_headers)["user_principal_id"]
+    usage_accumulator.record(user_id, conversation_id, usage)
+
+
+class MeteredStream():
+    """Records the usage chunk of a streamed completion, and can close the stream like ``AsyncStream``."""
+
+    def __init__(self, stream, request_headers, conversation_id):
+        self.stream = stream
+        self.request_headers = request_headers
+        self.conversation_id = conversation_id
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await self.stream.__anext__()
+        if chunk.usage:
+            record_usage(self.request_headers, self.conversation_id, chunk.usage)
+        return chunk
+
+    async def close(self):
+        await self.stream.close()
+
+
+async def send_chat_request(request_body, request_headers, stream=None):
     filtered_messages = []
     messages = request_body.get("messages", [])
     for message in messages:
@@ -426,13 +661,22 @@ async def send_chat_request(request_body, request_headers):
             filtered_messages.append(message)
             
     request_body['messages'] = filtered_messages
-    model_args = prepare_model_args(request_body, request_headers)
+    with time_phase("prepare_model_args"):
+        model_args = await prepare_model_args(request_body, request_headers, stream)
 
     try:
-        azure_openai_client = await init_openai_client()
+        azure_openai_client = await get_openai_client()
+        start = time.perf_counter()
         raw_response = await azure_openai_client.chat.completions.with_raw_response.create(**model_args)
+        if not model_args["stream"]:
+            observe_phase("completion", time.perf_counter() - start)
         response = raw_response.parse()
         apim_request_id = raw_response.headers.get("apim-request-id") 
+        conversation_id = request_body.get("history_metadata", {}).get("conversation_id")
+        if model_args["stream"]:
+            response = MeteredStream(response, request_headers, conversation_id)
+        else:
+            record_usage(request_headers, conversation_id, response.usage)
     except Exception as e:
         logging.exception("Exception in send_chat_request")
         raise e
@@ -440,7 +684,7 @@ async def send_chat_request(request_body, request_headers):
     return response, apim_request_id
 
 
-async def complete_chat_request(request_body, request_headers):
+async def complete_chat_request(request_body, request_headers, on_answer=None, citations=None):
     if app_settings.base_settings.use_promptflow:
         response = await promptflow_request(request_body)
         history_metadata = request_body.get("history_metadata", {})
@@ -451,7 +695,7 @@ async def complete_chat_request(request_body, request_headers):
             app_settings.promptflow.citations_field_name
         )
     else:
-        response, apim_request_id = await send_chat_request(request_body, request_headers)
+        response, apim_request_id = await send_chat_request(request_body, request_headers, stream=False)
         history_metadata = request_body.get("history_metadata", {})
         non_streaming_response = format_non_streaming_response(response, history_metadata, apim_request_id)
 
@@ -461,10 +705,17 @@ async def complete_chat_request(request_body, request_headers):
             if function_response:
                 request_body["messages"].extend(function_response)
 
-                response, apim_request_id = await send_chat_request(request_body, request_headers)
+                response, apim_request_id = await send_chat_request(request_body, request_headers, stream=False)
                 history_metadata = request_body.get("history_metadata", {})
                 non_streaming_response = format_non_streaming_response(response, history_metadata, apim_request_id)
 
+        if citations is not None:
+            citations.compact_response(non_streaming_response)
+        if on_answer is not None:
+            answer = AssembledAnswer()
+            answer.add(non_streaming_response)
+            await on_answer(answer)
+
     return non_streaming_response
 
 class AzureOpenaiFunctionCallStreamState():
@@ -531,16 +782,75 @@ async def process_function_call_stream(completionChunk, function_call_stream_sta
             return function_call_stream_state.streaming_state
 
 
-async def stream_chat_request(request_body, request_headers):
+class StreamTimer():
+    """Records time to first token, stream duration and tokens per second of a streamed answer."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first_token_at = None
+        self.tokens = 0
+
+    async def measure(self, stream):
+        ## counts in local state only, the metrics are recorded once in finish()
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+                if self.first_token_at is None:
+                    self.first_token_at = time.perf_counter()
+                self.tokens += 1
+            yield chunk
+
+    def finish(self, outcome):
+        end = time.perf_counter()
+        observe_phase("stream", end - self.start)
+        labels = get_request_labels()
+        if labels is not None:
+            stream_outcomes.labels(*labels, outcome).inc()
+        if self.first_token_at is None:
+            return
+        observe_phase("time_to_first_token", self.first_token_at - self.start)
+        if labels is not None and self.tokens > 1 and end > self.first_token_at:
+            completion_tokens_per_second.labels(*labels).observe((self.tokens - 1) / (end - self.first_token_at))
+
+
+async def stream_chat_request(request_body, request_headers, on_answer=None, citations=None):
+    stream_timer = StreamTimer()
     response, apim_request_id = await send_chat_request(request_body, request_headers)
     history_metadata = request_body.get("history_metadata", {})
+    # every upstream stream opened for this answer, closed when the answer ends for any reason
+    upstream_streams = [response]
     
     async def generate(apim_request_id, history_metadata):
+        ## Quart cancels the request task when the client disconnects, which raises CancelledError
+        ## here (or GeneratorExit if it happens while a chunk is sent); in-flight tool calls are
+        ## cancelled with it and the upstream streams are closed so Azure OpenAI stops generating
+        outcome = "error"
+        answer = AssembledAnswer() if on_answer is not None else None
+        try:
+            async with aclosing(generate_chunks(apim_request_id, history_metadata)) as chunks:
+                async for chunk in chunks:
+                    if citations is not None:
+                        citations.compact_response(chunk)
+                    if answer is not None:
+                        answer.add(chunk)
+                    yield chunk
+            if answer is not None:
+                ## only complete answers are handed over, before the client sees the end of the stream
+                await on_answer(answer)
+            outcome = "completed"
+        except (asyncio.CancelledError, GeneratorExit):
+            outcome = "cancelled"
+            raise
+        finally:
+            for stream in upstream_streams:
+                await stream.close()
+            stream_timer.finish(outcome)
+
+    async def generate_chunks(apim_request_id, history_metadata):
         if app_settings.azure_openai.function_call_azure_functions_enabled:
             # Maintain state during function call streaming
             function_call_stream_state = AzureOpenaiFunctionCallStreamState()
             
-            async for completionChunk in response:
+            async for completionChunk in stream_timer.measure(response):
                 stream_state = await process_function_call_stream(completionChunk, function_call_stream_state, request_body, request_headers, history_metadata, apim_request_id)
                 
                 # No function call, asistant response
@@ -552,26 +862,66 @@ async def stream_chat_request(request_body, request_headers):
                 if stream_state == "COMPLETED":
                     request_body["messages"].extend(function_call_stream_state.function_messages)
                     function_response, apim_request_id = await send_chat_request(request_body, request_headers)
-                    async for functionCompletionChunk in function_response:
+                    upstream_streams.append(function_response)
+                    async for functionCompletionChunk in stream_timer.measure(function_response):
                         yield format_stream_response(functionCompletionChunk, history_metadata, apim_request_id)
                 
         else:
-            async for completionChunk in response:
+            async for completionChunk in stream_timer.measure(response):
                 yield format_stream_response(completionChunk, history_metadata, apim_request_id)
 
     return generate(apim_request_id=apim_request_id, history_metadata=history_metadata)
 
 
-async def conversation_internal(request_body, request_headers):
+async def generate_resumable(request_body, request_headers, on_answer, citations, started):
+    ## runs in the task of the replay buffer, which holds the admission slot until the answer
+    ## is generated, also after the client went away; started tells the request how it began
     try:
-        if app_settings.azure_openai.stream and not app_settings.base_settings.use_promptflow:
-            result = await stream_chat_request(request_body, request_headers)
-            response = await make_response(format_as_ndjson(result))
+        observe_phase("admission", await chat_admission.admit())
+        result = await stream_chat_request(request_body, request_headers, on_answer, citations)
+        if not started.done():
+            started.set_result(None)
+    except Exception as ex:
+        if not started.done():
+            started.set_exception(ex)
+        return
+    finally:
+        if not started.done():
+            started.cancel()
+
+    async for line in format_as_ndjson(result):
+        yield line
+
+
+async def conversation_internal(request_body, request_headers, on_answer=None, citations=None):
+    streamed = app_settings.azure_openai.stream and not app_settings.base_settings.use_promptflow
+    if not (streamed and app_settings.stream_resume.enabled):
+        observe_phase("admission", await chat_admission.admit())
+    try:
+        if streamed:
+            if app_settings.stream_resume.enabled:
+                ## generated in the background into a replay buffer, the response reads it from the start
+                user_id = get_authenticated_user_details(request_headers)["user_principal_id"]
+                started = asyncio.get_running_loop().create_future()
+                replay_buffer = stream_replay.start(
+                    user_id, generate_resumable(request_body, request_headers, on_answer, citations, started)
+                )
+                try:
+                    await asyncio.shield(started)
+                except asyncio.CancelledError:
+                    ## the client went away before the answer started, it can't resume without the stream id
+                    replay_buffer.cancel()
+                    raise
+                response = await make_response(format_replay(replay_buffer.read(0)))
+                response.headers["X-Stream-Id"] = replay_buffer.stream_id
+            else:
+                result = await stream_chat_request(request_body, request_headers, on_answer, citations)
+                response = await make_response(format_as_ndjson(result))
             response.timeout = None
             response.mimetype = "application/json-lines"
             return response
         else:
-            result = await complete_chat_request(request_body, request_headers)
+            result = await complete_chat_request(request_body, request_headers, on_answer, citations)
             return jsonify(result)
 
     except Exception as ex:
@@ -591,6 +941,96 @@ async def conversation():
     return await conversation_internal(request_json, request.headers)
 
 
+@bp.route("/conversation/batch", methods=["POST"])
+async def conversation_batch():
+    ## one /conversation request body per line, answered without streaming
+    try:
+        items = [json.loads(line) for line in (await request.get_data(as_text=True)).splitlines() if line.strip()]
+    except ValueError as e:
+        return jsonify({"error": f"Request body must be NDJSON, one /conversation request per line: {e}"}), 400
+    if not items:
+        return jsonify({"error": "No requests in the batch"}), 400
+    if len(items) > app_settings.batch.max_requests:
+        return jsonify({"error": f"A batch holds at most {app_settings.batch.max_requests} requests"}), 400
+
+    response = await make_response(format_as_ndjson(run_batch(items, request.headers)))
+    response.timeout = None
+    response.mimetype = "application/json-lines"
+    return response
+
+
+async def run_batch_item(index, request_body, request_headers):
+    start = time.perf_counter()
+    if not isinstance(request_body, dict) or not isinstance(request_body.get("messages"), list):
+        return {"index": index, "error": "Each request must be a JSON object with a messages list", "status": 400, "latency": 0.0}
+
+    observe_phase("admission", await chat_admission.admit(low_priority=True))
+    try:
+        result = {"index": index, "response": await complete_chat_request(request_body, request_headers)}
+    except Exception as ex:
+        logging.exception(f"Exception in /conversation/batch item {index}")
+        result = {"index": index, "error": str(ex), "status": getattr(ex, "status_code", 500)}
+    result["latency"] = time.perf_counter() - start
+    return result
+
+
+async def run_batch(items, request_headers):
+    """Yield the result of every item as it completes, BATCH_CONCURRENCY at a time."""
+    results = asyncio.Queue()
+    pending = iter(enumerate(items))
+
+    async def worker():
+        for index, request_body in pending:
+            ## each item runs in its own task, which holds the admission slot until it is done
+            await results.put(await asyncio.ensure_future(run_batch_item(index, request_body, request_headers)))
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(max(1, min(app_settings.batch.concurrency, len(items))))]
+    try:
+        for _ in range(len(items)):
+            yield await results.get()
+    finally:
+        ## the client went away or the batch is done, stop what is still running
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+@bp.route("/conversation/resume/<stream_id>", methods=["GET"])
+async def resume_conversation(stream_id):
+    if not app_settings.stream_resume.enabled:
+        return jsonify({"error": "Resumable streams are not enabled"}), 404
+
+    try:
+        offset = int(request.args.get("offset", 0))
+    except ValueError:
+        return jsonify({"error": "offset must be an integer"}), 400
+
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    replay_buffer = stream_replay.get(stream_id)
+    if replay_buffer is None or replay_buffer.user_id != authenticated_user["user_principal_id"]:
+        return jsonify({"error": f"Stream {stream_id} not found, it may have expired"}), 404
+    if offset < 0 or offset > replay_buffer.end_offset:
+        return jsonify({"error": f"offset must be between 0 and {replay_buffer.end_offset}"}), 400
+    if offset < replay_buffer.first_offset:
+        return jsonify({"error": f"Offset {offset} is no longer buffered, the oldest is {replay_buffer.first_offset}"}), 410
+
+    response = await make_response(format_replay(replay_buffer.read(offset)))
+    response.headers["X-Stream-Id"] = stream_id
+    response.timeout = None
+    response.mimetype = "application/json-lines"
+    return response
+
+
+async def format_replay(lines):
+    ## closing the response closes the reader, which starts the idle timeout of the buffer
+    async with aclosing(lines):
+        try:
+            async for line in lines:
+                yield line
+        except StreamOffsetExpiredError as e:
+            yield json.dumps({"error": str(e)})
+
+
 @bp.route("/frontend_settings", methods=["GET"])
 def get_frontend_settings():
     try:
@@ -600,7 +1040,231 @@ def get_frontend_settings():
         return jsonify({"error": str(e)}), 500
 
 
+@bp.before_request
+async def start_request_metrics():
+    g.request_start = time.perf_counter()
+    set_request_labels(
+        request.url_rule.rule if request.url_rule else "unmatched",
+        app_settings.base_settings.datasource_type or "none",
+        app_settings.azure_openai.model,
+    )
+
+
+@bp.after_request
+async def record_request_metrics(response):
+    request_start = g.get("request_start")
+    if request_start is not None:
+        http_request_duration.labels(
+            request.url_rule.rule if request.url_rule else "unmatched",
+            request.method,
+            str(response.status_code),
+        ).observe(time.perf_counter() - request_start)
+    return response
+
+
+@bp.before_request
+async def start_request_capture():
+    if (
+        app_settings.request_capture.enabled
+        and request.method == "POST"
+        and request.path in CAPTURED_ROUTES
+        and request_capture.sampled()
+    ):
+        g.capture_started = time.time()
+        ## copied now, the routes add the history and metadata to the body they read
+        g.capture_body = sanitize_body(await request.get_json(silent=True), request_capture.redact_content)
+
+
+@bp.after_request
+async def record_request_capture(response):
+    started = g.get("capture_started")
+    if started is not None:
+        ## /history/generate adds the conversation it answered in, possibly a new one, to the body it
+        ## read; that's the one cached by get_json() without silent, which parses since the silent one did
+        request_json = await request.get_json() if g.capture_body is not None else None
+        history_metadata = request_json.get("history_metadata") if isinstance(request_json, dict) else None
+        stream = response.mimetype == "application/json-lines"
+        record = functools.partial(
+            request_capture.record,
+            request.path,
+            g.capture_body,
+            get_authenticated_user_details(request_headers=request.headers)["user_principal_id"],
+            response.status_code,
+            started,
+            stream=stream,
+            conversation_id=history_metadata.get("conversation_id") if isinstance(history_metadata, dict) else None,
+        )
+        if stream and isinstance(response.response, IterableBody):
+            ## the body of a streamed answer is only sent after this, its latency is the whole answer's
+            response.response = IterableBody(capture_when_sent(response.response.iter, record, started))
+        else:
+            record(time.time() - started)
+    return response
+
+
+async def capture_when_sent(body, record, started):
+    ## also when the client went away, then the latency is until it did
+    try:
+        async with aclosing(body):
+            async for data in body:
+                yield data
+    finally:
+        record(time.time() - started)
+
+
+@bp.route("/ready", methods=["GET"])
+async def ready():
+    ## for health checks; the errors are only logged, they can name internal endpoints
+    warmup = {
+        dependency: {"ok": result["ok"], "seconds": result["seconds"]}
+        for dependency, result in current_app.warmup.results.items()
+    }
+    return jsonify({"ready": current_app.warmup.done, "warmup": warmup}), 200 if current_app.warmup.done else 503
+
+
+@bp.route("/metrics", methods=["GET"])
+async def metrics():
+    if not app_settings.base_settings.metrics_enabled:
+        return jsonify({"error": "Metrics are not enabled"}), 404
+    ## the metrics name deployments, routes and workers, only admins can scrape them once there is an admin key
+    if app_settings.base_settings.admin_api_key and not has_admin_api_key():
+        return jsonify({"error": "Invalid admin API key"}), 401
+
+    response = await make_response(metrics_registry.render())
+    response.mimetype = "text/plain; version=0.0.4"
+    return response
+
+
+## Admin API ##
+def has_admin_api_key():
+    provided = request.headers.get("X-Admin-Api-Key", "")
+    return hmac.compare_digest(provided.encode(), app_settings.base_settings.admin_api_key.encode())
+
+
+@bp.route("/admin/usage", methods=["GET"])
+async def get_usage():
+    if not app_settings.base_settings.admin_api_key:
+        return jsonify({"error": "The admin API is not enabled"}), 404
+    if not has_admin_api_key():
+        return jsonify({"error": "Invalid admin API key"}), 401
+
+    user_id = request.args.get("user_id")
+    since = request.args.get("since")
+    if since:
+        try:
+            since = date.fromisoformat(since).isoformat()
+        except ValueError:
+            return jsonify({"error": "since must be a date formatted as YYYY-MM-DD"}), 400
+
+    await cosmos_db_ready.wait()
+    if not current_app.cosmos_conversation_client:
+        return jsonify({"error": "CosmosDB is not configured"}), 404
+
+    try:
+        ## usage is written every USAGE_METERING_FLUSH_INTERVAL seconds, the latest requests may be missing
+        usage = [
+            {k: v for k, v in document.items() if not k.startswith("_")}
+            for document in await current_app.cosmos_conversation_client.get_usage(user_id=user_id, since=since or None)
+        ]
+        totals = {
+            field: sum(document[field] for document in usage)
+            for field in ("promptTokens", "cachedTokens", "completionTokens", "requests")
+        }
+        return jsonify({"usage": usage, "totals": totals}), 200
+    except Exception as e:
+        logging.exception("Exception in /admin/usage")
+        return jsonify({"error": str(e)}), 500
+
+
+@bp.route("/admin/profile", methods=["POST"])
+async def profile_worker():
+    """Sample the event loop of the worker serving this request and return the collapsed stacks."""
+    if not app_settings.base_settings.admin_api_key:
+        return jsonify({"error": "The admin API is not enabled"}), 404
+    if not has_admin_api_key():
+        return jsonify({"error": "Invalid admin API key"}), 401
+
+    try:
+        seconds = float(request.args.get("seconds", 10))
+        interval = float(request.args.get("interval_ms", 5)) / 1000
+    except ValueError:
+        return jsonify({"error": "seconds and interval_ms must be numbers"}), 400
+    if not 0 < seconds <= MAX_PROFILE_SECONDS or not 0.001 <= interval <= 1:
+        return jsonify({"error": f"seconds must be up to {MAX_PROFILE_SECONDS} and interval_ms from 1 to 1000"}), 400
+    if worker_profile_lock.locked():
+        return jsonify({"error": "This worker is already being profiled"}), 409
+
+    async with worker_profile_lock:
+        sampler = StackSampler(asyncio.get_running_loop(), threading.get_ident(), interval, seconds)
+        collapsed = await sampler.run(seconds)
+
+    return await profile_response(sampler, collapsed)
+
+
+@bp.route("/admin/profile/<profile_id>", methods=["GET"])
+async def get_request_profile(profile_id):
+    if not app_settings.base_settings.admin_api_key:
+        return jsonify({"error": "The admin API is not enabled"}), 404
+    if not has_admin_api_key():
+        return jsonify({"error": "Invalid admin API key"}), 401
+
+    sampler = request_profiles.get(profile_id)
+    if sampler is None:
+        return jsonify({"error": "Profile not found"}), 404
+    if not sampler.done:
+        return jsonify({"status": "running", "samples": sampler.samples}), 202
+    return await profile_response(sampler, sampler.collapsed())
+
+
+async def profile_response(sampler, collapsed):
+    response = await make_response(collapsed)
+    response.mimetype = "text/plain"
+    response.headers["X-Profile-Pid"] = str(os.getpid())
+    response.headers["X-Profile-Samples"] = str(sampler.samples)
+    response.headers["X-Profile-Duration"] = f"{sampler.duration:.3f}"
+    return response
+
+
+@bp.before_request
+async def start_request_profile():
+    ## the profile covers the request's task until its response, streamed or not, is sent
+    if (
+        request.headers.get("X-Profile-Request", "").lower() == "true"
+        and app_settings.base_settings.admin_api_key
+        and has_admin_api_key()
+    ):
+        g.profile_id = request_profiles.profile_task(asyncio.current_task())
+
+
+@bp.after_request
+async def add_request_profile_id(response):
+    profile_id = g.get("profile_id")
+    if profile_id:
+        response.headers["X-Profile-Id"] = profile_id
+    return response
+
+
 ## Conversation History API ##
+@bp.before_request
+async def collect_history_diagnostics():
+    if (
+        request.path.startswith("/history/")
+        and app_settings.chat_history
+        and app_settings.chat_history.enable_diagnostics
+    ):
+        start_request_diagnostics()
+
+
+@bp.after_request
+async def add_history_diagnostics(response):
+    ## streamed responses read the store after the headers were sent, so only the
+    ## operations run before the response was created are reported
+    diagnostics = get_request_diagnostics()
+    if diagnostics:
+        response.headers["X-History-Diagnostics"] = json.dumps(diagnostics, separators=(",", ":"))
+    return response
+
+
 @bp.route("/history/generate", methods=["POST"])
 async def add_conversation():
     await cosmos_db_ready.wait()
@@ -616,20 +1280,42 @@ async def add_conversation():
         if not current_app.cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
+        ## clients can send only the new "message", the history is then read from
+        ## this worker's cache or from the history store
+        history = None
+        if "message" in request_json:
+            history = []
+            if conversation_id:
+                history = await get_conversation_history(current_app.cosmos_conversation_client, user_id, conversation_id)
+            messages = history + [request_json["message"]]
+        else:
+            messages = request_json["messages"]
+
+        ## with compact_citations the stream sends each citation body once per conversation,
+        ## the bodies already stored are only referenced by key
+        citations = None
+        if request_json.get("compact_citations"):
+            known_keys = ()
+            if conversation_id:
+                known_keys = await current_app.cosmos_conversation_client.get_citation_keys(user_id, conversation_id)
+            citations = CitationStream(known_keys)
+
         # check for the conversation_id, if the conversation is not set, we will create a new one
         history_metadata = {}
+        if citations is not None:
+            history_metadata["compact_citations"] = True
         if not conversation_id:
-            title = await generate_title(request_json["messages"])
+            title, title_usage = await generate_title(messages)
             conversation_dict = await current_app.cosmos_conversation_client.create_conversation(
                 user_id=user_id, title=title
             )
             conversation_id = conversation_dict["id"]
+            record_usage(request.headers, conversation_id, title_usage)
             history_metadata["title"] = title
             history_metadata["date"] = conversation_dict["createdAt"]
 
         ## Format the incoming message object in the "chat/completions" messages format
         ## then write it to the conversation history in cosmos
-        messages = request_json["messages"]
         if len(messages) > 0 and messages[-1]["role"] == "user":
             createdMessageValue = await current_app.cosmos_conversation_client.create_message(
                 uuid=str(uuid.uuid4()),
@@ -646,17 +1332,86 @@ async def add_conversation():
         else:
             raise Exception("No user message found")
 
+        if history is not None and createdMessageValue:
+            await conversation_history_cache.put(
+                user_id, conversation_id, createdMessageValue["createdAt"], history + [chat_message(createdMessageValue)]
+            )
+
         # Submit request to Chat Completions for response
         request_body = await request.get_json()
+        request_body["messages"] = messages
         history_metadata["conversation_id"] = conversation_id
         request_body["history_metadata"] = history_metadata
-        return await conversation_internal(request_body, request.headers)
+
+        ## with persist_answer the answer is written here once complete, the client skips /history/update
+        on_answer = None
+        if request_json.get("persist_answer"):
+            history_metadata["persist_answer"] = True
+            conversation_client = current_app.cosmos_conversation_client
+
+            user_message_created_at = createdMessageValue["createdAt"] if createdMessageValue else None
+
+            async def on_answer(answer):
+                created = await save_answer_messages(
+                    conversation_client, user_id, conversation_id, answer.tool_message, answer.assistant_message
+                )
+                if isinstance(created, dict):
+                    await conversation_history_cache.append(
+                        user_id, conversation_id, user_message_created_at, created["createdAt"], chat_message(created)
+                    )
+
+        return await conversation_internal(request_body, request.headers, on_answer, citations)
 
     except Exception as e:
         logging.exception("Exception in /history/generate")
         return jsonify({"error": str(e)}), 500
 
 
+async def get_conversation_history(conversation_client, user_id, conversation_id) -> list:
+    """Return the user and assistant messages of a conversation, from the cache while it's current."""
+    conversation = await conversation_client.get_conversation(user_id, conversation_id)
+    if not conversation:
+        raise Exception("Conversation not found for the given conversation ID: " + conversation_id + ".")
+
+    history = await conversation_history_cache.get(user_id, conversation_id, conversation["updatedAt"])
+    if history is None:
+        history = [
+            chat_message(message)
+            for message in await conversation_client.get_messages(user_id, conversation_id)
+            if message["role"] in ("user", "assistant")
+        ]
+        await conversation_history_cache.put(user_id, conversation_id, conversation["updatedAt"], history)
+    return history
+
+
+async def save_answer_messages(conversation_client, user_id, conversation_id, tool_message, assistant_message):
+    # Create an empty tool message if not present
+    if tool_message is None:
+        tool_message = {
+            "role": "tool",
+            "content": "{\"citations\": []}"
+        }
+    # Store the citation bodies in the conversation's citation table, the message only references them
+    content, bodies = split_citations(tool_message["content"])
+    if bodies:
+        await conversation_client.add_citations(user_id, conversation_id, bodies)
+        tool_message = {**tool_message, "content": content}
+    # Write the tool message first
+    await conversation_client.create_message(
+        uuid=str(uuid.uuid4()),
+        conversation_id=conversation_id,
+        user_id=user_id,
+        input_message=tool_message,
+    )
+    # Write the assistant message
+    return await conversation_client.create_message(
+        uuid=assistant_message.get("id") or str(uuid.uuid4()),
+        conversation_id=conversation_id,
+        user_id=user_id,
+        input_message=assistant_message,
+    )
+
+
 @bp.route("/history/update", methods=["POST"])
 async def update_conversation():
     await cosmos_db_ready.wait()
@@ -681,29 +1436,12 @@ async def update_conversation():
         messages = request_json["messages"]
         # Always expect the last message to be 'assistant'.
         if len(messages) > 0 and messages[-1]["role"] == "assistant":
-            # Try to find citations in the previous message, or create an empty tool message if not present
+            # Try to find citations in the previous message
             tool_message = None
             if len(messages) > 1 and messages[-2].get("role", None) == "tool":
                 tool_message = messages[-2]
-            else:
-                # Create an empty tool message if not present
-                tool_message = {
-                    "role": "tool",
-                    "content": "{\"citations\": []}"
-                }
-            # Write the tool message first
-            await current_app.cosmos_conversation_client.create_message(
-                uuid=str(uuid.uuid4()),
-                conversation_id=conversation_id,
-                user_id=user_id,
-                input_message=tool_message,
-            )
-            # Write the assistant message
-            await current_app.cosmos_conversation_client.create_message(
-                uuid=messages[-1]["id"],
-                conversation_id=conversation_id,
-                user_id=user_id,
-                input_message=messages[-1],
+            await save_answer_messages(
+                current_app.cosmos_conversation_client, user_id, conversation_id, tool_message, messages[-1]
             )
         else:
             raise Exception("No bot messages found")
@@ -791,6 +1529,8 @@ async def delete_conversation():
         deleted_conversation = await current_app.cosmos_conversation_client.delete_conversation(
             user_id, conversation_id
         )
+        await current_app.cosmos_conversation_client.delete_citations(user_id, conversation_id)
+        await conversation_history_cache.discard(user_id, conversation_id)
 
         return (
             jsonify(
@@ -861,24 +1601,93 @@ async def get_conversation():
             404,
         )
 
+    ## tool messages reference their citations by key, clients asking for compact_citations get
+    ## the referenced bodies once in a "citations" table, the others get them expanded in place
+    compact_citations = bool(request_json.get("compact_citations", False))
+
+    ## stream the messages as NDJSON, one message per line, as cosmos returns them
+    if request_json.get("stream", False):
+        conversation_client = current_app.cosmos_conversation_client
+
+        async def generate_messages():
+            table = None
+            async for msg in conversation_client.iter_messages(user_id, conversation_id):
+                if msg["role"] == "tool" and referenced_keys(msg["content"]):
+                    if table is None:
+                        table = await conversation_client.get_citations(user_id, conversation_id)
+                    msg["content"] = expand_citations(msg["content"], table)
+                yield format_history_message(msg)
+
+        response = await make_response(format_as_ndjson(generate_messages()))
+        response.timeout = None
+        response.mimetype = "application/json-lines"
+        return response
+
+    ## return a single page of messages when the client asks for paging
+    page_size = request_json.get("page_size", None)
+    if page_size is not None:
+        if (
+            not isinstance(page_size, int)
+            or isinstance(page_size, bool)
+            or not 1 <= page_size <= MAX_HISTORY_PAGE_SIZE
+        ):
+            return jsonify({"error": f"page_size must be an integer between 1 and {MAX_HISTORY_PAGE_SIZE}"}), 400
+
+        conversation_messages, continuation_token = await current_app.cosmos_conversation_client.get_messages_page(
+            user_id,
+            conversation_id,
+            page_size=page_size,
+            continuation_token=request_json.get("continuation_token", None),
+        )
+        response = await format_history_messages(
+            current_app.cosmos_conversation_client, user_id, conversation_id, conversation_messages, compact_citations
+        )
+        response["continuation_token"] = continuation_token
+        return jsonify(response), 200
+
     # get the messages for the conversation from cosmos
     conversation_messages = await current_app.cosmos_conversation_client.get_messages(
         user_id, conversation_id
     )
 
     ## format the messages in the bot frontend format
-    messages = [
-        {
-            "id": msg["id"],
-            "role": msg["role"],
-            "content": msg["content"],
-            "createdAt": msg["createdAt"],
-            "feedback": msg.get("feedback"),
+    response = await format_history_messages(
+        current_app.cosmos_conversation_client, user_id, conversation_id, conversation_messages, compact_citations
+    )
+    return jsonify(response), 200
+
+
+async def format_history_messages(conversation_client, user_id, conversation_id, conversation_messages, compact_citations):
+    keys = set()
+    for msg in conversation_messages:
+        if msg["role"] == "tool":
+            keys |= referenced_keys(msg["content"])
+    table = await conversation_client.get_citations(user_id, conversation_id) if keys else {}
+
+    if compact_citations:
+        return {
+            "conversation_id": conversation_id,
+            "messages": [format_history_message(msg) for msg in conversation_messages],
+            "citations": {key: table[key] for key in keys if key in table},
         }
-        for msg in conversation_messages
-    ]
 
-    return jsonify({"conversation_id": conversation_id, "messages": messages}), 200
+    for msg in conversation_messages:
+        if msg["role"] == "tool":
+            msg["content"] = expand_citations(msg["content"], table)
+    return {
+        "conversation_id": conversation_id,
+        "messages": [format_history_message(msg) for msg in conversation_messages],
+    }
+
+
+def format_history_message(msg):
+    return {
+        "id": msg["id"],
+        "role": msg["role"],
+        "content": msg["content"],
+        "createdAt": msg["createdAt"],
+        "feedback": msg.get("feedback"),
+    }
 
 
 @bp.route("/history/rename", methods=["POST"])
@@ -954,6 +1763,8 @@ async def delete_all_conversations():
             deleted_conversation = await current_app.cosmos_conversation_client.delete_conversation(
                 user_id, conversation["id"]
             )
+            await current_app.cosmos_conversation_client.delete_citations(user_id, conversation["id"])
+            await conversation_history_cache.discard(user_id, conversation["id"])
         return (
             jsonify(
                 {
@@ -992,6 +1803,15 @@ async def clear_messages():
             conversation_id, user_id
         )
 
+        await current_app.cosmos_conversation_client.delete_citations(user_id, conversation_id)
+
+        ## bump updatedAt, the history cached by other workers is no longer current
+        await conversation_history_cache.discard(user_id, conversation_id)
+        conversation = await current_app.cosmos_conversation_client.get_conversation(user_id, conversation_id)
+        if conversation:
+            conversation["updatedAt"] = datetime.utcnow().isoformat()
+            await current_app.cosmos_conversation_client.upsert_conversation(conversation)
+
         return (
             jsonify(
                 {
@@ -1009,7 +1829,7 @@ async def clear_messages():
 @bp.route("/history/ensure", methods=["GET"])
 async def ensure_cosmos():
     await cosmos_db_ready.wait()
-    if not app_settings.chat_history:
+    if not current_app.cosmos_conversation_client:
         return jsonify({"error": "CosmosDB is not configured"}), 404
 
     try:
@@ -1047,7 +1867,8 @@ async def ensure_cosmos():
             return jsonify({"error": "CosmosDB is not working"}), 500
 
 
-async def generate_title(conversation_messages) -> str:
+async def generate_title(conversation_messages):
+    ## returns the title and the token usage of generating it
     ## make sure the messages are sorted by _ts descending
     title_prompt = "Summarize the conversation so far into a 4-word or less title. Do not use any quotation marks or punctuation. Do not include any other commentary or description."
 
@@ -1058,16 +1879,16 @@ async def generate_title(conversation_messages) -> str:
     messages.append({"role": "user", "content": title_prompt})
 
     try:
-        azure_openai_client = await init_openai_client()
+        azure_openai_client = await get_openai_client()
         response = await azure_openai_client.chat.completions.create(
             model=app_settings.azure_openai.model, messages=messages, temperature=1, max_tokens=64
         )
 
         title = response.choices[0].message.content
-        return title
+        return title, response.usage
     except Exception as e:
         logging.exception("Exception while generating title", e)
-        return messages[-2]["content"]
+        return messages[-2]["content"], None
 
 
 app = create_app()
\ No newline at end of file
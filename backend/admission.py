@@ -0,0 +1,105 @@
+import asyncio
+import time
+from collections import deque
+
+from backend.metrics import registry
+
+admitted_requests = registry.counter(
+    "admission_admitted_total",
+    "Requests admitted by the admission controller",
+    ("controller",),
+)
+
+
+class AdmissionController():
+    """Bounds the number of concurrent requests of a kind within a worker.
+
+    A slot is held by the asyncio task that acquired it until the task
+    finishes. Quart serves each request, including its streamed body, in a
+    single task, so a streaming response keeps its slot until the last chunk
+    was sent or the client went away. ``max_concurrency`` of 0 admits
+    everything immediately.
+
+    Low priority requests (batch jobs) share the same slots but are only
+    admitted while no regular request is waiting, and at most
+    ``max_low_priority`` of them (0 for no limit) hold a slot at once.
+    """
+
+    def __init__(self, name: str, max_concurrency: int = 0, max_low_priority: int = 0):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_low_priority = max_low_priority
+        self._in_use = 0
+        self._low_priority_in_use = 0
+        self._waiters = deque()
+        self._low_priority_waiters = deque()
+        self._admitted = admitted_requests.labels(name)
+
+    @property
+    def in_use(self) -> int:
+        return self._in_use
+
+    @property
+    def low_priority_in_use(self) -> int:
+        return self._low_priority_in_use
+
+    def _has_slot(self, low_priority: bool) -> bool:
+        if self.max_concurrency > 0 and self._in_use >= self.max_concurrency:
+            return False
+        if low_priority:
+            return not self._waiters and not (
+                self.max_low_priority > 0 and self._low_priority_in_use >= self.max_low_priority
+            )
+        return True
+
+    def _take(self, low_priority: bool):
+        if self.max_concurrency > 0:
+            self._in_use += 1
+        if low_priority:
+            self._low_priority_in_use += 1
+
+    def _release(self, low_priority: bool):
+        if self.max_concurrency > 0:
+            self._in_use -= 1
+        if low_priority:
+            self._low_priority_in_use -= 1
+        self._wake()
+
+    def _wake(self):
+        ## regular requests first, low priority ones only once none is left waiting
+        for low_priority, waiters in ((False, self._waiters), (True, self._low_priority_waiters)):
+            while waiters and self._has_slot(low_priority):
+                self._take(low_priority)
+                waiters.popleft().set_result(None)
+
+    def _tracks(self, low_priority: bool) -> bool:
+        return self.max_concurrency > 0 or (low_priority and self.max_low_priority > 0)
+
+    async def admit(self, low_priority: bool = False) -> float:
+        """Wait for a slot for the current task and return the seconds spent waiting."""
+        if not self._tracks(low_priority):
+            self._admitted.inc()
+            return 0.0
+
+        start = time.perf_counter()
+        waiters = self._low_priority_waiters if low_priority else self._waiters
+        if waiters or not self._has_slot(low_priority):
+            waiter = asyncio.get_running_loop().create_future()
+            waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.cancelled():
+                    waiters.remove(waiter)
+                    # low priority requests may have been waiting behind this one
+                    self._wake()
+                else:
+                    # the slot was handed over just before the cancellation
+                    self._release(low_priority)
+                raise
+        else:
+            self._take(low_priority)
+
+        asyncio.current_task().add_done_callback(lambda _: self._release(low_priority))
+        self._admitted.inc()
+        return time.perf_counter() - start
@@ -0,0 +1,274 @@
+"""
+Caches with a tier per worker in front of a tier shared by the workers.
+
+Every gunicorn worker keeps its own copy of what it caches, so each entry
+is stored up to 2 * cpus + 1 times and a worker misses what another one
+has already loaded. ``TieredCache`` looks a key up in the worker's
+``LRUCache`` first, then in an optional ``CacheBackend`` shared by the
+workers, and writes to both. ``SqliteCacheBackend`` shares the entries of
+the workers of one host through a SQLite database in WAL mode; another
+store, e.g. Redis, only needs to implement ``CacheBackend``.
+
+The shared tier only holds strings, so the values are serialized with
+``dumps``/``loads`` (JSON by default). It is a cache: when it can't be read
+or written the value is loaded again, the request doesn't fail.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import aiosqlite
+
+from backend.metrics import registry
+
+DEFAULT_MAX_SHARED_ENTRIES = 100000
+## the expired and oldest entries of the shared database are deleted once every this many writes
+PRUNE_INTERVAL = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    expires_at REAL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_cache_updated ON cache (updated_at);
+"""
+
+cache_requests = registry.counter(
+    "cache_requests_total",
+    "Cache lookups by cache and by the tier that answered: the worker's memory, the shared tier or none",
+    ("cache", "result"),
+)
+
+
+class LRUCache():
+    """The ``max_entries`` least recently used entries of a worker, each kept for at most ``ttl`` seconds."""
+
+    def __init__(self, max_entries: int, ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        if self.max_entries <= 0:
+            return
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CacheBackend(ABC):
+    """A store of string values by namespace and key, shared by the workers."""
+
+    @abstractmethod
+    async def get(self, namespace: str, key: str) -> Optional[Tuple[str, Optional[float]]]:
+        """Return the value and the seconds it has left, or None if there is no current value."""
+        pass
+
+    @abstractmethod
+    async def set(self, namespace: str, key: str, value: str, ttl: Optional[float] = None):
+        pass
+
+    @abstractmethod
+    async def delete(self, namespace: str, key: str):
+        pass
+
+    async def close(self):
+        pass
+
+
+class SqliteCacheBackend(CacheBackend):
+    """Entries in a local SQLite database in WAL mode, shared by the workers of the host.
+
+    The database is created readable by the app's user only, the entries
+    can hold conversations. At most ``max_entries`` entries are kept, the
+    least recently written are deleted first.
+    """
+
+    def __init__(self, database_path: str, max_entries: int = DEFAULT_MAX_SHARED_ENTRIES):
+        self.database_path = database_path
+        self.max_entries = max_entries
+        self._connection = None
+        self._connection_lock = asyncio.Lock()
+        self._writes = 0
+
+    def _create(self):
+        descriptor = os.open(self.database_path, os.O_RDWR | os.O_CREAT, 0o600)
+        os.close(descriptor)
+
+    async def _get_connection(self):
+        if self._connection is None:
+            async with self._connection_lock:
+                if self._connection is None:
+                    await asyncio.to_thread(self._create)
+                    connection = await aiosqlite.connect(self.database_path)
+                    await connection.execute("PRAGMA journal_mode=WAL")
+                    await connection.execute("PRAGMA synchronous=NORMAL")
+                    await connection.execute("PRAGMA busy_timeout=5000")
+                    await connection.executescript(SCHEMA)
+                    await connection.commit()
+                    self._connection = connection
+
+        return self._connection
+
+    async def get(self, namespace, key):
+        connection = await self._get_connection()
+        async with connection.execute(
+            "SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ?", (namespace, key)
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        ttl = expires_at - time.time() if expires_at is not None else None
+        if ttl is not None and ttl <= 0:
+            return None
+        return value, ttl
+
+    async def set(self, namespace, key, value, ttl=None):
+        connection = await self._get_connection()
+        now = time.time()
+        await connection.execute(
+            "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (namespace, key, value, now + ttl if ttl is not None else None, now),
+        )
+        await connection.commit()
+        self._writes += 1
+        if self._writes % PRUNE_INTERVAL == 0:
+            await self.prune()
+
+    async def delete(self, namespace, key):
+        connection = await self._get_connection()
+        await connection.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, key))
+        await connection.commit()
+
+    async def prune(self):
+        """Delete the expired entries, then the least recently written ones over ``max_entries``."""
+        connection = await self._get_connection()
+        await connection.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+        await connection.execute(
+            "DELETE FROM cache WHERE updated_at <= ("
+            "SELECT updated_at FROM cache ORDER BY updated_at DESC LIMIT 1 OFFSET ?)",
+            (self.max_entries,),
+        )
+        await connection.commit()
+
+    async def close(self):
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+
+_shared_backend = None
+
+
+def set_shared_backend(backend: Optional[CacheBackend]):
+    """Use ``backend`` as the shared tier of the caches not given a backend of their own."""
+    global _shared_backend
+    _shared_backend = backend
+
+
+class TieredCache():
+    """The values of one cache: the worker's ``LRUCache`` in front of the shared tier, if any.
+
+    The shared tier is ``backend``, or the one set with ``set_shared_backend``.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        max_entries: int,
+        ttl: Optional[float] = None,
+        backend: Optional[CacheBackend] = None,
+        dumps=json.dumps,
+        loads=json.loads,
+    ):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.memory = LRUCache(max_entries, ttl)
+        self.enabled = max_entries > 0
+        self._backend = backend
+        self.dumps = dumps
+        self.loads = loads
+
+    @property
+    def backend(self) -> Optional[CacheBackend]:
+        if not self.enabled:
+            return None
+        return self._backend if self._backend is not None else _shared_backend
+
+    async def get(self, key: str):
+        value = self.memory.get(key)
+        if value is not None:
+            cache_requests.inc(cache=self.namespace, result="memory")
+            return value
+
+        backend = self.backend
+        if backend is not None:
+            try:
+                shared = await backend.get(self.namespace, key)
+            except Exception as e:
+                logging.warning(f"Could not read the shared {self.namespace} cache: {e}")
+                shared = None
+            if shared is not None:
+                value = self.loads(shared[0])
+                ## expires with the shared entry, not ttl seconds after this read
+                self.memory.set(key, value, shared[1])
+                cache_requests.inc(cache=self.namespace, result="shared")
+                return value
+
+        cache_requests.inc(cache=self.namespace, result="miss")
+        return None
+
+    async def set(self, key: str, value):
+        self.memory.set(key, value)
+        backend = self.backend
+        if backend is not None:
+            try:
+                await backend.set(self.namespace, key, self.dumps(value), self.ttl)
+            except Exception as e:
+                logging.warning(f"Could not write the shared {self.namespace} cache: {e}")
+
+    async def delete(self, key: str):
+        self.memory.delete(key)
+        backend = self.backend
+        if backend is not None:
+            try:
+                await backend.delete(self.namespace, key)
+            except Exception as e:
+                logging.warning(f"Could not delete from the shared {self.namespace} cache: {e}")
+
+    def clear(self):
+        """Forget the worker's entries; the shared ones expire."""
+        self.memory.clear()
@@ -0,0 +1,189 @@
+"""
+Opt-in capture of chat requests for replay with tools/replay_requests.py.
+
+``RequestCapture`` keeps the sanitized body, arrival time, status and
+latency of captured requests in memory and appends them every few seconds,
+from a thread, to JSONL files that rotate by size. Users are replaced by a
+hash of their principal id and, unless turned off, every word of message
+content and citations is replaced by x's of the same length, so the files
+keep the shape of the traffic (sizes, conversation lengths, arrival times)
+without its text.
+"""
+import asyncio
+import glob
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import time
+from collections import deque
+
+CAPTURED_ROUTES = ("/conversation", "/history/generate")
+
+DEFAULT_MAX_PENDING = 10000
+
+## message fields kept as they are, every other one is redacted
+_MESSAGE_FIELDS_KEPT = ("id", "role", "name", "tool_call_id", "date")
+_WORD_CHARACTER = re.compile(r"\w")
+
+
+def user_hash(user_id) -> str:
+    return hashlib.sha256(str(user_id).encode()).hexdigest()[:16] if user_id else None
+
+
+def redact(value):
+    """Replace the letters and digits of every string in ``value`` with x's, keeping JSON strings valid JSON."""
+    if isinstance(value, str):
+        if value[:1] in ("{", "["):
+            try:
+                return json.dumps(redact(json.loads(value)))
+            except ValueError:
+                pass
+        return _WORD_CHARACTER.sub("x", value)
+    if isinstance(value, dict):
+        return {key: redact(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    return value
+
+
+def sanitize_message(message):
+    if not isinstance(message, dict):
+        return message
+    return {key: value if key in _MESSAGE_FIELDS_KEPT else redact(value) for key, value in message.items()}
+
+
+def sanitize_body(body, redact_content: bool = True):
+    """Return a copy of a /conversation or /history/generate body safe to write to disk.
+
+    Taken when the request arrives: the routes add to the body they were sent.
+    """
+    if not isinstance(body, dict):
+        return body
+    copy_message = sanitize_message if redact_content else dict
+    sanitized = dict(body)
+    if isinstance(body.get("messages"), list):
+        sanitized["messages"] = [
+            copy_message(message) if isinstance(message, dict) else message for message in body["messages"]
+        ]
+    if isinstance(body.get("message"), dict):
+        sanitized["message"] = copy_message(body["message"])
+    return sanitized
+
+
+class RequestCapture():
+    """Captured requests waiting to be written to ``directory``.
+
+    ``record`` only appends to a bounded deque; when the files can't be
+    written fast enough the oldest records are dropped and counted in
+    ``dropped``. Each worker process writes its own files, named after the
+    time they were started, the pid and a sequence number; the oldest files
+    beyond ``max_files`` are deleted.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        sample_rate: float = 1.0,
+        redact_content: bool = True,
+        max_file_bytes: int = 50 * 2**20,
+        max_files: int = 20,
+        flush_interval: float = 5.0,
+        max_pending: int = DEFAULT_MAX_PENDING,
+    ):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.redact_content = redact_content
+        self.max_file_bytes = max_file_bytes
+        self.max_files = max_files
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._pending = deque(maxlen=max_pending)
+        self._path = None
+        self._sequence = 0
+        self._flush_task = None
+        self._closing = None
+
+    def sampled(self) -> bool:
+        ## the module's generator is reseeded in each forked worker
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def record(self, route, body, user_id, status, started, latency, stream=None, conversation_id=None):
+        """Keep a request for the next flush.
+
+        ``body`` is the copy made by ``sanitize_body`` and ``started`` the
+        arrival of the request as a Unix timestamp. ``conversation_id`` is
+        the conversation the request was answered in, which lets a replay
+        send the following requests of a new conversation to the one it
+        created.
+        """
+        if len(self._pending) == self._pending.maxlen:
+            self.dropped += 1
+        self._pending.append({
+            "time": round(started, 3),
+            "route": route,
+            "user": user_hash(user_id),
+            "stream": stream,
+            "conversation": conversation_id,
+            "status": status,
+            "latency": round(latency, 4),
+            "body": body,
+        })
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def _new_path(self):
+        self._sequence += 1
+        started = time.strftime('%Y%m%dT%H%M%S', time.gmtime())
+        return os.path.join(self.directory, f"capture-{started}-{os.getpid()}-{self._sequence}.jsonl")
+
+    def _prune(self):
+        files = sorted(glob.glob(os.path.join(self.directory, "capture-*.jsonl")), key=os.path.getmtime)
+        for path in files[:max(0, len(files) - self.max_files)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def write(self, lines):
+        """Append JSONL lines to the current file, starting a new one when it is full."""
+        os.makedirs(self.directory, exist_ok=True)
+        if self._path is None or (os.path.exists(self._path) and os.path.getsize(self._path) >= self.max_file_bytes):
+            self._path = self._new_path()
+        with open(self._path, "a", encoding="utf-8") as file:
+            file.writelines(lines)
+        self._prune()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        records = list(self._pending)
+        self._pending.clear()
+        lines = [json.dumps(record, separators=(",", ":")) + "\n" for record in records]
+        try:
+            await asyncio.to_thread(self.write, lines)
+        except OSError:
+            logging.exception(f"Failed to write {len(records)} captured requests to {self.directory}")
+
+    async def _flush_periodically(self):
+        while not self._closing.is_set():
+            try:
+                await asyncio.wait_for(self._closing.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                await self.flush()
+
+    def start(self):
+        """Flush every ``flush_interval`` seconds until ``close``."""
+        if self._flush_task is None:
+            self._closing = asyncio.Event()
+            self._flush_task = asyncio.ensure_future(self._flush_periodically())
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._closing.set()
+            await self._flush_task
+            self._flush_task = None
+        await self.flush()
@@ -0,0 +1,114 @@
+"""
+Content-addressed citations.
+
+The tool message of an answer carries the full text of every chunk it
+cites, and the same chunks tend to be cited again and again within a
+conversation. Citation bodies are stored once per conversation, keyed by a
+hash of their content and source, and tool messages reference them as
+``{"ref": key}``. Compact streams send a body only the first time it is
+cited in a conversation, with its key in ``ref`` so the client can keep its
+own table.
+"""
+import hashlib
+import json
+
+CITATION_KEY_LENGTH = 32
+
+
+def citation_key(citation: dict) -> str:
+    source = [citation.get("content"), citation.get("filepath"), citation.get("url")]
+    return hashlib.sha256(json.dumps(source).encode()).hexdigest()[:CITATION_KEY_LENGTH]
+
+
+def is_reference(citation) -> bool:
+    return isinstance(citation, dict) and citation.keys() == {"ref"}
+
+
+def _load_context(content):
+    """Return the parsed tool message content if it holds a list of citations, else None."""
+    try:
+        context = json.loads(content)
+    except (TypeError, ValueError):
+        return None
+    if isinstance(context, dict) and isinstance(context.get("citations"), list):
+        return context
+    return None
+
+
+def _body(citation: dict) -> dict:
+    return {name: value for name, value in citation.items() if name != "ref"}
+
+
+def split_citations(content):
+    """Return ``(content, bodies)``: the content with every citation replaced by a reference, and the bodies by key."""
+    context = _load_context(content)
+    if context is None:
+        return content, {}
+
+    bodies = {}
+    references = []
+    for citation in context["citations"]:
+        if is_reference(citation) or not isinstance(citation, dict):
+            references.append(citation)
+            continue
+        body = _body(citation)
+        key = citation_key(body)
+        bodies[key] = body
+        references.append({"ref": key})
+
+    context["citations"] = references
+    return json.dumps(context), bodies
+
+
+def referenced_keys(content) -> set:
+    context = _load_context(content)
+    if context is None:
+        return set()
+    return {citation["ref"] for citation in context["citations"] if is_reference(citation)}
+
+
+def expand_citations(content, table: dict):
+    """Replace the references found in ``table`` by their bodies; unknown references are left as they are."""
+    context = _load_context(content)
+    if context is None or not any(is_reference(citation) for citation in context["citations"]):
+        return content
+
+    context["citations"] = [
+        table.get(citation["ref"], citation) if is_reference(citation) else citation
+        for citation in context["citations"]
+    ]
+    return json.dumps(context)
+
+
+class CitationStream():
+    """Rewrites the tool messages of a compact stream given the citation keys the client already has."""
+
+    def __init__(self, known_keys=()):
+        self.known_keys = set(known_keys)
+
+    def compact(self, content):
+        context = _load_context(content)
+        if context is None:
+            return content
+
+        citations = []
+        for citation in context["citations"]:
+            if is_reference(citation) or not isinstance(citation, dict):
+                citations.append(citation)
+                continue
+            body = _body(citation)
+            key = citation_key(body)
+            if key in self.known_keys:
+                citations.append({"ref": key})
+            else:
+                self.known_keys.add(key)
+                citations.append({**body, "ref": key})
+
+        context["citations"] = citations
+        return json.dumps(context)
+
+    def compact_response(self, response_obj):
+        for message in response_obj.get("choices", [{}])[0].get("messages", []):
+            if message.get("role") == "tool" and "content" in message:
+                message["content"] = self.compact(message["content"])
+        return response_obj
@@ -0,0 +1,101 @@
+from abc import ABC, abstractmethod
+
+
+class ConversationClientBase(ABC):
+    """Interface of the chat history stores used by the /history routes.
+
+    Conversations and messages are plain dicts shaped like the Cosmos DB
+    documents: conversations carry ``id``, ``userId``, ``title``,
+    ``createdAt`` and ``updatedAt``; messages additionally carry
+    ``conversationId``, ``role``, ``content`` and, when feedback is enabled,
+    ``feedback``. Every lookup is scoped to the user that owns the data.
+    """
+
+    @abstractmethod
+    async def ensure(self):
+        """Return ``(success, message)`` describing whether the store is usable."""
+
+    @abstractmethod
+    async def create_conversation(self, user_id, title = ''):
+        pass
+
+    @abstractmethod
+    async def upsert_conversation(self, conversation):
+        pass
+
+    @abstractmethod
+    async def delete_conversation(self, user_id, conversation_id):
+        pass
+
+    @abstractmethod
+    async def delete_messages(self, conversation_id, user_id):
+        pass
+
+    @abstractmethod
+    async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        pass
+
+    @abstractmethod
+    async def get_conversation(self, user_id, conversation_id):
+        """Return the conversation, or None if the user has no such conversation."""
+
+    @abstractmethod
+    async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+        """Store a message and bump the conversation's updatedAt.
+
+        Returns the stored message, or the string "Conversation not found".
+        """
+
+    @abstractmethod
+    async def update_message_feedback(self, user_id, message_id, feedback):
+        """Return the updated message, or False if the user has no such message."""
+
+    @abstractmethod
+    async def get_messages(self, user_id, conversation_id):
+        """Return all messages of the conversation ordered by createdAt."""
+
+    @abstractmethod
+    async def get_messages_page(self, user_id, conversation_id, page_size, continuation_token=None):
+        """Return ``(messages, continuation_token)``; the token is None on the last page."""
+
+    @abstractmethod
+    async def add_usage(self, records):
+        """Add token counts to the usage documents of each record.
+
+        A record is a dict with ``userId``, ``conversationId`` (None for chats
+        without history), ``day`` (``YYYY-MM-DD``, UTC), ``promptTokens``,
+        ``cachedTokens``, ``completionTokens`` and ``requests``; the counts are
+        added to the stored document of the same user, conversation and day.
+
+        Return the records that could not be added, if the store writes them
+        one by one; raise if none of them were.
+        """
+
+    @abstractmethod
+    async def get_usage(self, user_id=None, since=None):
+        """Return the usage documents of a user (or of every user) from ``since`` on, ordered by day."""
+
+    @abstractmethod
+    async def add_citations(self, user_id, conversation_id, citations: dict):
+        """Store citation bodies in the conversation's citation table, by key.
+
+        Keys are content hashes, so a body already stored under its key is left as it is.
+        """
+
+    @abstractmethod
+    async def get_citations(self, user_id, conversation_id):
+        """Return the conversation's citation table as a dict of bodies by key."""
+
+    @abstractmethod
+    async def delete_citations(self, user_id, conversation_id):
+        pass
+
+    async def get_citation_keys(self, user_id, conversation_id) -> set:
+        return set(await self.get_citations(user_id, conversation_id))
+
+    async def iter_messages(self, user_id, conversation_id):
+        for message in await self.get_messages(user_id, conversation_id):
+            yield message
+
+    async def close(self):
+        pass
@@ -0,0 +1,315 @@
+import json
+import uuid
+from datetime import datetime
+from azure.core import MatchConditions
+from azure.cosmos import exceptions
+from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.instrumentation import instrumented
+
+DEFAULT_EMBEDDED_MESSAGES_MAX_BYTES = 64 * 1024
+CONVERSATION_SUMMARY_FIELDS = ['id', 'type', 'createdAt', 'updatedAt', 'userId', 'title']
+MAX_WRITE_ATTEMPTS = 5
+
+
+class CosmosEmbeddedConversationClient(CosmosConversationClient):
+    """Conversation history client storing messages inside the conversation document.
+
+    The most recent messages live in the conversation document itself. When
+    they grow past ``embedded_max_bytes`` the oldest ones are moved to
+    ``messageSegment`` documents, so reading or deleting a conversation is
+    usually a single point operation. Conversations written with the
+    per-message item layout are still served through the base class.
+    """
+
+    def __init__(self, *args, embedded_max_bytes: int = DEFAULT_EMBEDDED_MESSAGES_MAX_BYTES, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.embedded_max_bytes = embedded_max_bytes
+
+    @staticmethod
+    def _is_embedded(conversation):
+        return conversation.get('layout') == 'embedded'
+
+    async def _read_conversation(self, user_id, conversation_id):
+        try:
+            conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+
+        if conversation.get('type') != 'conversation':
+            return None
+        return conversation
+
+    async def _replace_conversation(self, conversation):
+        ## optimistic concurrency: fails with a 412 if someone else wrote the document since we read it
+        return await self.container_client.replace_item(
+            item=conversation['id'],
+            body=conversation,
+            etag=conversation.get('_etag'),
+            match_condition=MatchConditions.IfNotModified
+        )
+
+    async def _read_segment(self, user_id, segment_id):
+        segment = await self.container_client.read_item(item=segment_id, partition_key=user_id)
+        return segment['messages']
+
+    async def _delete_segment(self, user_id, segment_id):
+        try:
+            await self.container_client.delete_item(item=segment_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            pass
+
+    async def _spill_messages(self, conversation):
+        messages = conversation['messages']
+        size = len(json.dumps(messages))
+        if size <= self.embedded_max_bytes or len(messages) < 2:
+            return
+
+        ## move the oldest messages out until the embedded ones fit in half of the budget,
+        ## so the next few writes don't spill again
+        spilled = []
+        while len(messages) > 1 and size > self.embedded_max_bytes // 2:
+            message = messages.pop(0)
+            spilled.append(message)
+            size -= len(json.dumps(message)) + 2
+
+        sequence = len(conversation['segments'])
+        segment = {
+            'id': f"{conversation['id']}-segment-{sequence}",
+            'type': 'messageSegment',
+            'userId': conversation['userId'],
+            'conversationId': conversation['id'],
+            'sequence': sequence,
+            'createdAt': spilled[0]['createdAt'],
+            'messages': spilled,
+            'messageIds': [m['id'] for m in spilled]
+        }
+        await self.container_client.upsert_item(segment)
+        conversation['segments'].append({'id': segment['id'], 'count': len(spilled)})
+        conversation['messageIds'] = [m['id'] for m in messages]
+
+    @instrumented
+    async def create_conversation(self, user_id, title = ''):
+        conversation = {
+            'id': str(uuid.uuid4()),
+            'type': 'conversation',
+            'createdAt': datetime.utcnow().isoformat(),
+            'updatedAt': datetime.utcnow().isoformat(),
+            'userId': user_id,
+            'title': title,
+            'layout': 'embedded',
+            'messages': [],
+            'messageIds': [],
+            'segments': []
+        }
+        resp = await self.container_client.upsert_item(conversation)
+        if resp:
+            return resp
+        else:
+            return False
+
+    @instrumented
+    async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        ## project out the embedded messages so listing stays cheap
+        parameters = [
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        fields = ", ".join(f"c.{field}" for field in CONVERSATION_SUMMARY_FIELDS)
+        query = f"SELECT {fields} FROM c where c.userId = @userId and c.type='conversation' order by c.updatedAt {sort_order}"
+        if limit is not None:
+            query += f" offset {offset} limit {limit}"
+
+        conversations = []
+        async for item in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id):
+            conversations.append(item)
+
+        return conversations
+
+    @instrumented
+    async def get_conversation(self, user_id, conversation_id):
+        return await self._read_conversation(user_id, conversation_id)
+
+    @instrumented
+    async def delete_conversation(self, user_id, conversation_id):
+        conversation = await self._read_conversation(user_id, conversation_id)
+        if not conversation:
+            return True
+
+        if self._is_embedded(conversation):
+            for segment in conversation['segments']:
+                await self._delete_segment(user_id, segment['id'])
+
+        return await self.container_client.delete_item(item=conversation_id, partition_key=user_id)
+
+    @instrumented
+    async def delete_messages(self, conversation_id, user_id):
+        for _ in range(MAX_WRITE_ATTEMPTS):
+            conversation = await self._read_conversation(user_id, conversation_id)
+            if not conversation:
+                return None
+            if not self._is_embedded(conversation):
+                return await super().delete_messages(conversation_id, user_id)
+
+            for segment in conversation['segments']:
+                await self._delete_segment(user_id, segment['id'])
+
+            deleted_message_ids = conversation['messageIds']
+            conversation.update(messages=[], messageIds=[], segments=[])
+            try:
+                await self._replace_conversation(conversation)
+                return deleted_message_ids
+            except exceptions.CosmosAccessConditionFailedError:
+                continue
+
+        raise ValueError(f"Conversation {conversation_id} kept changing while deleting its messages")
+
+    @instrumented
+    async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+        message = {
+            'id': uuid,
+            'type': 'message',
+            'userId' : user_id,
+            'createdAt': datetime.utcnow().isoformat(),
+            'updatedAt': datetime.utcnow().isoformat(),
+            'conversationId' : conversation_id,
+            'role': input_message['role'],
+            'content': input_message['content']
+        }
+
+        if self.enable_message_feedback:
+            message['feedback'] = ''
+
+        for _ in range(MAX_WRITE_ATTEMPTS):
+            conversation = await self._read_conversation(user_id, conversation_id)
+            if not conversation:
+                return "Conversation not found"
+            if not self._is_embedded(conversation):
+                return await super().create_message(uuid, conversation_id, user_id, input_message)
+
+            if uuid in conversation['messageIds']:
+                index = conversation['messageIds'].index(uuid)
+                conversation['messages'][index] = message
+            else:
+                conversation['messages'].append(message)
+                conversation['messageIds'].append(uuid)
+            conversation['updatedAt'] = message['createdAt']
+
+            await self._spill_messages(conversation)
+            try:
+                await self._replace_conversation(conversation)
+                return message
+            except exceptions.CosmosAccessConditionFailedError:
+                continue
+
+        return False
+
+    @instrumented
+    async def update_message_feedback(self, user_id, message_id, feedback):
+        parameters = [
+            {
+                'name': '@messageId',
+                'value': message_id
+            },
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        ## the message lives either in its conversation document or in one of its segments
+        query = "SELECT * FROM c WHERE c.userId = @userId AND ARRAY_CONTAINS(c.messageIds, @messageId)"
+        for _ in range(MAX_WRITE_ATTEMPTS):
+            document = None
+            async for item in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id):
+                document = item
+                break
+
+            if not document:
+                return await super().update_message_feedback(user_id, message_id, feedback)
+
+            message = next(m for m in document['messages'] if m['id'] == message_id)
+            message['feedback'] = feedback
+            try:
+                await self.container_client.replace_item(
+                    item=document['id'],
+                    body=document,
+                    etag=document.get('_etag'),
+                    match_condition=MatchConditions.IfNotModified
+                )
+                return message
+            except exceptions.CosmosAccessConditionFailedError:
+                continue
+
+        return False
+
+    @instrumented
+    async def get_messages(self, user_id, conversation_id):
+        conversation = await self._read_conversation(user_id, conversation_id)
+        if not conversation:
+            return []
+        if not self._is_embedded(conversation):
+            return await super().get_messages(user_id, conversation_id)
+
+        messages = []
+        for segment in conversation['segments']:
+            messages.extend(await self._read_segment(user_id, segment['id']))
+        messages.extend(conversation['messages'])
+
+        return messages
+
+    @instrumented
+    async def iter_messages(self, user_id, conversation_id):
+        conversation = await self._read_conversation(user_id, conversation_id)
+        if not conversation:
+            return
+        if not self._is_embedded(conversation):
+            async for message in super().iter_messages(user_id, conversation_id):
+                yield message
+            return
+
+        for segment in conversation['segments']:
+            for message in await self._read_segment(user_id, segment['id']):
+                yield message
+        for message in conversation['messages']:
+            yield message
+
+    @instrumented
+    async def get_messages_page(self, user_id, conversation_id, page_size, continuation_token=None):
+        conversation = await self._read_conversation(user_id, conversation_id)
+        if not conversation:
+            return [], None
+        if not self._is_embedded(conversation):
+            return await super().get_messages_page(user_id, conversation_id, page_size, continuation_token)
+
+        ## the continuation token is the offset of the next message; segment counts tell us which
+        ## segments overlap the requested window so only those are read
+        start = int(continuation_token) if continuation_token else 0
+        end = start + page_size
+        messages = []
+        position = 0
+        for segment in conversation['segments']:
+            segment_end = position + segment['count']
+            if segment_end > start and position < end:
+                segment_messages = await self._read_segment(user_id, segment['id'])
+                messages.extend(segment_messages[max(start - position, 0):end - position])
+            position = segment_end
+
+        embedded_messages = conversation['messages']
+        messages.extend(embedded_messages[max(start - position, 0):max(end - position, 0)])
+        total = position + len(embedded_messages)
+
+        return messages, (str(end) if end < total else None)
+
+    @instrumented
+    async def import_conversation(self, conversation, messages):
+        ## write a conversation read from the per-message item layout as an embedded document
+        document = {k: v for k, v in conversation.items() if not k.startswith('_')}
+        document.update(layout='embedded', messages=[], messageIds=[], segments=[])
+        for message in messages:
+            message = {k: v for k, v in message.items() if not k.startswith('_')}
+            document['messages'].append(message)
+            document['messageIds'].append(message['id'])
+            await self._spill_messages(document)
+
+        return await self.container_client.upsert_item(document)
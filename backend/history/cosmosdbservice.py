@@ -1,18 +1,29 @@
+import asyncio
+import logging
 import uuid
 from datetime import datetime
 from azure.cosmos.aio import CosmosClient
 from azure.cosmos import exceptions
-  
-class CosmosConversationClient():
+from backend.history.conversationclient import ConversationClientBase
+from backend.history.instrumentation import instrumented, record_cosmos_response
+
+USAGE_COUNT_FIELDS = ['promptTokens', 'cachedTokens', 'completionTokens', 'requests']
+
+class CosmosConversationClient(ConversationClientBase):
     
-    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False):
+    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False, cosmosdb_client: any = None):
         self.cosmosdb_endpoint = cosmosdb_endpoint
         self.credential = credential
         self.database_name = database_name
         self.container_name = container_name
         self.enable_message_feedback = enable_message_feedback
         try:
-            self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential)
+            ## an existing client (or a compatible stand-in) can be passed in instead of connecting here
+            self.cosmosdb_client = cosmosdb_client or CosmosClient(
+                self.cosmosdb_endpoint,
+                credential=credential,
+                raw_response_hook=record_cosmos_response,
+            )
         except exceptions.CosmosHttpResponseError as e:
             if e.status_code == 401:
                 raise ValueError("Invalid credentials") from e
@@ -45,6 +56,7 @@ class CosmosConversationClient():
             
         return True, "CosmosDB client initialized successfully"
 
+    @instrumented
     async def create_conversation(self, user_id, title = ''):
         conversation = {
             'id': str(uuid.uuid4()),  
@@ -61,6 +73,7 @@ class CosmosConversationClient():
         else:
             return False
     
+    @instrumented
     async def upsert_conversation(self, conversation):
         resp = await self.container_client.upsert_item(conversation)
         if resp:
@@ -68,8 +81,15 @@ class CosmosConversationClient():
         else:
             return False
 
+    async def close(self):
+        await self.cosmosdb_client.close()
+
+    @instrumented
     async def delete_conversation(self, user_id, conversation_id):
-        conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)        
+        try:
+            conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            conversation = None
         if conversation:
             resp = await self.container_client.delete_item(item=conversation_id, partition_key=user_id)
             return resp
@@ -77,6 +97,7 @@ class CosmosConversationClient():
             return True
 
         
+    @instrumented
     async def delete_messages(self, conversation_id, user_id):
         ## get a list of all the messages in the conversation
         messages = await self.get_messages(user_id, conversation_id)
@@ -88,6 +109,7 @@ class CosmosConversationClient():
             return response_list
 
 
+    @instrumented
     async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
         parameters = [
             {
@@ -105,6 +127,7 @@ class CosmosConversationClient():
         
         return conversations
 
+    @instrumented
     async def get_conversation(self, user_id, conversation_id):
         parameters = [
             {
@@ -127,6 +150,7 @@ class CosmosConversationClient():
         else:
             return conversations[0]
  
+    @instrumented
     async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
         message = {
             'id': uuid,
@@ -154,16 +178,20 @@ class CosmosConversationClient():
         else:
             return False
     
+    @instrumented
     async def update_message_feedback(self, user_id, message_id, feedback):
-        message = await self.container_client.read_item(item=message_id, partition_key=user_id)
-        if message:
+        try:
+            message = await self.container_client.read_item(item=message_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            message = None
+        if message and message.get('type') == 'message':
             message['feedback'] = feedback
             resp = await self.container_client.upsert_item(message)
             return resp
         else:
             return False
 
-    async def get_messages(self, user_id, conversation_id):
+    def _query_messages(self, user_id, conversation_id, page_size=None):
         parameters = [
             {
                 'name': '@conversationId',
@@ -174,10 +202,150 @@ class CosmosConversationClient():
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.timestamp ASC"
+        query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.createdAt ASC"
+        return self.container_client.query_items(
+            query=query,
+            parameters=parameters,
+            partition_key=user_id,
+            max_item_count=page_size
+        )
+
+    @instrumented
+    async def get_messages(self, user_id, conversation_id):
         messages = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
+        async for item in self._query_messages(user_id, conversation_id):
             messages.append(item)
 
         return messages
 
+    @instrumented
+    async def iter_messages(self, user_id, conversation_id):
+        ## yield messages as the query pages come back instead of buffering the whole conversation
+        async for item in self._query_messages(user_id, conversation_id):
+            yield item
+
+    @instrumented
+    async def get_messages_page(self, user_id, conversation_id, page_size, continuation_token=None):
+        ## returns a single page of messages and the token to fetch the next one (None when exhausted)
+        pager = self._query_messages(user_id, conversation_id, page_size=page_size).by_page(continuation_token)
+        messages = []
+        async for page in pager:
+            async for item in page:
+                messages.append(item)
+            break
+
+        return messages, pager.continuation_token
+
+
+    async def _add_usage_record(self, record):
+        ## one document per user, conversation and day, incremented in place with a patch
+        item_id = f"usage-{record['day']}-{record['conversationId'] or 'none'}"
+        updated_at = datetime.utcnow().isoformat()
+        operations = [{'op': 'incr', 'path': f'/{field}', 'value': record[field]} for field in USAGE_COUNT_FIELDS]
+        operations.append({'op': 'set', 'path': '/updatedAt', 'value': updated_at})
+        while True:
+            try:
+                return await self.container_client.patch_item(
+                    item=item_id, partition_key=record['userId'], patch_operations=operations
+                )
+            except exceptions.CosmosResourceNotFoundError:
+                pass
+
+            try:
+                return await self.container_client.create_item({
+                    'id': item_id,
+                    'type': 'usage',
+                    'userId': record['userId'],
+                    'conversationId': record['conversationId'],
+                    'day': record['day'],
+                    'updatedAt': updated_at,
+                    **{field: record[field] for field in USAGE_COUNT_FIELDS},
+                })
+            except exceptions.CosmosResourceExistsError:
+                # another worker created it first, patch that one
+                continue
+
+    @instrumented
+    async def add_usage(self, records):
+        ## each record is its own write, the ones that succeeded must not be retried
+        results = await asyncio.gather(*(self._add_usage_record(record) for record in records), return_exceptions=True)
+        failed = [record for record, result in zip(records, results) if isinstance(result, Exception)]
+        if failed:
+            error = next(result for result in results if isinstance(result, Exception))
+            logging.warning(f"Failed to add the token usage of {len(failed)} of {len(records)} records: {error}")
+        return failed
+
+    @instrumented
+    async def get_usage(self, user_id=None, since=None):
+        query = "SELECT * FROM c WHERE c.type='usage'"
+        parameters = []
+        if user_id is not None:
+            query += " AND c.userId = @userId"
+            parameters.append({'name': '@userId', 'value': user_id})
+        if since is not None:
+            query += " AND c.day >= @since"
+            parameters.append({'name': '@since', 'value': since})
+        query += " ORDER BY c.day ASC"
+
+        usage = []
+        async for item in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id):
+            usage.append(item)
+
+        return usage
+
+    async def _add_citation(self, user_id, conversation_id, key, citation):
+        ## the id is derived from the content hash, an existing document already holds the same body
+        try:
+            await self.container_client.create_item({
+                'id': f"citation-{conversation_id}-{key}",
+                'type': 'citation',
+                'userId': user_id,
+                'conversationId': conversation_id,
+                'key': key,
+                'createdAt': datetime.utcnow().isoformat(),
+                'citation': citation,
+            })
+        except exceptions.CosmosResourceExistsError:
+            pass
+
+    @instrumented
+    async def add_citations(self, user_id, conversation_id, citations: dict):
+        await asyncio.gather(
+            *(self._add_citation(user_id, conversation_id, key, citation) for key, citation in citations.items())
+        )
+
+    def _query_citations(self, user_id, conversation_id, select='*'):
+        parameters = [
+            {
+                'name': '@conversationId',
+                'value': conversation_id
+            },
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        query = f"SELECT {select} FROM c WHERE c.conversationId = @conversationId AND c.type='citation' AND c.userId = @userId"
+        return self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id)
+
+    @instrumented
+    async def get_citations(self, user_id, conversation_id):
+        citations = {}
+        async for item in self._query_citations(user_id, conversation_id):
+            citations[item['key']] = item['citation']
+
+        return citations
+
+    @instrumented
+    async def get_citation_keys(self, user_id, conversation_id):
+        ## only the keys, the bodies can be several KB each
+        keys = set()
+        async for item in self._query_citations(user_id, conversation_id, select='c.key'):
+            keys.add(item['key'])
+
+        return keys
+
+    @instrumented
+    async def delete_citations(self, user_id, conversation_id):
+        async for item in self._query_citations(user_id, conversation_id, select='c.id'):
+            await self.container_client.delete_item(item=item['id'], partition_key=user_id)
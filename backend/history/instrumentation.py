@@ -0,0 +1,186 @@
+"""
+Request unit and latency instrumentation of the Cosmos DB history clients.
+
+``record_cosmos_response`` is installed as the ``raw_response_hook`` of the
+Cosmos DB client and sees every HTTP response, including the ones the SDK
+retries. ``instrumented`` wraps a client method so those responses are
+attributed to the operation (the method name) and aggregated when it ends.
+Calls nested in an instrumented method, e.g. ``get_conversation`` inside
+``create_message``, are attributed to the outer operation.
+"""
+import functools
+import inspect
+import time
+from contextvars import ContextVar
+
+from backend.metrics import observe_phase, registry
+
+REQUEST_CHARGE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+# Responses the SDK (429 throttled, 449 retry with) or the embedded client (412 etag mismatch) retry
+RETRIED_STATUS_CODES = (412, 429, 449)
+
+operation_duration = registry.histogram(
+    "cosmosdb_operation_duration_seconds",
+    "Client side duration of chat history operations, including retries",
+    ("operation", "status"),
+)
+operation_server_duration = registry.histogram(
+    "cosmosdb_operation_server_duration_seconds",
+    "Sum of the x-ms-request-duration-ms reported by Cosmos DB for the requests of an operation",
+    ("operation",),
+)
+operation_request_charge = registry.histogram(
+    "cosmosdb_operation_request_charge",
+    "Request units consumed by an operation, from x-ms-request-charge",
+    ("operation",),
+    buckets=REQUEST_CHARGE_BUCKETS,
+)
+operation_requests = registry.histogram(
+    "cosmosdb_operation_requests",
+    "Cosmos DB round trips of an operation",
+    ("operation",),
+    buckets=COUNT_BUCKETS,
+)
+operation_items = registry.histogram(
+    "cosmosdb_operation_items",
+    "Documents returned by the queries of an operation, from x-ms-item-count",
+    ("operation",),
+    buckets=COUNT_BUCKETS,
+)
+retried_requests = registry.counter(
+    "cosmosdb_retried_requests_total",
+    "Responses of chat history operations that were retried (412, 429 and 449)",
+    ("operation", "status_code"),
+)
+throttled_requests = registry.counter(
+    "cosmosdb_throttled_requests_total",
+    "Responses of chat history operations throttled with 429",
+    ("operation",),
+)
+
+_current_operation: ContextVar = ContextVar("cosmosdb_operation", default=None)
+_request_diagnostics: ContextVar = ContextVar("cosmosdb_request_diagnostics", default=None)
+
+
+class OperationStats():
+    def __init__(self, operation: str):
+        self.operation = operation
+        self.request_charge = 0.0
+        self.server_duration_ms = 0.0
+        self.requests = 0
+        self.items = 0
+        self.retried = 0
+        self.throttled = 0
+        self.duration_ms = 0.0
+
+    def add_response(self, status_code, headers):
+        self.requests += 1
+        self.request_charge += float(headers.get("x-ms-request-charge") or 0)
+        self.server_duration_ms += float(headers.get("x-ms-request-duration-ms") or 0)
+        self.items += int(headers.get("x-ms-item-count") or 0)
+        if status_code in RETRIED_STATUS_CODES:
+            self.retried += 1
+            retried_requests.inc(operation=self.operation, status_code=str(status_code))
+        if status_code == 429:
+            self.throttled += 1
+            throttled_requests.inc(operation=self.operation)
+
+    def as_dict(self):
+        return {
+            "operation": self.operation,
+            "ru": round(self.request_charge, 2),
+            "ms": round(self.duration_ms, 1),
+            "server_ms": round(self.server_duration_ms, 1),
+            "requests": self.requests,
+            "items": self.items,
+            "retried": self.retried,
+            "throttled": self.throttled,
+        }
+
+
+def record_cosmos_response(pipeline_response):
+    """raw_response_hook attributing each Cosmos DB response to the running operation."""
+    stats = _current_operation.get()
+    if stats is None:
+        return
+    http_response = pipeline_response.http_response
+    stats.add_response(http_response.status_code, http_response.headers)
+
+
+def _finish(stats: OperationStats, start: float, status: str):
+    stats.duration_ms = (time.perf_counter() - start) * 1000
+    operation_duration.observe(stats.duration_ms / 1000, operation=stats.operation, status=status)
+    operation_server_duration.observe(stats.server_duration_ms / 1000, operation=stats.operation)
+    operation_request_charge.observe(stats.request_charge, operation=stats.operation)
+    operation_requests.observe(stats.requests, operation=stats.operation)
+    operation_items.observe(stats.items, operation=stats.operation)
+    observe_phase("cosmosdb", stats.duration_ms / 1000)
+
+    diagnostics = _request_diagnostics.get()
+    if diagnostics is not None:
+        diagnostics.append(stats.as_dict())
+
+
+def instrumented(function):
+    """Record the Cosmos DB cost of an async client method (or async generator) under its name."""
+    operation = function.__name__
+
+    if inspect.isasyncgenfunction(function):
+        @functools.wraps(function)
+        async def generator_wrapper(*args, **kwargs):
+            if _current_operation.get() is not None:
+                async for item in function(*args, **kwargs):
+                    yield item
+                return
+
+            stats = OperationStats(operation)
+            start = time.perf_counter()
+            status = "error"
+            # set around each step rather than for the lifetime of the generator,
+            # so work the consumer does between items isn't attributed to it
+            iterator = function(*args, **kwargs).__aiter__()
+            try:
+                while True:
+                    _current_operation.set(stats)
+                    try:
+                        item = await iterator.__anext__()
+                    except StopAsyncIteration:
+                        status = "ok"
+                        break
+                    finally:
+                        _current_operation.set(None)
+                    yield item
+            finally:
+                await iterator.aclose()
+                _finish(stats, start, status)
+
+        return generator_wrapper
+
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        if _current_operation.get() is not None:
+            return await function(*args, **kwargs)
+
+        stats = OperationStats(operation)
+        start = time.perf_counter()
+        token = _current_operation.set(stats)
+        status = "error"
+        try:
+            result = await function(*args, **kwargs)
+            status = "ok"
+            return result
+        finally:
+            _current_operation.reset(token)
+            _finish(stats, start, status)
+
+    return wrapper
+
+
+def start_request_diagnostics():
+    """Collect the stats of the operations run by the current request, see ``get_request_diagnostics``."""
+    _request_diagnostics.set([])
+
+
+def get_request_diagnostics():
+    return _request_diagnostics.get()
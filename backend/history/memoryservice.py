@@ -0,0 +1,138 @@
+import copy
+import uuid
+from datetime import datetime
+from backend.history.conversationclient import ConversationClientBase
+
+
+class InMemoryConversationClient(ConversationClientBase):
+    """Chat history kept in process memory, for local development and load tests.
+
+    Nothing is persisted and every worker process has its own copy of the data.
+    """
+
+    def __init__(self, enable_message_feedback: bool = False):
+        self.enable_message_feedback = enable_message_feedback
+        self.conversations = {}
+        self.messages = {}
+        self.usage = {}
+        self.citations = {}
+
+    async def ensure(self):
+        return True, "In-memory chat history initialized successfully"
+
+    async def create_conversation(self, user_id, title = ''):
+        conversation = {
+            'id': str(uuid.uuid4()),
+            'type': 'conversation',
+            'createdAt': datetime.utcnow().isoformat(),
+            'updatedAt': datetime.utcnow().isoformat(),
+            'userId': user_id,
+            'title': title
+        }
+        return await self.upsert_conversation(conversation)
+
+    async def upsert_conversation(self, conversation):
+        self.conversations[(conversation['userId'], conversation['id'])] = copy.deepcopy(conversation)
+        return copy.deepcopy(conversation)
+
+    async def delete_conversation(self, user_id, conversation_id):
+        self.conversations.pop((user_id, conversation_id), None)
+        return True
+
+    async def delete_messages(self, conversation_id, user_id):
+        messages = self.messages.pop((user_id, conversation_id), {})
+        if messages:
+            return list(messages)
+
+    async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        conversations = sorted(
+            (c for (owner, _), c in self.conversations.items() if owner == user_id),
+            key=lambda c: c['updatedAt'],
+            reverse=sort_order.upper() == 'DESC'
+        )
+        offset = int(offset)
+        if limit is not None:
+            conversations = conversations[offset:offset + int(limit)]
+
+        return copy.deepcopy(conversations)
+
+    async def get_conversation(self, user_id, conversation_id):
+        return copy.deepcopy(self.conversations.get((user_id, conversation_id)))
+
+    async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+        conversation = self.conversations.get((user_id, conversation_id))
+        if not conversation:
+            return "Conversation not found"
+
+        message = {
+            'id': uuid,
+            'type': 'message',
+            'userId' : user_id,
+            'createdAt': datetime.utcnow().isoformat(),
+            'updatedAt': datetime.utcnow().isoformat(),
+            'conversationId' : conversation_id,
+            'role': input_message['role'],
+            'content': input_message['content']
+        }
+
+        if self.enable_message_feedback:
+            message['feedback'] = ''
+
+        ## messages are kept in insertion order, keyed by id so upserts replace in place
+        self.messages.setdefault((user_id, conversation_id), {})[uuid] = message
+        conversation['updatedAt'] = message['createdAt']
+        return copy.deepcopy(message)
+
+    async def update_message_feedback(self, user_id, message_id, feedback):
+        for (owner, _), messages in self.messages.items():
+            if owner == user_id and message_id in messages:
+                messages[message_id]['feedback'] = feedback
+                return copy.deepcopy(messages[message_id])
+
+        return False
+
+    async def get_messages(self, user_id, conversation_id):
+        messages = self.messages.get((user_id, conversation_id), {})
+        return copy.deepcopy(sorted(messages.values(), key=lambda m: m['createdAt']))
+
+    async def get_messages_page(self, user_id, conversation_id, page_size, continuation_token=None):
+        messages = await self.get_messages(user_id, conversation_id)
+        start = int(continuation_token) if continuation_token else 0
+        end = start + page_size
+        return messages[start:end], (str(end) if end < len(messages) else None)
+
+    async def add_usage(self, records):
+        for record in records:
+            key = (record['userId'], record['conversationId'], record['day'])
+            usage = self.usage.setdefault(key, {
+                'type': 'usage',
+                'userId': record['userId'],
+                'conversationId': record['conversationId'],
+                'day': record['day'],
+                'promptTokens': 0,
+                'cachedTokens': 0,
+                'completionTokens': 0,
+                'requests': 0,
+            })
+            for field in ('promptTokens', 'cachedTokens', 'completionTokens', 'requests'):
+                usage[field] += record[field]
+            usage['updatedAt'] = datetime.utcnow().isoformat()
+        return []
+
+    async def get_usage(self, user_id=None, since=None):
+        usage = [
+            u for u in self.usage.values()
+            if (user_id is None or u['userId'] == user_id) and (since is None or u['day'] >= since)
+        ]
+        return copy.deepcopy(sorted(usage, key=lambda u: u['day']))
+
+    async def add_citations(self, user_id, conversation_id, citations: dict):
+        table = self.citations.setdefault((user_id, conversation_id), {})
+        for key, citation in citations.items():
+            table.setdefault(key, copy.deepcopy(citation))
+
+    async def get_citations(self, user_id, conversation_id):
+        return copy.deepcopy(self.citations.get((user_id, conversation_id), {}))
+
+    async def delete_citations(self, user_id, conversation_id):
+        self.citations.pop((user_id, conversation_id), None)
@@ -0,0 +1,59 @@
+import json
+
+from backend.cache import TieredCache
+
+DEFAULT_MAX_CONVERSATIONS = 1000
+
+
+def chat_message(message: dict) -> dict:
+    """Keep the fields of a stored message that are sent back to the model."""
+    return {"id": message["id"], "role": message["role"], "content": message["content"]}
+
+
+class ConversationHistoryCache():
+    """The user and assistant messages of recent conversations.
+
+    Each worker keeps the conversations it used last, in front of the cache
+    shared by the workers when there is one, see ``backend.cache``. An entry
+    is only served while the conversation's ``updatedAt`` is the one it was
+    stored with, so messages written by another worker (or instance) are
+    never missed: the history is read from the store again instead.
+    Tool messages aren't kept, the model never sees the citations of
+    previous answers.
+    """
+
+    def __init__(self, max_conversations: int = DEFAULT_MAX_CONVERSATIONS, backend=None):
+        self.max_conversations = max_conversations
+        self._cache = TieredCache("conversation_history", max_conversations, backend=backend)
+
+    @staticmethod
+    def _key(user_id, conversation_id) -> str:
+        return json.dumps([user_id, conversation_id])
+
+    async def get(self, user_id, conversation_id, updated_at):
+        entry = await self._cache.get(self._key(user_id, conversation_id))
+        if entry is None or entry[0] != updated_at:
+            return None
+        return entry[1]
+
+    async def put(self, user_id, conversation_id, updated_at, messages: list):
+        await self._cache.set(
+            self._key(user_id, conversation_id),
+            [updated_at, [message for message in messages if message["role"] in ("user", "assistant")]],
+        )
+
+    async def append(self, user_id, conversation_id, previous_updated_at, updated_at, message: dict):
+        """Add a message written by this worker, if the entry was current right before the write.
+
+        A message written by another worker for the same conversation between
+        the two writes isn't detected; that needs concurrent turns in one
+        conversation.
+        """
+        messages = await self.get(user_id, conversation_id, previous_updated_at)
+        if messages is None:
+            await self.discard(user_id, conversation_id)
+            return
+        await self.put(user_id, conversation_id, updated_at, messages + [message])
+
+    async def discard(self, user_id, conversation_id):
+        await self._cache.delete(self._key(user_id, conversation_id))
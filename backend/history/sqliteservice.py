@@ -0,0 +1,343 @@
+import asyncio
+import base64
+import json
+import uuid
+from datetime import datetime
+
+import aiosqlite
+
+from backend.history.conversationclient import ConversationClientBase
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    user_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    document TEXT NOT NULL,
+    PRIMARY KEY (user_id, id)
+);
+CREATE INDEX IF NOT EXISTS ix_conversations_user_updated ON conversations (user_id, updated_at);
+CREATE TABLE IF NOT EXISTS messages (
+    user_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    conversation_id TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    document TEXT NOT NULL,
+    PRIMARY KEY (user_id, id)
+);
+CREATE INDEX IF NOT EXISTS ix_messages_conversation_created ON messages (conversation_id, created_at);
+CREATE TABLE IF NOT EXISTS usage (
+    user_id TEXT NOT NULL,
+    conversation_id TEXT NOT NULL,
+    day TEXT NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    cached_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    requests INTEGER NOT NULL,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (user_id, conversation_id, day)
+);
+CREATE INDEX IF NOT EXISTS ix_usage_day ON usage (day);
+CREATE TABLE IF NOT EXISTS citations (
+    user_id TEXT NOT NULL,
+    conversation_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    document TEXT NOT NULL,
+    PRIMARY KEY (user_id, conversation_id, key)
+);
+"""
+
+
+def _encode_token(created_at, rowid):
+    return base64.urlsafe_b64encode(json.dumps([created_at, rowid]).encode()).decode()
+
+
+def _decode_token(continuation_token):
+    return json.loads(base64.urlsafe_b64decode(continuation_token.encode()))
+
+
+class SqliteConversationClient(ConversationClientBase):
+    """Chat history stored in a local SQLite database in WAL mode.
+
+    Documents are stored as JSON next to the columns used for lookups and
+    ordering, so they keep the same shape as the Cosmos DB documents. WAL
+    lets every gunicorn worker read while another one writes.
+    """
+
+    def __init__(self, database_path: str, enable_message_feedback: bool = False):
+        self.database_path = database_path
+        self.enable_message_feedback = enable_message_feedback
+        self._connection = None
+        self._connection_lock = asyncio.Lock()
+
+    async def _get_connection(self):
+        if self._connection is None:
+            async with self._connection_lock:
+                if self._connection is None:
+                    connection = await aiosqlite.connect(self.database_path)
+                    await connection.execute("PRAGMA journal_mode=WAL")
+                    await connection.execute("PRAGMA synchronous=NORMAL")
+                    await connection.execute("PRAGMA busy_timeout=5000")
+                    await connection.executescript(SCHEMA)
+                    await connection.commit()
+                    self._connection = connection
+
+        return self._connection
+
+    async def close(self):
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+    async def ensure(self):
+        try:
+            connection = await self._get_connection()
+            await connection.execute("SELECT 1")
+        except Exception as e:
+            return False, f"SQLite chat history database {self.database_path} is not usable: {e}"
+
+        return True, "SQLite chat history initialized successfully"
+
+    async def create_conversation(self, user_id, title = ''):
+        conversation = {
+            'id': str(uuid.uuid4()),
+            'type': 'conversation',
+            'createdAt': datetime.utcnow().isoformat(),
+            'updatedAt': datetime.utcnow().isoformat(),
+            'userId': user_id,
+            'title': title
+        }
+        return await self.upsert_conversation(conversation)
+
+    async def upsert_conversation(self, conversation):
+        connection = await self._get_connection()
+        await connection.execute(
+            "INSERT INTO conversations (user_id, id, updated_at, document) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (user_id, id) DO UPDATE SET updated_at = excluded.updated_at, document = excluded.document",
+            (conversation['userId'], conversation['id'], conversation['updatedAt'], json.dumps(conversation))
+        )
+        await connection.commit()
+        return conversation
+
+    async def delete_conversation(self, user_id, conversation_id):
+        connection = await self._get_connection()
+        await connection.execute(
+            "DELETE FROM conversations WHERE user_id = ? AND id = ?",
+            (user_id, conversation_id)
+        )
+        await connection.commit()
+        return True
+
+    async def delete_messages(self, conversation_id, user_id):
+        connection = await self._get_connection()
+        async with connection.execute(
+            "DELETE FROM messages WHERE user_id = ? AND conversation_id = ? RETURNING id",
+            (user_id, conversation_id)
+        ) as cursor:
+            deleted = [row[0] for row in await cursor.fetchall()]
+        await connection.commit()
+        if deleted:
+            return deleted
+
+    async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        order = 'DESC' if sort_order.upper() == 'DESC' else 'ASC'
+        query = f"SELECT document FROM conversations WHERE user_id = ? ORDER BY updated_at {order}"
+        parameters = [user_id]
+        if limit is not None:
+            query += " LIMIT ? OFFSET ?"
+            parameters.extend([int(limit), int(offset)])
+
+        connection = await self._get_connection()
+        async with connection.execute(query, parameters) as cursor:
+            return [json.loads(row[0]) for row in await cursor.fetchall()]
+
+    async def get_conversation(self, user_id, conversation_id):
+        connection = await self._get_connection()
+        async with connection.execute(
+            "SELECT document FROM conversations WHERE user_id = ? AND id = ?",
+            (user_id, conversation_id)
+        ) as cursor:
+            row = await cursor.fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+        conversation = await self.get_conversation(user_id, conversation_id)
+        if not conversation:
+            return "Conversation not found"
+
+        message = {
+            'id': uuid,
+            'type': 'message',
+            'userId' : user_id,
+            'createdAt': datetime.utcnow().isoformat(),
+            'updatedAt': datetime.utcnow().isoformat(),
+            'conversationId' : conversation_id,
+            'role': input_message['role'],
+            'content': input_message['content']
+        }
+
+        if self.enable_message_feedback:
+            message['feedback'] = ''
+
+        ## write the message and bump the parent conversation's updatedAt in one transaction
+        conversation['updatedAt'] = message['createdAt']
+        connection = await self._get_connection()
+        await connection.execute(
+            "INSERT INTO messages (user_id, id, conversation_id, created_at, document) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (user_id, id) DO UPDATE SET created_at = excluded.created_at, document = excluded.document",
+            (user_id, uuid, conversation_id, message['createdAt'], json.dumps(message))
+        )
+        await connection.execute(
+            "UPDATE conversations SET updated_at = ?, document = ? WHERE user_id = ? AND id = ?",
+            (conversation['updatedAt'], json.dumps(conversation), user_id, conversation_id)
+        )
+        await connection.commit()
+        return message
+
+    async def update_message_feedback(self, user_id, message_id, feedback):
+        connection = await self._get_connection()
+        async with connection.execute(
+            "SELECT document FROM messages WHERE user_id = ? AND id = ?",
+            (user_id, message_id)
+        ) as cursor:
+            row = await cursor.fetchone()
+        if not row:
+            return False
+
+        message = json.loads(row[0])
+        message['feedback'] = feedback
+        await connection.execute(
+            "UPDATE messages SET document = ? WHERE user_id = ? AND id = ?",
+            (json.dumps(message), user_id, message_id)
+        )
+        await connection.commit()
+        return message
+
+    async def get_messages(self, user_id, conversation_id):
+        connection = await self._get_connection()
+        async with connection.execute(
+            "SELECT document FROM messages WHERE conversation_id = ? AND user_id = ? ORDER BY created_at, rowid",
+            (conversation_id, user_id)
+        ) as cursor:
+            return [json.loads(row[0]) for row in await cursor.fetchall()]
+
+    async def iter_messages(self, user_id, conversation_id):
+        connection = await self._get_connection()
+        async with connection.execute(
+            "SELECT document FROM messages WHERE conversation_id = ? AND user_id = ? ORDER BY created_at, rowid",
+            (conversation_id, user_id)
+        ) as cursor:
+            async for row in cursor:
+                yield json.loads(row[0])
+
+    async def get_messages_page(self, user_id, conversation_id, page_size, continuation_token=None):
+        ## keyset pagination: the token holds the (created_at, rowid) of the last message returned
+        query = "SELECT document, created_at, rowid FROM messages WHERE conversation_id = ? AND user_id = ?"
+        parameters = [conversation_id, user_id]
+        if continuation_token:
+            query += " AND (created_at, rowid) > (?, ?)"
+            parameters.extend(_decode_token(continuation_token))
+        query += " ORDER BY created_at, rowid LIMIT ?"
+        parameters.append(page_size + 1)
+
+        connection = await self._get_connection()
+        async with connection.execute(query, parameters) as cursor:
+            rows = await cursor.fetchall()
+
+        messages = [json.loads(row[0]) for row in rows[:page_size]]
+        if len(rows) > page_size:
+            last = rows[page_size - 1]
+            return messages, _encode_token(last[1], last[2])
+
+        return messages, None
+
+    async def add_usage(self, records):
+        ## chats without history are stored under an empty conversation id, the key can't hold NULL
+        updated_at = datetime.utcnow().isoformat()
+        connection = await self._get_connection()
+        await connection.executemany(
+            "INSERT INTO usage (user_id, conversation_id, day, prompt_tokens, cached_tokens, completion_tokens, requests, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (user_id, conversation_id, day) DO UPDATE SET "
+            "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+            "cached_tokens = cached_tokens + excluded.cached_tokens, "
+            "completion_tokens = completion_tokens + excluded.completion_tokens, "
+            "requests = requests + excluded.requests, "
+            "updated_at = excluded.updated_at",
+            [
+                (
+                    record['userId'], record['conversationId'] or '', record['day'], record['promptTokens'],
+                    record['cachedTokens'], record['completionTokens'], record['requests'], updated_at
+                )
+                for record in records
+            ]
+        )
+        await connection.commit()
+        return []
+
+    async def get_usage(self, user_id=None, since=None):
+        query = (
+            "SELECT user_id, conversation_id, day, prompt_tokens, cached_tokens, completion_tokens, requests, updated_at "
+            "FROM usage WHERE 1 = 1"
+        )
+        parameters = []
+        if user_id is not None:
+            query += " AND user_id = ?"
+            parameters.append(user_id)
+        if since is not None:
+            query += " AND day >= ?"
+            parameters.append(since)
+        query += " ORDER BY day"
+
+        connection = await self._get_connection()
+        async with connection.execute(query, parameters) as cursor:
+            rows = await cursor.fetchall()
+
+        return [
+            {
+                'type': 'usage',
+                'userId': row[0],
+                'conversationId': row[1] or None,
+                'day': row[2],
+                'promptTokens': row[3],
+                'cachedTokens': row[4],
+                'completionTokens': row[5],
+                'requests': row[6],
+                'updatedAt': row[7],
+            }
+            for row in rows
+        ]
+
+    async def add_citations(self, user_id, conversation_id, citations: dict):
+        connection = await self._get_connection()
+        await connection.executemany(
+            "INSERT INTO citations (user_id, conversation_id, key, document) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (user_id, conversation_id, key) DO NOTHING",
+            [(user_id, conversation_id, key, json.dumps(citation)) for key, citation in citations.items()]
+        )
+        await connection.commit()
+
+    async def get_citations(self, user_id, conversation_id):
+        connection = await self._get_connection()
+        async with connection.execute(
+            "SELECT key, document FROM citations WHERE user_id = ? AND conversation_id = ?",
+            (user_id, conversation_id)
+        ) as cursor:
+            return {row[0]: json.loads(row[1]) for row in await cursor.fetchall()}
+
+    async def get_citation_keys(self, user_id, conversation_id):
+        connection = await self._get_connection()
+        async with connection.execute(
+            "SELECT key FROM citations WHERE user_id = ? AND conversation_id = ?",
+            (user_id, conversation_id)
+        ) as cursor:
+            return {row[0] for row in await cursor.fetchall()}
+
+    async def delete_citations(self, user_id, conversation_id):
+        connection = await self._get_connection()
+        await connection.execute(
+            "DELETE FROM citations WHERE user_id = ? AND conversation_id = ?",
+            (user_id, conversation_id)
+        )
+        await connection.commit()
@@ -0,0 +1,200 @@
+"""
+Detection of code blocking the event loop.
+
+A blocking call in a coroutine (a synchronous HTTP request, ``time.sleep``,
+heavy CPU work) stalls every other request and stream of the worker.
+``LoopWatchdog`` has a task on the event loop update a heartbeat and a
+daemon thread check it: when the heartbeat is more than ``threshold``
+seconds late the loop is stuck in one callback, so the thread takes the
+stack of the event loop thread right then, which shows the blocking call,
+and logs it once per stall. When the loop runs again the stall is counted
+in ``event_loop_blocked_total``, labelled with the innermost frame of the
+app's own code, and its duration observed in ``event_loop_blocked_seconds``.
+
+``forbid_blocking_calls`` makes known blocking calls raise
+``BlockingCallError`` when they are made on a running event loop, so tests
+catch them before they reach a worker. Calls from other threads, e.g.
+through ``asyncio.to_thread``, are allowed.
+"""
+import asyncio
+import contextlib
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from backend.metrics import registry
+
+DEFAULT_THRESHOLD = 0.5
+
+## frames of these files are the app's own code, the location reported for a stall
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_LIBRARY_DIRECTORIES = ("site-packages", "dist-packages", os.sep + "lib" + os.sep + "python")
+
+event_loop_blocked = registry.counter(
+    "event_loop_blocked_total",
+    "Times the event loop ran one callback for longer than EVENT_LOOP_BLOCK_THRESHOLD, by app code location",
+    ("location",),
+)
+event_loop_blocked_duration = registry.histogram(
+    "event_loop_blocked_seconds",
+    "How long the event loop was blocked, for stalls longer than EVENT_LOOP_BLOCK_THRESHOLD",
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+
+
+class BlockingCallError(RuntimeError):
+    pass
+
+
+def _is_app_file(filename: str) -> bool:
+    return filename.startswith(APP_ROOT) and not any(part in filename for part in _LIBRARY_DIRECTORIES)
+
+
+def blocking_location(frame) -> str:
+    """``file:line function`` of the innermost app frame of a stack, or of its innermost frame."""
+    innermost = frame
+    while frame is not None:
+        if _is_app_file(frame.f_code.co_filename):
+            break
+        frame = frame.f_back
+    frame = frame or innermost
+    if frame is None:
+        return "unknown"
+    filename = frame.f_code.co_filename
+    if _is_app_file(filename):
+        filename = os.path.relpath(filename, APP_ROOT)
+    return f"{filename}:{frame.f_lineno} {frame.f_code.co_name}"
+
+
+class LoopWatchdog():
+    """Reports event loop stalls longer than ``threshold`` seconds, with the stack that caused them."""
+
+    def __init__(self, threshold: float = DEFAULT_THRESHOLD):
+        self.threshold = threshold
+        self.interval = threshold / 4
+        self._heartbeat = None
+        self._loop = None
+        self._loop_thread_id = None
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    async def _beat(self):
+        while True:
+            self._heartbeat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    def _record(self, heartbeat, location):
+        ## runs on the event loop once it is free again
+        blocked_for = time.monotonic() - heartbeat - self.interval
+        event_loop_blocked.inc(location=location)
+        event_loop_blocked_duration.observe(blocked_for)
+
+    def _report(self, heartbeat, blocked_for):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        location = blocking_location(frame)
+        stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+        logging.warning(
+            f"Event loop blocked for {blocked_for:.3f}s at {location}\n{stack}",
+            extra={"event": "event_loop_blocked", "blocked_for": blocked_for, "location": location, "stack": stack},
+        )
+        self._loop.call_soon_threadsafe(self._record, heartbeat, location)
+
+    def _watch(self):
+        reported = None
+        while not self._stopped.wait(self.interval):
+            heartbeat = self._heartbeat
+            if heartbeat is None or heartbeat == reported:
+                continue
+            blocked_for = time.monotonic() - heartbeat - self.interval
+            if blocked_for > self.threshold:
+                reported = heartbeat
+                try:
+                    self._report(heartbeat, blocked_for)
+                except RuntimeError:
+                    ## the loop was closed meanwhile
+                    return
+
+    def start(self):
+        """Start watching the running event loop until ``close``."""
+        if self._task is not None or self.threshold <= 0:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.ensure_future(self._beat())
+        self._thread = threading.Thread(target=self._watch, name="event-loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def close(self):
+        if self._task is None:
+            return
+        self._stopped.set()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._thread.join(timeout=1)
+        self._thread = None
+
+
+def _on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def _known_blocking_calls():
+    """``(owner, attribute, name)`` of the blocking calls forbidden on the event loop."""
+    import urllib.request
+
+    calls = [
+        (time, "sleep", "time.sleep"),
+        (urllib.request, "urlopen", "urllib.request.urlopen"),
+    ]
+    try:
+        import requests
+        calls.append((requests.Session, "request", "requests"))
+    except ImportError:
+        pass
+    try:
+        import httpx
+        calls.append((httpx.Client, "send", "httpx.Client"))
+    except ImportError:
+        pass
+    return calls
+
+
+def _forbidden(function, name):
+    def forbidden(*args, **kwargs):
+        if _on_event_loop():
+            raise BlockingCallError(
+                f"{name} blocks the event loop; use the asyncio equivalent or run it with asyncio.to_thread"
+            )
+        return function(*args, **kwargs)
+
+    forbidden.__wrapped__ = function
+    return forbidden
+
+
+@contextlib.contextmanager
+def forbid_blocking_calls():
+    """Make known blocking calls raise ``BlockingCallError`` on a running event loop, until the block exits."""
+    patched = []
+    try:
+        for owner, attribute, name in _known_blocking_calls():
+            original = getattr(owner, attribute)
+            setattr(owner, attribute, _forbidden(original, name))
+            patched.append((owner, attribute, original))
+        yield
+    finally:
+        for owner, attribute, original in reversed(patched):
+            setattr(owner, attribute, original)
@@ -0,0 +1,326 @@
+"""
+In-process metrics rendered in the Prometheus text exposition format.
+
+Metrics are kept per worker process: with several gunicorn workers each
+scrape of /metrics only sees the worker that served it, so scrape every
+instance or aggregate on the Prometheus side.
+
+Recording is meant to be cheap enough for hot paths: ``labels()`` returns a
+cached child and ``observe``/``inc`` on it cost a few hundred nanoseconds.
+Updates rely on running on the event loop thread and take no lock.
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextvars import ContextVar
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    pairs = (
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(pairs) + "}"
+
+
+class _CounterChild():
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class _GaugeChild():
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value: float):
+        self.value = value
+
+
+class _HistogramChild():
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Metric(ABC):
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+
+    @abstractmethod
+    def _new_child(self):
+        pass
+
+    def labels(self, *values, **labels):
+        """Return the child for the label values, given in ``labelnames`` order or by name."""
+        if labels:
+            if values or set(labels) != set(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+            values = tuple(labels[name] for name in self.labelnames)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for values, child in sorted(list(self._children.items())):
+            lines.extend(self._render_child(tuple(zip(self.labelnames, values)), child))
+        return lines
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1, **labels):
+        self.labels(**labels).inc(amount)
+
+    def value(self, **labels):
+        return self.labels(**labels).value
+
+    def _render_child(self, labels, child):
+        return [f"{self.name}{_format_labels(labels)} {_format_value(child.value)}"]
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float, **labels):
+        self.labels(**labels).set(value)
+
+    def value(self, **labels):
+        return self.labels(**labels).value
+
+    def _render_child(self, labels, child):
+        return [f"{self.name}{_format_labels(labels)} {_format_value(child.value)}"]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.bounds = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value: float, **labels):
+        self.labels(**labels).observe(value)
+
+    def snapshot(self, **labels):
+        """Return ``{"count", "sum"}`` for the labels, zeros if nothing was observed."""
+        child = self.labels(**labels)
+        return {"count": child.count, "sum": child.sum}
+
+    def _render_child(self, labels, child):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + (math.inf,), list(child.counts)):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', _format_value(bound)),))} {cumulative}")
+        lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(child.sum)}")
+        lines.append(f"{self.name}_count{_format_labels(labels)} {child.count}")
+        return lines
+
+
+class MetricsRegistry():
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric_class, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(name, *args, **kwargs)
+            elif not isinstance(metric, metric_class):
+                raise ValueError(f"Metric {name} is already registered as a {metric.type}")
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames=()) -> Gauge:
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+## Per-request timings, labelled with the route, data source type and deployment of the request
+REQUEST_LABELS = ("route", "datasource", "deployment")
+
+request_phase_duration = registry.histogram(
+    "request_phase_duration_seconds",
+    "Time spent in each phase of a request: admission, prepare_model_args, time_to_first_token, stream, completion, tool_call, graph, cosmosdb",
+    REQUEST_LABELS + ("phase",),
+)
+
+
+class _RequestLabels():
+    __slots__ = ("values", "phases")
+
+    def __init__(self, values):
+        self.values = values
+        # phase -> histogram child, so repeated phases skip the label lookup
+        self.phases = {}
+
+
+_request_labels: ContextVar = ContextVar("metrics_request_labels", default=None)
+
+
+def set_request_labels(route: str, datasource: str, deployment: str):
+    _request_labels.set(_RequestLabels((route, datasource, deployment)))
+
+
+def get_request_labels():
+    """Return the (route, datasource, deployment) of the current request, or None outside of one."""
+    labels = _request_labels.get()
+    return labels.values if labels is not None else None
+
+
+def observe_phase(phase: str, seconds: float):
+    labels = _request_labels.get()
+    if labels is None:
+        return
+    child = labels.phases.get(phase)
+    if child is None:
+        child = labels.phases[phase] = request_phase_duration.labels(*labels.values, phase)
+    child.observe(seconds)
+
+
+class time_phase():
+    """Context manager recording the duration of its block as a request phase."""
+    __slots__ = ("phase", "start")
+
+    def __init__(self, phase: str):
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe_phase(self.phase, time.perf_counter() - self.start)
+
+
+## Per-worker process health, for comparing worker counts under load
+EVENT_LOOP_LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+event_loop_lag = registry.histogram(
+    "event_loop_lag_seconds",
+    "How late the event loop ran a callback scheduled with call_later",
+    buckets=EVENT_LOOP_LAG_BUCKETS,
+)
+process_resident_memory = registry.gauge(
+    "process_resident_memory_bytes",
+    "Resident memory of the worker process",
+)
+process_info = registry.gauge(
+    "process_info",
+    "Always 1, identifies the worker process that served the scrape",
+    ("pid",),
+)
+
+
+def _resident_memory_bytes():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class EventLoopMonitor():
+    """Samples event loop lag and resident memory every ``interval`` seconds.
+
+    Lag is how much later than asked a sleep resumes: time the loop spent
+    running other callbacks, i.e. blocking code or too much work for one
+    worker.
+    """
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        process_info.set(1, pid=str(os.getpid()))
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            event_loop_lag.observe(max(0.0, loop.time() - start - self.interval))
+            memory = _resident_memory_bytes()
+            if memory is not None:
+                process_resident_memory.set(memory)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,131 @@
+"""
+Sampling profiler of a worker's event loop, for the /admin/profile routes.
+
+A ``StackSampler`` thread takes the stack of the event loop thread every
+``interval`` seconds, the same way the loop watchdog does, and counts the
+distinct stacks. It only holds the GIL for the time it takes to walk one
+stack, so it can run on a live worker. The result is in the collapsed
+stack format (``root;caller;callee count`` per line) read by speedscope,
+flamegraph.pl and most flame graph viewers.
+
+A sampler given a task only counts the samples taken while that task runs
+on the loop, which profiles a single request among the others, and stops
+when the task is done.
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+
+from backend.loop_watchdog import APP_ROOT
+
+DEFAULT_INTERVAL = 0.005
+MAX_SECONDS = 60
+DEFAULT_MAX_PROFILES = 20
+
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    filename = code.co_filename
+    if filename.startswith(APP_ROOT):
+        filename = os.path.relpath(filename, APP_ROOT)
+    else:
+        filename = os.path.basename(filename)
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+class StackSampler():
+    """Counts the stacks of the event loop thread until ``max_seconds`` have passed or ``stop`` is called."""
+
+    def __init__(self, loop, thread_id, interval=DEFAULT_INTERVAL, max_seconds=MAX_SECONDS, task=None):
+        self.loop = loop
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.task = task
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = None
+        self.duration = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def done(self) -> bool:
+        return self.duration is not None
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+        if self.task is not None and asyncio.current_task(self.loop) is not self.task:
+            return
+        stack = []
+        while frame is not None:
+            stack.append(frame_label(frame))
+            frame = frame.f_back
+        self.stacks[tuple(reversed(stack))] += 1
+        self.samples += 1
+
+    def _run(self):
+        deadline = self.started + self.max_seconds
+        while not self._stopped.wait(self.interval) and time.monotonic() < deadline:
+            if self.task is not None and self.task.done():
+                break
+            self._sample()
+        self.duration = time.monotonic() - self.started
+
+    def start(self):
+        self.started = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    async def run(self, seconds):
+        """Sample for ``seconds`` without blocking the loop and return the collapsed stacks."""
+        self.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self.stop()
+        return self.collapsed()
+
+    def collapsed(self) -> str:
+        return "".join(
+            f"{';'.join(stack)} {count}\n" for stack, count in self.stacks.most_common()
+        )
+
+
+class ProfileStore():
+    """Profiles of single requests by id, the last ``max_profiles`` of them."""
+
+    def __init__(self, max_profiles: int = DEFAULT_MAX_PROFILES):
+        self.max_profiles = max_profiles
+        self._profiles = OrderedDict()
+
+    def profile_task(self, task, interval=DEFAULT_INTERVAL, max_seconds=MAX_SECONDS) -> str:
+        """Start profiling ``task``, which must run on the current thread's event loop, and return the profile id."""
+        profile_id = str(uuid.uuid4())
+        self._profiles[profile_id] = StackSampler(
+            asyncio.get_running_loop(), threading.get_ident(), interval, max_seconds, task
+        ).start()
+        while len(self._profiles) > self.max_profiles:
+            _, sampler = self._profiles.popitem(last=False)
+            sampler.stop()
+        return profile_id
+
+    def get(self, profile_id):
+        return self._profiles.get(profile_id)
+
+    def close(self):
+        for sampler in self._profiles.values():
+            sampler.stop()
+        self._profiles.clear()
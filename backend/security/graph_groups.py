@@ -0,0 +1,152 @@
+"""
+Group membership lookups for document-level access control on Azure AI Search.
+
+Each user's transitive group memberships are read from Microsoft Graph once
+and cached for ``ttl`` seconds along with the search filter compiled from
+them. Concurrent requests from the same user share a single lookup.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+
+import httpx
+
+from backend.cache import TieredCache
+from backend.metrics import time_phase
+from backend.security.group_filter import compile_group_filter
+
+GRAPH_TRANSITIVE_MEMBER_OF_URL = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
+GRAPH_URL = "https://graph.microsoft.com/v1.0/"
+DEFAULT_CACHE_TTL = 300
+DEFAULT_CACHE_MAX_ENTRIES = 10000
+
+
+async def fetch_user_groups(user_token, http_client: httpx.AsyncClient = None) -> list:
+    """Return the ids of every group the user is a transitive member of, following @odata.nextLink."""
+    if http_client is None:
+        async with httpx.AsyncClient(timeout=30) as client:
+            return await fetch_user_groups(user_token, client)
+
+    headers = {"Authorization": "bearer " + user_token}
+    group_ids = []
+    endpoint = GRAPH_TRANSITIVE_MEMBER_OF_URL
+    while endpoint:
+        response = await http_client.get(endpoint, headers=headers)
+        if response.status_code != 200:
+            raise GraphGroupLookupError(f"Error fetching user groups: {response.status_code} {response.text}")
+
+        page = response.json()
+        group_ids.extend(obj["id"] for obj in page.get("value", []))
+        endpoint = page.get("@odata.nextLink")
+
+    return group_ids
+
+
+async def warm_up_graph(http_client: httpx.AsyncClient):
+    """Open a connection to Graph for the lookups to reuse; any answer will do, it is not authenticated."""
+    await http_client.get(GRAPH_URL)
+
+
+class GraphGroupLookupError(Exception):
+    pass
+
+
+class UserGroups():
+    """A user's group ids and the filter last compiled from them."""
+
+    def __init__(self, group_ids: list):
+        self.group_ids = group_ids
+        self._compiled = None
+
+    def filter(self, column, snapshot, max_groups, overflow) -> str:
+        ## recompiled only when the snapshot of indexed groups changes
+        version = snapshot.version if snapshot else None
+        if self._compiled is None or self._compiled[0] != version:
+            self._compiled = (version, compile_group_filter(column, self.group_ids, snapshot, max_groups, overflow))
+        return self._compiled[1]
+
+
+class UserGroupCache():
+    """TTL cache of per-user group memberships with single-flight loading.
+
+    Entries are keyed by a hash of the user's Graph access token rather than
+    the principal id header, so a request can only ever reuse groups that
+    were read with its own token. Failed lookups are not cached. The
+    workers share the groups they read when the shared cache is enabled.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_CACHE_TTL, max_entries: int = DEFAULT_CACHE_MAX_ENTRIES, backend=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._cache = TieredCache(
+            "user_groups",
+            max_entries,
+            ttl,
+            backend,
+            dumps=lambda user_groups: json.dumps(user_groups.group_ids),
+            loads=lambda group_ids: UserGroups(json.loads(group_ids)),
+        )
+        self._loading = {}
+
+    @staticmethod
+    def key(user_token: str) -> str:
+        return hashlib.sha256(user_token.encode()).hexdigest()
+
+    async def get_or_load(self, user_token: str, loader):
+        """Return the cached value for the token, calling ``await loader()`` on a miss."""
+        key = self.key(user_token)
+        while True:
+            value = await self._cache.get(key)
+            if value is not None:
+                return value
+
+            ## only the first request for a key runs the loader, the others wait for its result
+            future = self._loading.get(key)
+            if future is None:
+                break
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # the request running the loader went away, try again
+
+        future = asyncio.get_running_loop().create_future()
+        self._loading[key] = future
+        try:
+            value = await loader()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # the waiters (if any) re-raise it, don't report it as never retrieved
+            future.exception()
+            raise
+        else:
+            await self._cache.set(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            del self._loading[key]
+
+    def clear(self):
+        self._cache.clear()
+
+
+async def get_user_groups(user_token: str, cache: UserGroupCache, http_client: httpx.AsyncClient = None) -> UserGroups:
+    """Return the groups of the user owning ``user_token``.
+
+    If Graph can't be reached the user is treated as a member of no groups,
+    so no restricted documents are returned; that result isn't cached.
+    """
+    async def load():
+        with time_phase("graph"):
+            return UserGroups(await fetch_user_groups(user_token, http_client))
+
+    try:
+        return await cache.get_or_load(user_token, load)
+    except Exception as e:
+        logging.error(f"Exception while fetching user groups: {e}")
+        return UserGroups([])
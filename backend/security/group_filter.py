@@ -0,0 +1,169 @@
+"""
+Compact permitted-groups filters for Azure AI Search.
+
+Users in large tenants are members of thousands of groups, but only the
+groups that appear in the index's permitted groups column can ever match a
+document. ``IndexedGroups`` keeps a periodically refreshed snapshot of those
+group ids, read from the index with a facet query, and
+``compile_group_filter`` intersects a user's groups with it.
+"""
+import asyncio
+import logging
+import time
+from typing import Literal, Optional
+
+import httpx
+
+SEARCH_API_VERSION = "2023-11-01"
+SEARCH_SCOPE = "https://search.azure.com/.default"
+
+GroupOverflow = Literal["truncate", "send_all", "reject"]
+
+
+class GroupFilterTooLargeError(ValueError):
+    pass
+
+
+class IndexedGroupsSnapshot():
+    def __init__(self, document_counts: dict, version: int):
+        # group id -> number of documents that grant access to it
+        self.document_counts = document_counts
+        self.version = version
+
+
+class IndexedGroups():
+    """Snapshot of the group ids present in the permitted groups column of an index.
+
+    The snapshot is loaded on first use and refreshed in the background every
+    ``refresh_interval`` seconds; requests keep using the previous snapshot
+    while a refresh runs. ``get`` returns None when no complete snapshot is
+    available, e.g. the column isn't facetable or has more distinct values
+    than ``max_groups``, and callers then use the user's full group list.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        index: str,
+        column: str,
+        key: Optional[str] = None,
+        refresh_interval: float = 600,
+        max_groups: int = 100000,
+        http_client: httpx.AsyncClient = None,
+    ):
+        self.endpoint = endpoint
+        self.index = index
+        self.column = column
+        self.key = key
+        self.refresh_interval = refresh_interval
+        self.max_groups = max_groups
+        self.http_client = http_client
+        self._snapshot = None
+        self._loaded_at = None
+        self._version = 0
+        self._refresh_task = None
+
+    async def _auth_headers(self):
+        if self.key:
+            return {"api-key": self.key}
+
+        from backend.token_cache import default_credential
+
+        token = await default_credential().get_token(SEARCH_SCOPE)
+        return {"Authorization": f"Bearer {token.token}"}
+
+    async def _query_facets(self, client: httpx.AsyncClient):
+        response = await client.post(
+            f"{self.endpoint}/indexes/{self.index}/docs/search",
+            params={"api-version": SEARCH_API_VERSION},
+            headers=await self._auth_headers(),
+            json={
+                "search": "*",
+                "top": 0,
+                # ask for one more value than accepted to detect a truncated facet list
+                "facets": [f"{self.column},count:{self.max_groups + 1}"],
+            },
+        )
+        response.raise_for_status()
+        return response.json()["@search.facets"][self.column]
+
+    async def load(self) -> Optional[IndexedGroupsSnapshot]:
+        """Read the group ids from the index, returning None if they can't all be read."""
+        try:
+            if self.http_client is None:
+                async with httpx.AsyncClient(timeout=30) as client:
+                    facets = await self._query_facets(client)
+            else:
+                facets = await self._query_facets(self.http_client)
+        except Exception as e:
+            logging.warning(f"Could not read the permitted groups of index {self.index}, using full group lists: {e}")
+            return None
+
+        if len(facets) > self.max_groups:
+            logging.warning(
+                f"Index {self.index} has more than {self.max_groups} permitted groups, using full group lists"
+            )
+            return None
+
+        self._version += 1
+        return IndexedGroupsSnapshot({facet["value"]: facet["count"] for facet in facets}, self._version)
+
+    async def _refresh(self):
+        try:
+            self._snapshot = await self.load()
+        finally:
+            self._loaded_at = time.monotonic()
+            self._refresh_task = None
+
+    async def get(self) -> Optional[IndexedGroupsSnapshot]:
+        if self._loaded_at is None:
+            ## the first requests wait for the initial load
+            if self._refresh_task is None:
+                self._refresh_task = asyncio.ensure_future(self._refresh())
+            await asyncio.shield(self._refresh_task)
+        elif time.monotonic() - self._loaded_at > self.refresh_interval and self._refresh_task is None:
+            self._refresh_task = asyncio.ensure_future(self._refresh())
+
+        return self._snapshot
+
+
+def compile_group_filter(
+    column: str,
+    user_group_ids: list,
+    snapshot: Optional[IndexedGroupsSnapshot],
+    max_groups: int,
+    overflow: GroupOverflow = "truncate",
+) -> str:
+    """Return the smallest filter granting the user access to the documents of their groups.
+
+    Without a snapshot every group of the user is kept. When more than
+    ``max_groups`` remain, ``overflow`` decides: ``truncate`` keeps the groups
+    granting access to the most documents (the user may miss some documents,
+    but never sees one they aren't permitted to), ``send_all`` keeps every
+    group and ``reject`` raises GroupFilterTooLargeError.
+    """
+    if snapshot is None:
+        group_ids = list(dict.fromkeys(user_group_ids))
+    else:
+        group_ids = sorted(
+            {group_id for group_id in user_group_ids if group_id in snapshot.document_counts},
+            key=lambda group_id: (-snapshot.document_counts[group_id], group_id)
+        )
+
+    if len(group_ids) > max_groups:
+        if overflow == "reject":
+            raise GroupFilterTooLargeError(
+                f"The user is a member of {len(group_ids)} permitted groups, more than the {max_groups} allowed in a filter"
+            )
+        if overflow == "truncate":
+            logging.warning(f"Truncating the permitted groups filter from {len(group_ids)} to {max_groups} groups")
+            group_ids = group_ids[:max_groups]
+
+    return build_group_filter(column, group_ids)
+
+
+def build_group_filter(column: str, group_ids: list) -> str:
+    if not group_ids:
+        logging.debug("No user groups found")
+
+    return f"{column}/any(g:search.in(g, '{','.join(group_ids)}'))"
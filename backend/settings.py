@@ -1,7 +1,10 @@
+import asyncio
 import os
 import json
 import logging
 from abc import ABC, abstractmethod
+
+import httpx
 from pydantic import (
     BaseModel,
     confloat,
@@ -15,11 +18,12 @@ from pydantic import (
     ValidationInfo
 )
 from pydantic.alias_generators import to_snake
-from pydantic_settings import BaseSettings, SettingsConfigDict
+from pydantic_settings import BaseSettings, DotEnvSettingsSource, SettingsConfigDict
 from typing import List, Literal, Optional
 from typing_extensions import Self
-from quart import Request
-from backend.utils import parse_multi_columns, generateFilterString
+from backend.utils import parse_multi_columns
+from backend.security.graph_groups import UserGroupCache, get_user_groups, warm_up_graph
+from backend.security.group_filter import IndexedGroups
 
 DOTENV_PATH = os.environ.get(
     "DOTENV_PATH",
@@ -32,11 +36,33 @@ DOTENV_PATH = os.environ.get(
 )
 MINIMUM_SUPPORTED_AZURE_OPENAI_PREVIEW_API_VERSION = "2024-05-01-preview"
 
+# Values of each parsed .env file, shared by every settings class
+_dotenv_values = {}
+
+
+class _SharedDotEnvSettingsSource(DotEnvSettingsSource):
+    def _read_env_files(self):
+        key = (str(self.env_file), self.env_file_encoding, self.case_sensitive, self.env_ignore_empty, self.env_parse_none_str)
+        if key not in _dotenv_values:
+            _dotenv_values[key] = super()._read_env_files()
+        return _dotenv_values[key]
+
+
+class _DotEnvSettings(BaseSettings):
+    """Settings read from the environment and from DOTENV_PATH.
+
+    The .env file is parsed once per process instead of once for each of
+    the settings classes built at startup.
+    """
+
+    @classmethod
+    def settings_customise_sources(cls, settings_cls, init_settings, env_settings, dotenv_settings, file_secret_settings):
+        return init_settings, env_settings, _SharedDotEnvSettingsSource(settings_cls, env_file=DOTENV_PATH), file_secret_settings
+
 
-class _UiSettings(BaseSettings):
+class _UiSettings(_DotEnvSettings):
     model_config = SettingsConfigDict(
         env_prefix="UI_",
-        env_file=DOTENV_PATH,
         extra="ignore",
         env_ignore_empty=True
     )
@@ -51,10 +77,9 @@ class _UiSettings(BaseSettings):
     show_chat_history_button: bool = True
 
 
-class _ChatHistorySettings(BaseSettings):
+class _ChatHistorySettings(_DotEnvSettings):
     model_config = SettingsConfigDict(
         env_prefix="AZURE_COSMOSDB_",
-        env_file=DOTENV_PATH,
         extra="ignore",
         env_ignore_empty=True
     )
@@ -64,12 +89,106 @@ class _ChatHistorySettings(BaseSettings):
     account_key: Optional[str] = None
     conversations_container: str
     enable_feedback: bool = False
+    layout: Literal["items", "embedded"] = "items"
+    embedded_max_bytes: int = 64 * 1024
+    enable_diagnostics: bool = False
+
+
+class _ChatHistoryStoreSettings(_DotEnvSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="CHAT_HISTORY_",
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    backend: Literal["cosmosdb", "sqlite", "memory"] = "cosmosdb"
+    sqlite_path: str = "chat_history.db"
+    # Used by the sqlite and memory backends, Cosmos DB uses AZURE_COSMOSDB_ENABLE_FEEDBACK
+    enable_feedback: bool = False
+    # Conversations whose messages each worker keeps for requests that only send the new message
+    message_cache_size: int = 1000
+
 
+class _UsageMeteringSettings(_DotEnvSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="USAGE_METERING_",
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    enabled: bool = True
+    flush_interval: float = 60.0
+
+
+class _StreamResumeSettings(_DotEnvSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="STREAM_RESUME_",
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    enabled: bool = False
+    idle_timeout: float = 15.0
+    ttl: float = 60.0
+    max_streams: int = 1000
+    max_lines: int = 5000
 
-class _PromptflowSettings(BaseSettings):
+
+class _BatchSettings(_DotEnvSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="BATCH_",
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    max_requests: int = 1000
+    concurrency: int = 4
+    max_concurrent_requests: int = 0
+
+
+class _RequestCaptureSettings(_DotEnvSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="REQUEST_CAPTURE_",
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    enabled: bool = False
+    directory: str = "request_captures"
+    sample_rate: float = 1.0
+    redact_content: bool = True
+    max_file_mb: float = 50.0
+    max_files: int = 20
+    flush_interval: float = 5.0
+
+
+class _TokenCacheSettings(_DotEnvSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="AZURE_TOKEN_CACHE_",
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    enabled: bool = True
+    directory: Optional[str] = None
+    refresh_margin: int = 600
+
+
+class _SharedCacheSettings(_DotEnvSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="SHARED_CACHE_",
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    # SQLite database of the cache tier shared by the workers, not shared when unset
+    path: Optional[str] = None
+    max_entries: int = 100000
+
+
+class _PromptflowSettings(_DotEnvSettings):
     model_config = SettingsConfigDict(
         env_prefix="PROMPTFLOW_",
-        env_file=DOTENV_PATH,
         extra="ignore",
         env_ignore_empty=True
     )
@@ -93,10 +212,9 @@ class _AzureOpenAITool(BaseModel):
     function: _AzureOpenAIFunction
     
 
-class _AzureOpenAISettings(BaseSettings):
+class _AzureOpenAISettings(_DotEnvSettings):
     model_config = SettingsConfigDict(
         env_prefix="AZURE_OPENAI_",
-        env_file=DOTENV_PATH,
         extra='ignore',
         env_ignore_empty=True
     )
@@ -109,6 +227,7 @@ class _AzureOpenAISettings(BaseSettings):
     top_p: float = 0
     max_tokens: int = 1000
     stream: bool = True
+    stream_include_usage: bool = False
     stop_sequence: Optional[List[str]] = None
     seed: Optional[int] = None
     choices_count: Optional[conint(ge=1, le=128)] = Field(default=1, serialization_alias="n")
@@ -202,10 +321,9 @@ class _AzureOpenAISettings(BaseSettings):
             return None
     
 
-class _SearchCommonSettings(BaseSettings):
+class _SearchCommonSettings(_DotEnvSettings):
     model_config = SettingsConfigDict(
         env_prefix="SEARCH_",
-        env_file=DOTENV_PATH,
         extra="ignore",
         env_ignore_empty=True
     )
@@ -233,6 +351,14 @@ class DatasourcePayloadConstructor(BaseModel, ABC):
     def __init__(self, settings: '_AppSettings', **data):
         super().__init__(**data)
         self._settings = settings
+
+    async def get_request_filter(self, request_headers) -> Optional[str]:
+        """Return the per-user filter to add to the data source parameters, if any."""
+        return None
+
+    async def warm_up(self):
+        """Connect to the services the app itself calls for this data source, before the first request."""
+        pass
     
     @abstractmethod
     def construct_payload_configuration(
@@ -243,10 +369,9 @@ class DatasourcePayloadConstructor(BaseModel, ABC):
         pass
 
 
-class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
+class _AzureSearchSettings(_DotEnvSettings, DatasourcePayloadConstructor):
     model_config = SettingsConfigDict(
         env_prefix="AZURE_SEARCH_",
-        env_file=DOTENV_PATH,
         extra="ignore",
         env_ignore_empty=True
     )
@@ -275,13 +400,19 @@ class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
         'vectorSemanticHybrid'
     ] = "simple"
     permitted_groups_column: Optional[str] = Field(default=None, exclude=True)
+    permitted_groups_cache_ttl: int = Field(default=300, exclude=True)
+    permitted_groups_refresh_interval: int = Field(default=600, exclude=True)
+    permitted_groups_max_filter_groups: int = Field(default=1000, exclude=True)
+    permitted_groups_overflow: Literal["truncate", "send_all", "reject"] = Field(default="truncate", exclude=True)
     
     # Constructed fields
     endpoint: Optional[str] = None
     authentication: Optional[dict] = None
     embedding_dependency: Optional[dict] = None
     fields_mapping: Optional[dict] = None
-    filter: Optional[str] = Field(default=None, exclude=True)
+    _group_cache: Optional[UserGroupCache] = PrivateAttr(default=None)
+    _indexed_groups: Optional[IndexedGroups] = PrivateAttr(default=None)
+    _http_client: Optional[httpx.AsyncClient] = PrivateAttr(default=None)
     
     @field_validator('content_columns', 'vector_columns', mode="before")
     @classmethod
@@ -316,38 +447,65 @@ class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
         }
         return self
     
+    @model_validator(mode="after")
+    def set_permitted_groups(self) -> Self:
+        if self.permitted_groups_column:
+            ## shared by the Graph and Search requests so they reuse their connections
+            self._http_client = httpx.AsyncClient(timeout=30)
+            self._group_cache = UserGroupCache(ttl=self.permitted_groups_cache_ttl)
+            self._indexed_groups = IndexedGroups(
+                endpoint=self.endpoint,
+                index=self.index,
+                column=self.permitted_groups_column,
+                key=self.key,
+                refresh_interval=self.permitted_groups_refresh_interval,
+                http_client=self._http_client,
+            )
+        return self
+
     @model_validator(mode="after")
     def set_query_type(self) -> Self:
         self.query_type = to_snake(self.query_type)
 
-    def _set_filter_string(self, request: Request) -> str:
+    async def get_request_filter(self, request_headers) -> Optional[str]:
         if self.permitted_groups_column:
-            user_token = request.headers.get("X-MS-TOKEN-AAD-ACCESS-TOKEN", "")
+            user_token = request_headers.get("X-MS-TOKEN-AAD-ACCESS-TOKEN", "")
             logging.debug(f"USER TOKEN is {'present' if user_token else 'not present'}")
             if not user_token:
                 raise ValueError(
                     "Document-level access control is enabled, but user access token could not be fetched."
                 )
 
-            filter_string = generateFilterString(user_token)
+            user_groups = await get_user_groups(user_token, self._group_cache, self._http_client)
+            filter_string = user_groups.filter(
+                self.permitted_groups_column,
+                await self._indexed_groups.get(),
+                self.permitted_groups_max_filter_groups,
+                self.permitted_groups_overflow
+            )
             logging.debug(f"FILTER: {filter_string}")
             return filter_string
         
         return None
+
+    async def warm_up(self):
+        if self.permitted_groups_column:
+            ## the first requests would wait for the groups of the index and a connection to Graph
+            await asyncio.gather(self._indexed_groups.get(), warm_up_graph(self._http_client))
             
     def construct_payload_configuration(
         self,
         *args,
         **kwargs
     ):
-        request = kwargs.pop('request', None)
-        if request and self.permitted_groups_column:
-            self.filter = self._set_filter_string(request)
+        filter_string = kwargs.pop('filter_string', None)
             
         self.embedding_dependency = \
             self._settings.azure_openai.extract_embedding_dependency()
         parameters = self.model_dump(exclude_none=True, by_alias=True)
         parameters.update(self._settings.search.model_dump(exclude_none=True, by_alias=True))
+        if filter_string:
+            parameters["filter"] = filter_string
         
         return {
             "type": self._type,
@@ -356,12 +514,11 @@ class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
 
 
 class _AzureCosmosDbMongoVcoreSettings(
-    BaseSettings,
+    _DotEnvSettings,
     DatasourcePayloadConstructor
 ):
     model_config = SettingsConfigDict(
         env_prefix="AZURE_COSMOSDB_MONGO_VCORE_",
-        env_file=DOTENV_PATH,
         extra="ignore",
         env_ignore_empty=True
     )
@@ -427,10 +584,9 @@ class _AzureCosmosDbMongoVcoreSettings(
         }
 
 
-class _ElasticsearchSettings(BaseSettings, DatasourcePayloadConstructor):
+class _ElasticsearchSettings(_DotEnvSettings, DatasourcePayloadConstructor):
     model_config = SettingsConfigDict(
         env_prefix="ELASTICSEARCH_",
-        env_file=DOTENV_PATH,
         extra="ignore",
         env_ignore_empty=True
     )
@@ -500,10 +656,9 @@ class _ElasticsearchSettings(BaseSettings, DatasourcePayloadConstructor):
         }
 
 
-class _PineconeSettings(BaseSettings, DatasourcePayloadConstructor):
+class _PineconeSettings(_DotEnvSettings, DatasourcePayloadConstructor):
     model_config = SettingsConfigDict(
         env_prefix="PINECONE_",
-        env_file=DOTENV_PATH,
         extra="ignore",
         env_ignore_empty=True
     )
@@ -570,10 +725,9 @@ class _PineconeSettings(BaseSettings, DatasourcePayloadConstructor):
         }
 
 
-class _AzureMLIndexSettings(BaseSettings, DatasourcePayloadConstructor):
+class _AzureMLIndexSettings(_DotEnvSettings, DatasourcePayloadConstructor):
     model_config = SettingsConfigDict(
         env_prefix="AZURE_MLINDEX_",
-        env_file=DOTENV_PATH,
         extra="ignore",
         env_ignore_empty=True
     )
@@ -626,10 +780,9 @@ class _AzureMLIndexSettings(BaseSettings, DatasourcePayloadConstructor):
         }
 
 
-class _AzureSqlServerSettings(BaseSettings, DatasourcePayloadConstructor):
+class _AzureSqlServerSettings(_DotEnvSettings, DatasourcePayloadConstructor):
     model_config = SettingsConfigDict(
         env_prefix="AZURE_SQL_SERVER_",
-        env_file=DOTENV_PATH,
         extra="ignore",
         env_ignore_empty=True
     )
@@ -673,10 +826,9 @@ class _AzureSqlServerSettings(BaseSettings, DatasourcePayloadConstructor):
         }
     
 
-class _MongoDbSettings(BaseSettings, DatasourcePayloadConstructor):
+class _MongoDbSettings(_DotEnvSettings, DatasourcePayloadConstructor):
     model_config = SettingsConfigDict(
         env_prefix="MONGODB_",
-        env_file=DOTENV_PATH,
         extra="ignore",
         env_ignore_empty=True
     )
@@ -750,9 +902,8 @@ class _MongoDbSettings(BaseSettings, DatasourcePayloadConstructor):
         }
         
         
-class _BaseSettings(BaseSettings):
+class _BaseSettings(_DotEnvSettings):
     model_config = SettingsConfigDict(
-        env_file=DOTENV_PATH,
         extra="ignore",
         arbitrary_types_allowed=True,
         env_ignore_empty=True
@@ -761,6 +912,11 @@ class _BaseSettings(BaseSettings):
     auth_enabled: bool = True
     sanitize_answer: bool = False
     use_promptflow: bool = False
+    metrics_enabled: bool = False
+    max_concurrent_chat_requests: int = 0
+    admin_api_key: Optional[str] = None
+    event_loop_block_threshold: float = 0.5
+    warmup_timeout: float = 10
 
 
 class _AppSettings(BaseModel):
@@ -768,7 +924,14 @@ class _AppSettings(BaseModel):
     azure_openai: _AzureOpenAISettings = _AzureOpenAISettings()
     search: _SearchCommonSettings = _SearchCommonSettings()
     ui: Optional[_UiSettings] = _UiSettings()
-    
+    chat_history_store: _ChatHistoryStoreSettings = _ChatHistoryStoreSettings()
+    usage_metering: _UsageMeteringSettings = _UsageMeteringSettings()
+    stream_resume: _StreamResumeSettings = _StreamResumeSettings()
+    batch: _BatchSettings = _BatchSettings()
+    request_capture: _RequestCaptureSettings = _RequestCaptureSettings()
+    token_cache: _TokenCacheSettings = _TokenCacheSettings()
+    shared_cache: _SharedCacheSettings = _SharedCacheSettings()
+
     # Constructed properties
     chat_history: Optional[_ChatHistorySettings] = None
     datasource: Optional[DatasourcePayloadConstructor] = None
@@ -798,31 +961,31 @@ class _AppSettings(BaseModel):
     def set_datasource_settings(self) -> Self:
         try:
             if self.base_settings.datasource_type == "AzureCognitiveSearch":
-                self.datasource = _AzureSearchSettings(settings=self, _env_file=DOTENV_PATH)
+                self.datasource = _AzureSearchSettings(settings=self)
                 logging.debug("Using Azure Cognitive Search")
             
             elif self.base_settings.datasource_type == "AzureCosmosDB":
-                self.datasource = _AzureCosmosDbMongoVcoreSettings(settings=self, _env_file=DOTENV_PATH)
+                self.datasource = _AzureCosmosDbMongoVcoreSettings(settings=self)
                 logging.debug("Using Azure CosmosDB Mongo vcore")
             
             elif self.base_settings.datasource_type == "Elasticsearch":
-                self.datasource = _ElasticsearchSettings(settings=self, _env_file=DOTENV_PATH)
+                self.datasource = _ElasticsearchSettings(settings=self)
                 logging.debug("Using Elasticsearch")
             
             elif self.base_settings.datasource_type == "Pinecone":
-                self.datasource = _PineconeSettings(settings=self, _env_file=DOTENV_PATH)
+                self.datasource = _PineconeSettings(settings=self)
                 logging.debug("Using Pinecone")
             
             elif self.base_settings.datasource_type == "AzureMLIndex":
-                self.datasource = _AzureMLIndexSettings(settings=self, _env_file=DOTENV_PATH)
+                self.datasource = _AzureMLIndexSettings(settings=self)
                 logging.debug("Using Azure ML Index")
             
             elif self.base_settings.datasource_type == "AzureSqlServer":
-                self.datasource = _AzureSqlServerSettings(settings=self, _env_file=DOTENV_PATH)
+                self.datasource = _AzureSqlServerSettings(settings=self)
                 logging.debug("Using SQL Server")
             
             elif self.base_settings.datasource_type == "MongoDB":
-                self.datasource = _MongoDbSettings(settings=self, _env_file=DOTENV_PATH)
+                self.datasource = _MongoDbSettings(settings=self)
                 logging.debug("Using Mongo DB")
                 
             else:
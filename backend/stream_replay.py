@@ -0,0 +1,174 @@
+"""
+Server-side replay buffers making streamed answers resumable.
+
+The answer is generated by a background task writing each NDJSON line to a
+``ReplayBuffer`` and the response only reads from the buffer. A client whose
+connection dropped can read it again from the last line it received, then
+follow the live tail while the answer is still being generated. Buffers are
+kept per worker process, so resuming requires session affinity.
+"""
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict, deque
+
+DEFAULT_MAX_STREAMS = 1000
+DEFAULT_MAX_LINES = 5000
+DEFAULT_TTL = 60
+DEFAULT_IDLE_TIMEOUT = 15
+
+
+class StreamOffsetExpiredError(Exception):
+    pass
+
+
+class ReplayBuffer():
+    """The NDJSON lines of one streamed answer, the last ``max_lines`` of them.
+
+    Offsets count lines from the start of the answer. When nobody has been
+    reading for ``idle_timeout`` seconds since the first line the generation
+    is cancelled, like it would be without replay when the client disconnects.
+    """
+
+    def __init__(self, stream_id: str, user_id: str, max_lines: int, idle_timeout: float):
+        self.stream_id = stream_id
+        self.user_id = user_id
+        self.idle_timeout = idle_timeout
+        self.lines = deque(maxlen=max_lines)
+        self.first_offset = 0
+        self.done = False
+        self.finished_at = None
+        self.readers = 0
+        self._appended = asyncio.Event()
+        self._task = None
+        self._idle_handle = None
+
+    @property
+    def end_offset(self) -> int:
+        return self.first_offset + len(self.lines)
+
+    def append(self, line: str):
+        if len(self.lines) == self.lines.maxlen:
+            self.first_offset += 1
+        self.lines.append(line)
+        if self.readers == 0:
+            # cancel the generation if no reader shows up, once there is something to read
+            self._start_idle_timer()
+        self._wake()
+
+    def finish(self):
+        self.done = True
+        self.finished_at = time.monotonic()
+        self._cancel_idle_timer()
+        self._wake()
+
+    def _wake(self):
+        ## readers wait on the current event, a new one is armed for the next line
+        appended, self._appended = self._appended, asyncio.Event()
+        appended.set()
+
+    async def _produce(self, source):
+        try:
+            async for line in source:
+                self.append(line)
+        finally:
+            self.finish()
+
+    def start(self, source):
+        self._task = asyncio.ensure_future(self._produce(source))
+        self._task.add_done_callback(self._produced)
+
+    def _produced(self, task):
+        ## _produce finishes the buffer, unless its task was cancelled before it ran
+        if not self.done:
+            self.finish()
+
+    def cancel(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    def _start_idle_timer(self):
+        if not self.done and self._idle_handle is None:
+            self._idle_handle = asyncio.get_running_loop().call_later(self.idle_timeout, self._on_idle)
+
+    def _cancel_idle_timer(self):
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+
+    def _on_idle(self):
+        self._idle_handle = None
+        if self.readers == 0 and not self.done:
+            logging.debug(f"Nobody read stream {self.stream_id} for {self.idle_timeout}s, cancelling it")
+            self.cancel()
+
+    async def read(self, offset: int = 0):
+        """Yield the lines from ``offset`` on, then the new ones until the answer is complete."""
+        if offset < self.first_offset:
+            raise StreamOffsetExpiredError(f"Offset {offset} of stream {self.stream_id} is no longer buffered")
+
+        self.readers += 1
+        self._cancel_idle_timer()
+        try:
+            while True:
+                appended = self._appended
+                while offset < self.end_offset:
+                    if offset < self.first_offset:
+                        ## this reader fell further behind than the buffer holds
+                        raise StreamOffsetExpiredError(f"Offset {offset} of stream {self.stream_id} is no longer buffered")
+                    yield self.lines[offset - self.first_offset]
+                    offset += 1
+                if self.done:
+                    return
+                await appended.wait()
+        finally:
+            self.readers -= 1
+            if self.readers == 0:
+                self._start_idle_timer()
+
+
+class ReplayBufferStore():
+    """Replay buffers by stream id, kept ``ttl`` seconds after their answer completed."""
+
+    def __init__(
+        self,
+        max_streams: int = DEFAULT_MAX_STREAMS,
+        max_lines: int = DEFAULT_MAX_LINES,
+        ttl: float = DEFAULT_TTL,
+        idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+    ):
+        self.max_streams = max_streams
+        self.max_lines = max_lines
+        self.ttl = ttl
+        self.idle_timeout = idle_timeout
+        self._buffers = OrderedDict()
+
+    def _expire(self):
+        now = time.monotonic()
+        for stream_id, buffer in list(self._buffers.items()):
+            if buffer.done and now - buffer.finished_at > self.ttl:
+                del self._buffers[stream_id]
+
+        while len(self._buffers) >= self.max_streams:
+            stream_id, buffer = self._buffers.popitem(last=False)
+            if not buffer.done:
+                logging.warning(f"More than {self.max_streams} streams are buffered, cancelling stream {stream_id}")
+                buffer.cancel()
+
+    def start(self, user_id: str, source) -> ReplayBuffer:
+        """Generate ``source`` (an async iterator of lines) into a new buffer in the background."""
+        self._expire()
+        buffer = ReplayBuffer(str(uuid.uuid4()), user_id, self.max_lines, self.idle_timeout)
+        self._buffers[buffer.stream_id] = buffer
+        buffer.start(source)
+        return buffer
+
+    def get(self, stream_id: str):
+        self._expire()
+        return self._buffers.get(stream_id)
+
+    def close(self):
+        for buffer in self._buffers.values():
+            buffer.cancel()
+        self._buffers.clear()
@@ -0,0 +1,231 @@
+"""
+Entra ID tokens shared by the workers of a host.
+
+Every gunicorn worker has its own ``DefaultAzureCredential`` and would
+request its own token for each scope, at startup and whenever the token
+expires. ``SharedTokenCredential`` wraps the credential and keeps each
+token in a file of a private directory: the first worker that needs a
+token requests it while holding a ``flock`` on the scope's lock file and
+writes it, the other workers wait for the lock and read it. The files are
+keyed by the identity of the credential too, so another app or identity of
+the same user never gets these tokens. A token is
+refreshed ``refresh_margin`` seconds before it expires, in the background
+while it is still valid, so requests don't wait for Entra ID.
+
+Without ``fcntl`` (Windows) or a private directory the tokens are only
+cached in the process.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from backend.metrics import registry
+
+DEFAULT_DIRECTORY = os.path.join(tempfile.gettempdir(), "azure-token-cache")
+## the environment variables selecting the identity of DefaultAzureCredential
+IDENTITY_VARIABLES = ("AZURE_CLIENT_ID", "AZURE_TENANT_ID", "AZURE_USERNAME", "AZURE_CLIENT_CERTIFICATE_PATH", "AZURE_FEDERATED_TOKEN_FILE")
+## the app these tokens belong to
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_REFRESH_MARGIN = 600
+DEFAULT_LOCK_TIMEOUT = 30
+## a token this close to expiring is refreshed before it is returned
+MIN_VALIDITY = 30
+## wait this long before trying again after a background refresh failed
+RETRY_INTERVAL = 30
+
+token_requests = registry.counter(
+    "azure_token_requests_total",
+    "Entra ID tokens the worker needed, by where it got them: the worker's memory, the file shared with the other workers or Entra ID",
+    ("source",),
+)
+
+
+def default_identity() -> str:
+    """The app and the identity its ``DefaultAzureCredential`` signs in as, from the environment."""
+    return json.dumps([APP_ROOT] + [os.environ.get(name) for name in IDENTITY_VARIABLES])
+
+
+def _private_directory(directory):
+    """``directory``, created if needed, or None if other users could read or write it."""
+    if fcntl is None:
+        return None
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        status = os.stat(directory)
+    except OSError as e:
+        logging.warning(f"Not sharing Entra ID tokens between workers, {directory} is not usable: {e}")
+        return None
+    if status.st_uid != os.getuid() or status.st_mode & 0o077:
+        logging.warning(f"Not sharing Entra ID tokens between workers, {directory} is not private to this user")
+        return None
+    return directory
+
+
+def _lock(path, timeout):
+    """Open and lock ``path``, returning the open file, or None if the lock wasn't granted in ``timeout`` seconds."""
+    file = open(path, "a")
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return file
+        except BlockingIOError:
+            if time.monotonic() > deadline:
+                file.close()
+                return None
+            time.sleep(0.05)
+
+
+def _read(path):
+    try:
+        with open(path, "r") as file:
+            entry = json.load(file)
+        return entry["token"], entry["expires_on"], entry["refresh_at"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _write(path, token, expires_on, refresh_at):
+    temporary = f"{path}.{os.getpid()}"
+    descriptor = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, "w") as file:
+        json.dump({"token": token, "expires_on": expires_on, "refresh_at": refresh_at}, file)
+    os.replace(temporary, path)
+
+
+class SharedTokenCredential():
+    """An async credential returning the tokens of ``credential``, shared through the files of ``directory``.
+
+    Only credentials of the same ``identity`` (``default_identity()`` if not
+    given) share tokens.
+    """
+
+    def __init__(self, credential, directory=DEFAULT_DIRECTORY, refresh_margin=DEFAULT_REFRESH_MARGIN, lock_timeout=DEFAULT_LOCK_TIMEOUT, identity=None):
+        self.credential = credential
+        self.identity = identity if identity is not None else default_identity()
+        self.directory = _private_directory(directory) if directory else None
+        self.refresh_margin = refresh_margin
+        self.lock_timeout = lock_timeout
+        ## key -> (AccessToken, time to refresh it at)
+        self._tokens = {}
+        self._refreshing = {}
+
+    def _key(self, scopes, tenant_id, kwargs) -> str:
+        return json.dumps([self.identity, sorted(scopes), tenant_id, sorted(kwargs.items())], default=str)
+
+    def _refresh_at(self, expires_on, now):
+        ## short lived tokens are refreshed halfway through their lifetime instead
+        return expires_on - min(self.refresh_margin, (expires_on - now) / 2)
+
+    async def get_token(self, *scopes, claims=None, tenant_id=None, **kwargs):
+        if claims:
+            ## a claims challenge asks for a new token
+            return await self.credential.get_token(*scopes, claims=claims, tenant_id=tenant_id, **kwargs)
+
+        key = self._key(scopes, tenant_id, kwargs)
+        cached = self._tokens.get(key)
+        now = time.time()
+        if cached is not None:
+            token, refresh_at = cached
+            if now < refresh_at:
+                token_requests.inc(source="memory")
+                return token
+            if token.expires_on - now > MIN_VALIDITY:
+                token_requests.inc(source="memory")
+                self._refresh(key, scopes, tenant_id, kwargs)
+                return token
+        return await asyncio.shield(self._refresh(key, scopes, tenant_id, kwargs))
+
+    def _refresh(self, key, scopes, tenant_id, kwargs):
+        ## one refresh per token at a time, awaited by the requests that can't use the current one
+        task = self._refreshing.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._acquire(key, scopes, tenant_id, kwargs))
+            self._refreshing[key] = task
+            task.add_done_callback(lambda task: self._refreshed(key, task))
+        return task
+
+    def _refreshed(self, key, task):
+        del self._refreshing[key]
+        if not task.cancelled() and task.exception() is not None:
+            cached = self._tokens.get(key)
+            if cached is not None:
+                logging.warning(f"Could not refresh an Entra ID token, using the current one: {task.exception()}")
+                self._tokens[key] = (cached[0], time.time() + RETRY_INTERVAL)
+
+    async def _from_credential(self, scopes, tenant_id, kwargs):
+        token = await self.credential.get_token(*scopes, tenant_id=tenant_id, **kwargs)
+        token_requests.inc(source="credential")
+        return token, self._refresh_at(token.expires_on, time.time())
+
+    async def _acquire(self, key, scopes, tenant_id, kwargs):
+        from azure.core.credentials import AccessToken
+
+        if self.directory is None:
+            token, refresh_at = await self._from_credential(scopes, tenant_id, kwargs)
+        else:
+            path = os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest()[:32])
+            lock = await asyncio.to_thread(_lock, path + ".lock", self.lock_timeout)
+            try:
+                entry = await asyncio.to_thread(_read, path + ".json")
+                if entry is not None and time.time() < entry[2]:
+                    ## another worker refreshed it
+                    token, refresh_at = AccessToken(entry[0], entry[1]), entry[2]
+                    token_requests.inc(source="shared")
+                else:
+                    token, refresh_at = await self._from_credential(scopes, tenant_id, kwargs)
+                    await asyncio.to_thread(_write, path + ".json", token.token, token.expires_on, refresh_at)
+            finally:
+                if lock is not None:
+                    lock.close()
+
+        self._tokens[key] = (token, refresh_at)
+        return token
+
+    async def close(self):
+        for task in list(self._refreshing.values()):
+            task.cancel()
+        await self.credential.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+_default_credential = None
+
+
+def default_credential():
+    """The worker's ``DefaultAzureCredential``, sharing its tokens with the other workers unless disabled in the settings."""
+    global _default_credential
+    if _default_credential is None:
+        from azure.identity.aio import DefaultAzureCredential
+        from backend.settings import app_settings
+
+        credential = DefaultAzureCredential()
+        if app_settings.token_cache.enabled:
+            credential = SharedTokenCredential(
+                credential,
+                app_settings.token_cache.directory or DEFAULT_DIRECTORY,
+                app_settings.token_cache.refresh_margin,
+            )
+        _default_credential = credential
+    return _default_credential
+
+
+async def close_default_credential():
+    global _default_credential
+    if _default_credential is not None:
+        await _default_credential.close()
+        _default_credential = None
@@ -0,0 +1,132 @@
+"""
+Per-user and per-conversation token usage metering.
+
+Every Azure OpenAI call of a request reports its usage to a
+``UsageAccumulator``, which adds it to small in-memory counters keyed by
+user, conversation and UTC day. The counters are periodically written to
+the chat history store in one batch, so metering adds no store round trip
+to the requests themselves.
+"""
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+DEFAULT_FLUSH_INTERVAL = 60
+
+# prompt, cached prompt and completion tokens, and the number of calls
+_PROMPT, _CACHED, _COMPLETION, _REQUESTS = range(4)
+
+
+def usage_counts(usage):
+    """Return ``(prompt, cached, completion)`` tokens of an OpenAI usage object or dict."""
+    if isinstance(usage, dict):
+        details = usage.get("prompt_tokens_details") or {}
+        return (
+            usage.get("prompt_tokens") or 0,
+            details.get("cached_tokens") or 0,
+            usage.get("completion_tokens") or 0,
+        )
+
+    details = getattr(usage, "prompt_tokens_details", None)
+    return (
+        usage.prompt_tokens or 0,
+        (details.cached_tokens or 0) if details else 0,
+        usage.completion_tokens or 0,
+    )
+
+
+class UsageAccumulator():
+    """Token counts waiting to be written to the history store.
+
+    ``record`` only updates a dict entry and is safe to call on every
+    request. Counts are per worker process until flushed; a failed flush
+    keeps them for the next attempt.
+    """
+
+    def __init__(self, flush_interval: float = DEFAULT_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._store = None
+        self._flush_task = None
+        self._closing = None
+
+    def record(self, user_id, conversation_id, usage):
+        if usage is None or not user_id:
+            return
+
+        prompt, cached, completion = usage_counts(usage)
+        day = datetime.now(timezone.utc).date().isoformat()
+        counts = self._pending.get((user_id, conversation_id, day))
+        if counts is None:
+            counts = self._pending[(user_id, conversation_id, day)] = [0, 0, 0, 0]
+        counts[_PROMPT] += prompt
+        counts[_CACHED] += cached
+        counts[_COMPLETION] += completion
+        counts[_REQUESTS] += 1
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def drain(self) -> list:
+        """Return the pending counts as store records and start over."""
+        pending, self._pending = self._pending, {}
+        return [
+            {
+                "userId": user_id,
+                "conversationId": conversation_id,
+                "day": day,
+                "promptTokens": counts[_PROMPT],
+                "cachedTokens": counts[_CACHED],
+                "completionTokens": counts[_COMPLETION],
+                "requests": counts[_REQUESTS],
+            }
+            for (user_id, conversation_id, day), counts in pending.items()
+        ]
+
+    def _restore(self, records):
+        for record in records:
+            key = (record["userId"], record["conversationId"], record["day"])
+            counts = self._pending.setdefault(key, [0, 0, 0, 0])
+            counts[_PROMPT] += record["promptTokens"]
+            counts[_CACHED] += record["cachedTokens"]
+            counts[_COMPLETION] += record["completionTokens"]
+            counts[_REQUESTS] += record["requests"]
+
+    async def flush(self, store=None):
+        store = store or self._store
+        if store is None or not self._pending:
+            return
+        records = self.drain()
+        try:
+            failed = await store.add_usage(records)
+        except Exception:
+            logging.exception(f"Failed to write the token usage of {len(records)} users and conversations, retrying later")
+            self._restore(records)
+            return
+        ## only the records that were not written, the others would be counted twice
+        if failed:
+            logging.warning(f"Failed to write the token usage of {len(failed)} users and conversations, retrying later")
+            self._restore(failed)
+
+    async def _flush_periodically(self):
+        ## a flush in progress is never cancelled, a partially written batch would be counted twice
+        while not self._closing.is_set():
+            try:
+                await asyncio.wait_for(self._closing.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                await self.flush()
+
+    def start(self, store):
+        """Flush to ``store`` every ``flush_interval`` seconds until ``close``."""
+        self._store = store
+        if self._flush_task is None:
+            self._closing = asyncio.Event()
+            self._flush_task = asyncio.ensure_future(self._flush_periodically())
+
+    async def close(self):
+        """Stop the periodic flush and write what is still pending."""
+        if self._flush_task is not None:
+            self._closing.set()
+            await self._flush_task
+            self._flush_task = None
+        await self.flush()
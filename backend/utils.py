@@ -1,19 +1,17 @@
 import os
 import json
 import logging
-import requests
 import dataclasses
 
+from contextlib import aclosing
 from typing import List
 
+from backend.usage import usage_counts
+
 DEBUG = os.environ.get("DEBUG", "false")
 if DEBUG.lower() == "true":
     logging.basicConfig(level=logging.DEBUG)
 
-AZURE_SEARCH_PERMITTED_GROUPS_COLUMN = os.environ.get(
-    "AZURE_SEARCH_PERMITTED_GROUPS_COLUMN"
-)
-
 
 class JSONEncoder(json.JSONEncoder):
     def default(self, o):
@@ -23,12 +21,14 @@ class JSONEncoder(json.JSONEncoder):
 
 
 async def format_as_ndjson(r):
-    try:
-        async for event in r:
-            yield json.dumps(event, cls=JSONEncoder) + "\n"
-    except Exception as error:
-        logging.exception("Exception while generating response stream: %s", error)
-        yield json.dumps({"error": str(error)})
+    ## closes r along with this generator, e.g. when the client disconnects
+    async with aclosing(r):
+        try:
+            async for event in r:
+                yield json.dumps(event, cls=JSONEncoder) + "\n"
+        except Exception as error:
+            logging.exception("Exception while generating response stream: %s", error)
+            yield json.dumps({"error": str(error)})
 
 
 def parse_multi_columns(columns: str) -> list:
@@ -38,41 +38,26 @@ def parse_multi_columns(columns: str) -> list:
         return columns.split(",")
 
 
-def fetchUserGroups(userToken, nextLink=None):
-    # Recursively fetch group membership
-    if nextLink:
-        endpoint = nextLink
-    else:
-        endpoint = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
-
-    headers = {"Authorization": "bearer " + userToken}
-    try:
-        r = requests.get(endpoint, headers=headers)
-        if r.status_code != 200:
-            logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
-            return []
-
-        r = r.json()
-        if "@odata.nextLink" in r:
-            nextLinkData = fetchUserGroups(userToken, r["@odata.nextLink"])
-            r["value"].extend(nextLinkData)
-
-        return r["value"]
-    except Exception as e:
-        logging.error(f"Exception in fetchUserGroups: {e}")
-        return []
-
+class AssembledAnswer():
+    """The assistant and tool (citations) messages of an answer, put together from its response objects."""
 
-def generateFilterString(userToken):
-    # Get list of groups user is a member of
-    userGroups = fetchUserGroups(userToken)
+    def __init__(self):
+        self.message_id = None
+        self.tool_message = None
+        self.content_parts = []
 
-    # Construct filter string
-    if not userGroups:
-        logging.debug("No user groups found")
+    def add(self, response_obj):
+        for message in response_obj.get("choices", [{}])[0].get("messages", []):
+            if message.get("role") == "tool" and "content" in message:
+                self.tool_message = {"role": "tool", "content": message["content"]}
+            elif message.get("role") == "assistant" and message.get("content"):
+                ## the client knows the answer by the id of the completion that produced its content
+                self.message_id = response_obj["id"]
+                self.content_parts.append(message["content"])
 
-    group_ids = ", ".join([obj["id"] for obj in userGroups])
-    return f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, '{group_ids}'))"
+    @property
+    def assistant_message(self):
+        return {"id": self.message_id, "role": "assistant", "content": "".join(self.content_parts)}
 
 
 def format_non_streaming_response(chatCompletion, history_metadata, apim_request_id):
@@ -86,6 +71,15 @@ def format_non_streaming_response(chatCompletion, history_metadata, apim_request
         "apim-request-id": apim_request_id,
     }
 
+    usage = getattr(chatCompletion, "usage", None)
+    if usage is not None:
+        prompt_tokens, cached_tokens, completion_tokens = usage_counts(usage)
+        response_obj["usage"] = {
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "completion_tokens": completion_tokens,
+        }
+
     if len(chatCompletion.choices) > 0:
         message = chatCompletion.choices[0].message
         if message:
@@ -0,0 +1,76 @@
+"""
+Warm-up of a worker's connections to its dependencies.
+
+A new worker, and every worker gunicorn replaces after ``max_requests``,
+would otherwise make its first requests pay for the Entra ID token, DNS
+and TLS handshake of each dependency. ``Warmup`` runs one step per
+configured dependency, concurrently and each within ``timeout`` seconds,
+from ``before_serving``: the worker only starts accepting connections once
+it is done. A failed or slow step is logged and left to the first request
+that needs the dependency, it doesn't keep the worker from serving.
+"""
+import asyncio
+import logging
+import time
+
+from backend.metrics import registry
+
+DEFAULT_TIMEOUT = 10
+
+warmup_duration = registry.gauge(
+    "worker_warmup_seconds",
+    "How long the worker took to warm up the connection to each dependency when it started",
+    ("dependency",),
+)
+
+
+class Warmup():
+    """Steps warming up the dependencies, by name, and their results once ``run``."""
+
+    def __init__(self, timeout: float = DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self.steps = {}
+        self.results = {}
+        self.done = False
+
+    def add(self, dependency: str, step):
+        """Warm up ``dependency`` with ``await step()``."""
+        self.steps[dependency] = step
+
+    async def _run_step(self, dependency, step):
+        started = time.monotonic()
+        error = None
+        try:
+            await asyncio.wait_for(step(), self.timeout)
+        except asyncio.TimeoutError:
+            error = f"timed out after {self.timeout}s"
+        except Exception as e:
+            error = str(e) or type(e).__name__
+        seconds = time.monotonic() - started
+
+        warmup_duration.set(seconds, dependency=dependency)
+        self.results[dependency] = {"ok": error is None, "seconds": seconds, "error": error}
+        if error is None:
+            logging.info(
+                f"Warmed up {dependency} in {seconds:.3f}s",
+                extra={"event": "warmup", "dependency": dependency, "seconds": seconds, "ok": True},
+            )
+        else:
+            logging.warning(
+                f"Could not warm up {dependency} in {seconds:.3f}s: {error}",
+                extra={"event": "warmup", "dependency": dependency, "seconds": seconds, "ok": False, "error": error},
+            )
+
+    async def run(self):
+        """Run every step concurrently and return their results."""
+        started = time.monotonic()
+        if self.timeout > 0:
+            await asyncio.gather(*(self._run_step(dependency, step) for dependency, step in self.steps.items()))
+        self.done = True
+        if self.steps:
+            seconds = time.monotonic() - started
+            logging.info(
+                f"Worker warmed up in {seconds:.3f}s",
+                extra={"event": "warmup", "seconds": seconds, "results": self.results},
+            )
+        return self.results
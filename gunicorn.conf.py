@@ -1,4 +1,5 @@
 import multiprocessing
+import os
 
 max_requests = 1000
 max_requests_jitter = 50
@@ -9,5 +10,10 @@ timeout = 230
 # https://learn.microsoft.com/en-us/troubleshoot/azure/app-service/web-apps-performance-faqs#why-does-my-request-time-out-after-230-seconds
 
 num_cpus = multiprocessing.cpu_count()
-workers = (num_cpus * 2) + 1
+# WEB_CONCURRENCY overrides the worker count, e.g. with the value tools/load_test.py found best
+workers = int(os.environ.get("WEB_CONCURRENCY", (num_cpus * 2) + 1))
 worker_class = "uvicorn.workers.UvicornWorker"
+
+# GUNICORN_PRELOAD_APP=true imports the app once in the master and forks the workers from it, so the
+# workers replaced every max_requests start without importing it again; a reload then keeps the old code
+preload_app = os.environ.get("GUNICORN_PRELOAD_APP", "false").lower() == "true"
@@ -0,0 +1,164 @@
+import asyncio
+import json
+import os
+import random
+from importlib import import_module, reload
+
+import pytest
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+from werkzeug.datastructures import Headers
+
+WORDS = (
+    "the service answers questions about the documents in the index and cites the passages "
+    "it used so the reader can check every statement against its source"
+).split()
+
+AZURE_SEARCH_DOTENV = os.path.join(
+    os.path.dirname(__file__), "..", "unit_tests", "dotenv_data", "dotenv_with_azure_search_success"
+)
+
+
+def text(rng, size):
+    words = []
+    while sum(len(w) + 1 for w in words) < size:
+        words.append(rng.choice(WORDS))
+    return " ".join(words)
+
+
+def make_context(rng, citations=5, citation_bytes=1500):
+    return {
+        "citations": [
+            {
+                "content": text(rng, citation_bytes),
+                "title": f"Document {i}",
+                "url": f"https://example.com/documents/{i}.pdf",
+                "filepath": f"{i}.pdf",
+                "chunk_id": str(i),
+            }
+            for i in range(citations)
+        ],
+        "intent": json.dumps(["question about the documents"]),
+    }
+
+
+def chunk(delta, finish_reason=None):
+    return ChatCompletionChunk.model_validate({
+        "id": "chatcmpl-bench",
+        "object": "chat.completion.chunk",
+        "created": 1700000000,
+        "model": "gpt-4o",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    })
+
+
+@pytest.fixture(scope="session")
+def rng():
+    return random.Random(0)
+
+
+@pytest.fixture(scope="session")
+def long_conversation(rng):
+    """Request body of the 41st question of a conversation whose answers carry five 1.5 kB citations each."""
+    messages = []
+    for turn in range(40):
+        messages.append({"id": f"u{turn}", "role": "user", "content": text(rng, 200)})
+        messages.append({"id": f"t{turn}", "role": "tool", "content": json.dumps(make_context(rng))})
+        messages.append({
+            "id": f"a{turn}",
+            "role": "assistant",
+            "content": text(rng, 800),
+            "context": json.dumps(make_context(rng)),
+        })
+    messages.append({"id": "u40", "role": "user", "content": text(rng, 200)})
+    return {"messages": messages}
+
+
+@pytest.fixture(scope="session")
+def easy_auth_headers():
+    """Headers of a request signed in through App Service authentication."""
+    headers = Headers()
+    for i in range(20):
+        headers.add(f"X-Forwarded-Header-{i}", "x" * 40)
+    headers.add("Content-Type", "application/json")
+    headers.add("X-Ms-Client-Principal-Id", "00000000-0000-0000-0000-000000000000")
+    headers.add("X-Ms-Client-Principal-Name", "user@example.com")
+    headers.add("X-Ms-Client-Principal-Idp", "aad")
+    headers.add("X-Ms-Client-Principal", "e" * 1600)
+    headers.add("X-Ms-Token-Aad-Id-Token", "t" * 2400)
+    headers.add("X-Ms-Token-Aad-Access-Token", "t" * 2400)
+    return headers
+
+
+@pytest.fixture(scope="session")
+def stream_chunks(rng):
+    """Chunks of a streamed answer: the citations first, then 300 tokens of content."""
+    chunks = [chunk({"role": "assistant", "context": make_context(rng)})]
+    chunks.extend(chunk({"content": rng.choice(WORDS) + " "}) for _ in range(300))
+    chunks.append(chunk({}, "stop"))
+    return chunks
+
+
+@pytest.fixture(scope="session")
+def tool_call_chunks():
+    """Chunks of an answer calling 20 tools."""
+    chunks = []
+    for i in range(20):
+        chunks.append(chunk({"role": "assistant", "tool_calls": [{
+            "index": i,
+            "id": f"call_{i}",
+            "type": "function",
+            "function": {"name": "get_weather", "arguments": ""},
+        }]}))
+        chunks.append(chunk({"tool_calls": [{"index": i, "function": {"arguments": json.dumps({"city": f"City {i}"})}}]}))
+    chunks.append(chunk({}, "tool_calls"))
+    return chunks
+
+
+@pytest.fixture(scope="session")
+def chat_completion(rng):
+    """A complete answer with ten citations and usage."""
+    return ChatCompletion.model_validate({
+        "id": "chatcmpl-bench",
+        "object": "chat.completion",
+        "created": 1700000000,
+        "model": "gpt-4o",
+        "choices": [{
+            "index": 0,
+            "finish_reason": "stop",
+            "message": {"role": "assistant", "content": text(rng, 2000), "context": make_context(rng, citations=10)},
+        }],
+        "usage": {
+            "prompt_tokens": 12000,
+            "completion_tokens": 500,
+            "total_tokens": 12500,
+            "prompt_tokens_details": {"cached_tokens": 8000},
+        },
+    })
+
+
+@pytest.fixture(scope="session")
+def azure_search_settings():
+    previous = os.environ.get("DOTENV_PATH")
+    os.environ["DOTENV_PATH"] = AZURE_SEARCH_DOTENV
+    settings_module = reload(import_module("backend.settings"))
+    yield settings_module.app_settings
+    if previous is None:
+        os.environ.pop("DOTENV_PATH", None)
+    else:
+        os.environ["DOTENV_PATH"] = previous
+
+
+@pytest.fixture(scope="session")
+def app_module(azure_search_settings):
+    app = import_module("app")
+    previous = app.app_settings
+    app.app_settings = azure_search_settings
+    yield app
+    app.app_settings = previous
+
+
+@pytest.fixture
+def run_async():
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
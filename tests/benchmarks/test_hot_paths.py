@@ -0,0 +1,92 @@
+"""
+Microbenchmarks of the pure Python work done on every chat request.
+
+Run them on their own, comparing with the stored baseline of the same
+platform and failing when the fastest round of a benchmark got more than
+25% slower (the minimum is the least noisy statistic on a busy machine):
+
+    pytest tests/benchmarks --benchmark-storage=tests/benchmarks/baselines --benchmark-warmup=on --benchmark-compare --benchmark-compare-fail=min:25%
+
+Baselines are only comparable on the machine that recorded them; store a
+new one before starting performance work, and again once it is merged:
+
+    pytest tests/benchmarks --benchmark-storage=tests/benchmarks/baselines --benchmark-warmup=on --benchmark-save=baseline
+"""
+from backend.auth.auth_utils import get_authenticated_user_details
+from backend.utils import (
+    convert_to_pf_format,
+    format_as_ndjson,
+    format_non_streaming_response,
+    format_stream_response,
+)
+
+HISTORY_METADATA = {"conversation_id": "00000000-0000-0000-0000-000000000000", "title": "Benchmark"}
+
+
+def test_prepare_model_args_long_conversation(benchmark, app_module, long_conversation, easy_auth_headers, run_async):
+    model_args = benchmark(lambda: run_async(app_module.prepare_model_args(long_conversation, easy_auth_headers)))
+
+    assert len(model_args["messages"]) == len(long_conversation["messages"])
+    assert model_args["extra_body"]["data_sources"][0]["type"] == "azure_search"
+
+
+def test_format_stream_response_answer(benchmark, stream_chunks):
+    def format_all():
+        return [format_stream_response(chunk, HISTORY_METADATA, "apim-request-id") for chunk in stream_chunks]
+
+    responses = benchmark(format_all)
+
+    assert responses[0]["choices"][0]["messages"][0]["role"] == "tool"
+    assert responses[1]["choices"][0]["messages"][0]["role"] == "assistant"
+
+
+def test_format_stream_response_tool_calls(benchmark, tool_call_chunks):
+    def format_all():
+        return [format_stream_response(chunk, HISTORY_METADATA, "apim-request-id") for chunk in tool_call_chunks]
+
+    responses = benchmark(format_all)
+
+    assert responses[0]["choices"][0]["messages"][0]["tool_calls"]["function"]["name"] == "get_weather"
+
+
+def test_format_non_streaming_response(benchmark, chat_completion):
+    response = benchmark(format_non_streaming_response, chat_completion, HISTORY_METADATA, "apim-request-id")
+
+    assert [message["role"] for message in response["choices"][0]["messages"]] == ["tool", "assistant"]
+    assert response["usage"]["cached_tokens"] == 8000
+
+
+def test_convert_to_pf_format_long_conversation(benchmark, long_conversation):
+    chat_history = benchmark(convert_to_pf_format, long_conversation, "query", "reply")
+
+    assert len(chat_history) == 41
+
+
+def test_format_as_ndjson_answer(benchmark, stream_chunks, run_async):
+    responses = [format_stream_response(chunk, HISTORY_METADATA, "apim-request-id") for chunk in stream_chunks]
+
+    async def events():
+        for response in responses:
+            yield response
+
+    async def serialize():
+        return [line async for line in format_as_ndjson(events())]
+
+    lines = benchmark(lambda: run_async(serialize()))
+
+    assert len(lines) == len(responses)
+
+
+def test_construct_payload_configuration(benchmark, azure_search_settings):
+    payload = benchmark(
+        azure_search_settings.datasource.construct_payload_configuration,
+        filter_string="groups/any(g:search.in(g, 'a,b,c'))",
+    )
+
+    assert payload["parameters"]["filter"] == "groups/any(g:search.in(g, 'a,b,c'))"
+
+
+def test_get_authenticated_user_details(benchmark, easy_auth_headers):
+    user = benchmark(get_authenticated_user_details, easy_auth_headers)
+
+    assert user["user_principal_id"] == "00000000-0000-0000-0000-000000000000"
@@ -0,0 +1,10 @@
+import pytest
+
+from backend.loop_watchdog import forbid_blocking_calls
+
+
+@pytest.fixture(autouse=True)
+def no_blocking_calls():
+    """Fail tests making a known blocking call (time.sleep, requests, ...) on the event loop."""
+    with forbid_blocking_calls():
+        yield
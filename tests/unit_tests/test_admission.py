@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from backend.admission import AdmissionController
+
+
+@pytest.mark.asyncio
+async def test_admission_bounds_concurrency_until_tasks_finish():
+    controller = AdmissionController("test", max_concurrency=2)
+    running = 0
+    peak = 0
+    release = asyncio.Event()
+
+    async def handle():
+        nonlocal running, peak
+        await controller.admit()
+        running += 1
+        peak = max(peak, running)
+        await release.wait()
+        running -= 1
+
+    tasks = [asyncio.create_task(handle()) for _ in range(5)]
+    await asyncio.sleep(0)
+    assert controller.in_use == 2
+    assert running == 2
+
+    release.set()
+    await asyncio.gather(*tasks)
+    await asyncio.sleep(0)
+    assert peak == 2
+    assert controller.in_use == 0
+
+
+@pytest.mark.asyncio
+async def test_admission_slot_released_when_task_is_cancelled():
+    controller = AdmissionController("test-cancel", max_concurrency=1)
+
+    async def hold():
+        await controller.admit()
+        await asyncio.sleep(3600)
+
+    task = asyncio.create_task(hold())
+    await asyncio.sleep(0)
+    assert controller.in_use == 1
+
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    await asyncio.sleep(0)
+
+    assert await asyncio.wait_for(asyncio.create_task(controller.admit()), 1) >= 0
+    await asyncio.sleep(0)
+    assert controller.in_use == 0
+
+
+@pytest.mark.asyncio
+async def test_unbounded_admission_does_not_wait():
+    controller = AdmissionController("test-unbounded")
+    assert await controller.admit() == 0.0
+    assert controller.in_use == 0
+
+
+@pytest.mark.asyncio
+async def test_low_priority_waits_for_regular_requests():
+    controller = AdmissionController("test-priority", max_concurrency=1)
+    order = []
+    release = asyncio.Event()
+
+    async def handle(name, low_priority=False):
+        await controller.admit(low_priority=low_priority)
+        order.append(name)
+        await release.wait()
+
+    holder = asyncio.create_task(handle("holder"))
+    await asyncio.sleep(0)
+    low = asyncio.create_task(handle("batch", low_priority=True))
+    await asyncio.sleep(0)
+    regular = asyncio.create_task(handle("regular"))
+    await asyncio.sleep(0)
+
+    release.set()
+    await asyncio.gather(holder, low, regular)
+    assert order == ["holder", "regular", "batch"]
+
+
+@pytest.mark.asyncio
+async def test_low_priority_lane_is_bounded():
+    controller = AdmissionController("test-low-bound", max_low_priority=2)
+    release = asyncio.Event()
+
+    async def handle(low_priority):
+        await controller.admit(low_priority=low_priority)
+        await release.wait()
+
+    batch = [asyncio.create_task(handle(True)) for _ in range(4)]
+    regular = [asyncio.create_task(handle(False)) for _ in range(4)]
+    await asyncio.sleep(0)
+    assert controller.low_priority_in_use == 2
+    assert all(not task.done() for task in batch + regular)
+
+    release.set()
+    await asyncio.gather(*batch, *regular)
+    await asyncio.sleep(0)
+    assert controller.low_priority_in_use == 0
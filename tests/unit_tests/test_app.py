@@ -0,0 +1,271 @@
+import asyncio
+import json
+import os
+from importlib import import_module, reload
+
+import pytest
+from openai.types.chat import ChatCompletionChunk
+from werkzeug.datastructures import Headers
+
+from backend.admission import AdmissionController
+from backend.auth.auth_utils import get_authenticated_user_details
+from backend.capture import RequestCapture
+from backend.history.memoryservice import InMemoryConversationClient
+from backend.metrics import set_request_labels
+from backend.stream_replay import ReplayBufferStore
+
+DOTENV_PATH = os.path.join(os.path.dirname(__file__), "dotenv_data", "dotenv_no_datasource_1")
+LABELS = {"route": "/conversation", "datasource": "none", "deployment": "my_model"}
+
+
+def chunk(delta, finish_reason=None):
+    return ChatCompletionChunk.model_validate({
+        "id": "chatcmpl-test",
+        "object": "chat.completion.chunk",
+        "created": 1700000000,
+        "model": "gpt-4o",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    })
+
+
+class FakeStream():
+    """An upstream stream of ``chunks``, ``delay`` seconds apart, that then waits like a model that stopped sending if ``stall``."""
+
+    def __init__(self, chunks, stall=False, delay=0):
+        self.chunks = iter(chunks)
+        self.stall = stall
+        self.delay = delay
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await asyncio.sleep(self.delay)
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            if self.stall:
+                await asyncio.Event().wait()
+            raise StopAsyncIteration
+        return chunk
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    monkeypatch.setenv("DOTENV_PATH", DOTENV_PATH)
+    settings = reload(import_module("backend.settings")).app_settings
+    app = import_module("app")
+    monkeypatch.setattr(app, "app_settings", settings)
+    monkeypatch.setattr(settings.azure_openai, "stream", True)
+    return app
+
+
+@pytest.fixture
+def upstream(app_module, monkeypatch):
+    """Answer the chat requests with the FakeStream the test sets as ``upstream.stream``, or raise it if it is an error."""
+    class Upstream():
+        stream = None
+        requests = 0
+
+    async def send_chat_request(request_body, request_headers, stream=None):
+        Upstream.requests += 1
+        if isinstance(Upstream.stream, Exception):
+            raise Upstream.stream
+        return Upstream.stream, "apim-request-id"
+
+    monkeypatch.setattr(app_module, "send_chat_request", send_chat_request)
+    return Upstream
+
+
+@pytest.mark.asyncio
+async def test_cancelled_stream_closes_the_upstream(app_module, upstream):
+    upstream.stream = FakeStream([chunk({"role": "assistant", "content": "Hello"})], stall=True)
+    set_request_labels(*LABELS.values())
+    cancelled = app_module.stream_outcomes.value(**LABELS, outcome="cancelled")
+
+    answer = await app_module.stream_chat_request({"messages": [{"role": "user", "content": "Hi"}]}, Headers())
+    received = asyncio.Event()
+
+    async def read():
+        async for _ in answer:
+            received.set()
+
+    ## the client goes away while the model is still generating
+    reader = asyncio.ensure_future(read())
+    await received.wait()
+    reader.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await reader
+
+    assert upstream.stream.closed
+    assert app_module.stream_outcomes.value(**LABELS, outcome="cancelled") == cancelled + 1
+
+
+async def post_and_disconnect(client, path, body):
+    """Post ``body``, read the first part of the response and go away; return the response headers."""
+    async with client.request(path, method="POST", headers={"Content-Type": "application/json"}) as connection:
+        await connection.send(json.dumps(body).encode())
+        await connection.send_complete()
+        await connection.receive()
+        await connection.disconnect()
+    return connection.headers
+
+
+async def wait_until(condition):
+    while not condition():
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio
+async def test_resumable_answer_keeps_its_slot_after_the_client_left(app_module, upstream, monkeypatch):
+    monkeypatch.setattr(app_module.app_settings.stream_resume, "enabled", True)
+    admission = AdmissionController("test", max_concurrency=1)
+    monkeypatch.setattr(app_module, "chat_admission", admission)
+    stream_replay = ReplayBufferStore()
+    monkeypatch.setattr(app_module, "stream_replay", stream_replay)
+    upstream.stream = FakeStream([chunk({"role": "assistant", "content": "Hello"})], stall=True)
+
+    headers = await post_and_disconnect(
+        app_module.create_app().test_client(), "/conversation", {"messages": [{"role": "user", "content": "Hi"}]}
+    )
+
+    ## still generating, for a client that resumes
+    assert admission.in_use == 1
+    stream_replay.get(headers["X-Stream-Id"]).cancel()
+    await asyncio.wait_for(wait_until(lambda: admission.in_use == 0), 1)
+    assert upstream.stream.closed
+
+
+@pytest.mark.asyncio
+async def test_resumable_answer_left_while_waiting_for_a_slot_is_not_generated(app_module, upstream, monkeypatch):
+    monkeypatch.setattr(app_module.app_settings.stream_resume, "enabled", True)
+    admission = AdmissionController("test", max_concurrency=1)
+    monkeypatch.setattr(app_module, "chat_admission", admission)
+    stream_replay = ReplayBufferStore()
+    monkeypatch.setattr(app_module, "stream_replay", stream_replay)
+    upstream.stream = FakeStream([chunk({"role": "assistant", "content": "Hello"})], stall=True)
+    release = asyncio.Event()
+
+    async def hold_the_slot():
+        await admission.admit()
+        await release.wait()
+
+    holder = asyncio.ensure_future(hold_the_slot())
+    client = app_module.create_app().test_client()
+    async with client.request("/conversation", method="POST", headers={"Content-Type": "application/json"}) as connection:
+        await connection.send(json.dumps({"messages": [{"role": "user", "content": "Hi"}]}).encode())
+        await connection.send_complete()
+        await asyncio.wait_for(wait_until(lambda: admission._waiters), 1)
+        await connection.disconnect()
+
+    release.set()
+    await holder
+    await asyncio.wait_for(wait_until(lambda: all(buffer.done for buffer in stream_replay._buffers.values())), 1)
+    assert upstream.requests == 0
+    assert admission.in_use == 0
+
+
+@pytest.mark.asyncio
+async def test_resumable_answer_fails_with_the_upstream_status(app_module, upstream, monkeypatch):
+    monkeypatch.setattr(app_module.app_settings.stream_resume, "enabled", True)
+    monkeypatch.setattr(app_module, "stream_replay", ReplayBufferStore())
+    upstream.stream = Exception("Rate limit is exceeded")
+    upstream.stream.status_code = 429
+
+    response = await app_module.create_app().test_client().post(
+        "/conversation", json={"messages": [{"role": "user", "content": "Hi"}]}
+    )
+
+    assert response.status_code == 429
+    assert (await response.get_json())["error"] == "Rate limit is exceeded"
+
+
+@pytest.fixture
+def history(app_module):
+    """A test client of an app keeping the chat history in memory, and that history."""
+    app = app_module.create_app()
+    app.cosmos_conversation_client = InMemoryConversationClient()
+    app_module.cosmos_db_ready.set()
+    return app.test_client(), app.cosmos_conversation_client
+
+
+ANSWER = [
+    chunk({"role": "assistant", "context": {"citations": [{"title": "Benefits", "content": "Dental is covered"}]}}),
+    chunk({"content": "Dental is "}),
+    chunk({"content": "covered."}),
+]
+
+
+@pytest.mark.asyncio
+async def test_persisted_answer_is_saved_when_the_stream_completes(history, upstream):
+    client, store = history
+    user_id = get_authenticated_user_details(Headers())["user_principal_id"]
+    conversation = await store.create_conversation(user_id, "Benefits")
+    upstream.stream = FakeStream(ANSWER + [chunk({}, "stop")])
+
+    response = await client.post("/history/generate", json={
+        "conversation_id": conversation["id"],
+        "messages": [{"role": "user", "content": "Is dental covered?"}],
+        "persist_answer": True,
+    })
+    await response.get_data()
+
+    messages = await store.get_messages(user_id, conversation["id"])
+    assert [message["role"] for message in messages] == ["user", "tool", "assistant"]
+    ## the citation bodies are stored once per conversation, the tool message references them
+    [reference] = json.loads(messages[1]["content"])["citations"]
+    assert (await store.get_citations(user_id, conversation["id"]))[reference["ref"]]["title"] == "Benefits"
+    assert messages[2]["content"] == "Dental is covered."
+    assert messages[2]["id"] == "chatcmpl-test"
+
+
+@pytest.mark.asyncio
+async def test_cancelled_answer_is_not_persisted(history, upstream):
+    client, store = history
+    user_id = get_authenticated_user_details(Headers())["user_principal_id"]
+    conversation = await store.create_conversation(user_id, "Benefits")
+    upstream.stream = FakeStream(ANSWER, stall=True)
+
+    await post_and_disconnect(client, "/history/generate", {
+        "conversation_id": conversation["id"],
+        "messages": [{"role": "user", "content": "Is dental covered?"}],
+        "persist_answer": True,
+    })
+
+    assert upstream.stream.closed
+    messages = await store.get_messages(user_id, conversation["id"])
+    assert [message["role"] for message in messages] == ["user"]
+
+
+@pytest.mark.asyncio
+async def test_metrics_are_off_by_default_and_need_the_admin_key(app_module, monkeypatch):
+    client = app_module.create_app().test_client()
+    assert (await client.get("/metrics")).status_code == 404
+
+    monkeypatch.setattr(app_module.app_settings.base_settings, "metrics_enabled", True)
+    monkeypatch.setattr(app_module.app_settings.base_settings, "admin_api_key", "secret")
+    assert (await client.get("/metrics")).status_code == 401
+    response = await client.get("/metrics", headers={"X-Admin-Api-Key": "secret"})
+    assert response.status_code == 200
+    assert "http_request_duration_seconds" in await response.get_data(as_text=True)
+
+
+@pytest.mark.asyncio
+async def test_streamed_answer_is_captured_with_its_whole_duration(app_module, upstream, monkeypatch, tmp_path):
+    monkeypatch.setattr(app_module.app_settings.request_capture, "enabled", True)
+    request_capture = RequestCapture(str(tmp_path))
+    monkeypatch.setattr(app_module, "request_capture", request_capture)
+    upstream.stream = FakeStream([chunk({"role": "assistant", "content": "Hello"})] * 5 + [chunk({}, "stop")], delay=0.02)
+
+    response = await app_module.create_app().test_client().post(
+        "/conversation", json={"messages": [{"role": "user", "content": "Hi"}]}
+    )
+    await response.get_data()
+
+    [captured] = request_capture._pending
+    assert captured["stream"] is True
+    assert captured["status"] == 200
+    assert captured["latency"] >= 0.1
@@ -0,0 +1,119 @@
+import os
+import sys
+
+import pytest
+import pytest_asyncio
+
+from backend.cache import CacheBackend, LRUCache, SqliteCacheBackend, TieredCache, cache_requests
+from backend.history.message_cache import ConversationHistoryCache
+from backend.security.graph_groups import UserGroupCache, UserGroups
+
+
+@pytest_asyncio.fixture
+async def sqlite_backend(tmp_path):
+    """Make backends of one database, like the workers of a host have, and close them after the test."""
+    backends = []
+
+    def make(**kwargs):
+        backends.append(SqliteCacheBackend(str(tmp_path / "cache.db"), **kwargs))
+        return backends[-1]
+
+    yield make
+    for backend in backends:
+        await backend.close()
+
+
+def test_lru_cache_evicts_and_expires():
+    cache = LRUCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+
+    cache.set("d", 4, ttl=0)
+    assert cache.get("d") is None
+
+
+@pytest.mark.asyncio
+async def test_workers_share_entries_through_sqlite(sqlite_backend):
+    ## two workers, each with its own connection and memory tier
+    first = TieredCache("test", 10, backend=sqlite_backend())
+    second = TieredCache("test", 10, backend=sqlite_backend())
+
+    await first.set("key", {"groups": ["a"]})
+    assert await second.get("key") == {"groups": ["a"]}
+    assert cache_requests.value(cache="test", result="shared") == 1
+    assert await second.get("key") == {"groups": ["a"]}
+    assert cache_requests.value(cache="test", result="memory") == 1
+
+    await first.delete("key")
+    second.clear()
+    assert await second.get("key") is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(sys.platform == "win32", reason="POSIX permission bits")
+async def test_database_is_private(sqlite_backend, tmp_path):
+    await sqlite_backend().set("test", "key", "value")
+
+    assert oct(os.stat(tmp_path / "cache.db").st_mode & 0o777) == "0o600"
+
+
+@pytest.mark.asyncio
+async def test_shared_entries_expire_and_are_pruned(sqlite_backend):
+    backend = sqlite_backend(max_entries=2)
+
+    await backend.set("test", "expired", "1", ttl=-1)
+    assert await backend.get("test", "expired") is None
+
+    for key in ("a", "b", "c"):
+        await backend.set("test", key, key, ttl=60)
+    await backend.prune()
+    assert await backend.get("test", "a") is None
+    value, ttl = await backend.get("test", "c")
+    assert value == "c" and 59 < ttl <= 60
+
+
+class BrokenBackend(CacheBackend):
+    async def get(self, namespace, key):
+        raise OSError("database is locked")
+
+    async def set(self, namespace, key, value, ttl=None):
+        raise OSError("database is locked")
+
+    async def delete(self, namespace, key):
+        raise OSError("database is locked")
+
+
+@pytest.mark.asyncio
+async def test_shared_tier_errors_are_misses():
+    cache = TieredCache("broken", 10, backend=BrokenBackend())
+
+    await cache.set("key", "value")
+    assert await cache.get("key") == "value"
+    cache.clear()
+    assert await cache.get("key") is None
+
+
+@pytest.mark.asyncio
+async def test_caches_use_the_shared_tier(sqlite_backend):
+    history = ConversationHistoryCache(backend=sqlite_backend())
+    await history.put("user", "c", "t1", [{"id": "1", "role": "user", "content": "hi"}])
+    other_worker = ConversationHistoryCache(backend=sqlite_backend())
+    assert await other_worker.get("user", "c", "t1") == [{"id": "1", "role": "user", "content": "hi"}]
+    assert await other_worker.get("user", "c", "t2") is None
+
+    groups = UserGroupCache(ttl=60, backend=sqlite_backend())
+    other_groups = UserGroupCache(ttl=60, backend=sqlite_backend())
+
+    async def load():
+        return UserGroups(["a", "b"])
+
+    async def not_called():
+        raise AssertionError("the groups were loaded by the other worker")
+
+    await groups.get_or_load("token", load)
+    assert (await other_groups.get_or_load("token", not_called)).group_ids == ["a", "b"]
@@ -0,0 +1,62 @@
+import json
+import os
+
+import pytest
+
+from backend.capture import RequestCapture, redact, sanitize_body, user_hash
+
+
+def test_redact_keeps_shape_and_json():
+    assert redact("Where is Contoso's HQ? 42") == "xxxxx xx xxxxxxx'x xx? xx"
+
+    context = json.dumps({"citations": [{"content": "secret text", "chunk_id": 3}]})
+    redacted = json.loads(redact(context))
+    assert redacted == {"citations": [{"content": "xxxxxx xxxx", "chunk_id": 3}]}
+
+
+def test_sanitize_body_copies_and_redacts_messages():
+    body = {
+        "conversation_id": "c1",
+        "messages": [
+            {"id": "m1", "role": "user", "content": "hello world"},
+            {"id": "m2", "role": "assistant", "content": "hi", "context": json.dumps({"intent": "greeting"})},
+        ],
+    }
+
+    sanitized = sanitize_body(body)
+    ## the routes add to the body after it was captured
+    body["messages"].append({"role": "user", "content": "added later"})
+    body["history_metadata"] = {"conversation_id": "c1"}
+
+    assert sanitized == {
+        "conversation_id": "c1",
+        "messages": [
+            {"id": "m1", "role": "user", "content": "xxxxx xxxxx"},
+            {"id": "m2", "role": "assistant", "content": "xx", "context": json.dumps({"intent": "xxxxxxxx"})},
+        ],
+    }
+    assert sanitize_body({"message": {"role": "user", "content": "hi"}}, redact_content=False) == {
+        "message": {"role": "user", "content": "hi"}
+    }
+
+
+@pytest.mark.asyncio
+async def test_capture_writes_rotating_files(tmp_path):
+    capture = RequestCapture(str(tmp_path), max_file_bytes=200, max_files=2)
+
+    for i in range(4):
+        capture.record("/conversation", {"messages": [{"role": "user", "content": "x" * 100}]}, f"user{i}", 200, 1700000000.0 + i, 0.5)
+        await capture.flush()
+
+    assert capture.pending() == 0
+    files = sorted(os.listdir(tmp_path))
+    assert len(files) == 2
+    records = [json.loads(line) for name in files for line in open(tmp_path / name)]
+    assert [record["user"] for record in records] == [user_hash("user2"), user_hash("user3")]
+    assert records[0]["route"] == "/conversation"
+    assert records[0]["time"] == 1700000002.0
+
+
+def test_sample_rate():
+    assert all(RequestCapture("unused").sampled() for _ in range(10))
+    assert not any(RequestCapture("unused", sample_rate=0).sampled() for _ in range(10))
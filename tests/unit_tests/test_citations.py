@@ -0,0 +1,73 @@
+import json
+
+from backend.history.citations import (
+    CitationStream,
+    citation_key,
+    expand_citations,
+    referenced_keys,
+    split_citations,
+)
+
+
+def tool_content(*citations, intent="[]"):
+    return json.dumps({"citations": list(citations), "intent": intent})
+
+
+def test_citation_key_depends_on_content_and_source():
+    citation = {"content": "text", "title": "Doc", "filepath": "doc.pdf", "url": "https://x/doc.pdf"}
+
+    assert citation_key(citation) == citation_key({**citation, "title": "Other title"})
+    assert citation_key(citation) != citation_key({**citation, "content": "other text"})
+    assert citation_key(citation) != citation_key({**citation, "filepath": "other.pdf"})
+
+
+def test_split_and_expand_round_trip():
+    first, second = {"content": "one", "url": "u1"}, {"content": "two", "url": "u2"}
+    content = tool_content(first, second, first)
+
+    compact, bodies = split_citations(content)
+    keys = [citation_key(first), citation_key(second), citation_key(first)]
+    assert json.loads(compact)["citations"] == [{"ref": key} for key in keys]
+    assert json.loads(compact)["intent"] == "[]"
+    assert bodies == {keys[0]: first, keys[1]: second}
+    assert referenced_keys(compact) == set(keys)
+
+    assert json.loads(expand_citations(compact, bodies)) == json.loads(content)
+    # unknown references are kept
+    assert json.loads(expand_citations(compact, {}))["citations"][1] == {"ref": keys[1]}
+
+
+def test_split_keeps_content_without_citations():
+    assert split_citations("not json") == ("not json", {})
+    assert split_citations('{"intent": "x"}') == ('{"intent": "x"}', {})
+    assert expand_citations("not json", {}) == "not json"
+
+
+def test_citation_stream_sends_each_body_once():
+    first, second = {"content": "one"}, {"content": "two"}
+    stream = CitationStream(known_keys=[citation_key(first)])
+
+    citations = json.loads(stream.compact(tool_content(first, second)))["citations"]
+    assert citations == [{"ref": citation_key(first)}, {**second, "ref": citation_key(second)}]
+
+    citations = json.loads(stream.compact(tool_content(second)))["citations"]
+    assert citations == [{"ref": citation_key(second)}]
+
+    # the streamed body carries its key, stored as a plain body
+    _, bodies = split_citations(tool_content({**second, "ref": citation_key(second)}))
+    assert bodies == {citation_key(second): second}
+
+
+def test_citation_stream_rewrites_tool_messages_only():
+    stream = CitationStream()
+    response = {
+        "choices": [{"messages": [
+            {"role": "tool", "content": tool_content({"content": "one"})},
+            {"role": "assistant", "content": "answer"},
+        ]}]
+    }
+
+    stream.compact_response(response)
+    messages = response["choices"][0]["messages"]
+    assert json.loads(messages[0]["content"])["citations"][0]["ref"] == citation_key({"content": "one"})
+    assert messages[1] == {"role": "assistant", "content": "answer"}
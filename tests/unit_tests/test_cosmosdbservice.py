@@ -0,0 +1,239 @@
+import pytest
+from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.cosmosdbembeddedservice import CosmosEmbeddedConversationClient
+from tools.mock_cosmosdb import InMemoryCosmosClient
+from backend.history.instrumentation import (
+    get_request_diagnostics,
+    operation_request_charge,
+    operation_requests,
+    record_cosmos_response,
+    retried_requests,
+    start_request_diagnostics,
+)
+
+
+def make_client(client_class, cosmosdb_client=None, **kwargs):
+    return client_class(
+        cosmosdb_endpoint="https://dummy",
+        credential="key",
+        database_name="db",
+        container_name="conversations",
+        enable_message_feedback=True,
+        cosmosdb_client=cosmosdb_client or InMemoryCosmosClient(),
+        **kwargs
+    )
+
+
+@pytest.fixture
+def conversation_client():
+    return make_client(CosmosConversationClient)
+
+
+@pytest.fixture
+def embedded_client():
+    return make_client(CosmosEmbeddedConversationClient, embedded_max_bytes=1024)
+
+
+async def add_messages(client, user_id, conversation_id, count, content_size=10):
+    for i in range(count):
+        await client.create_message(
+            uuid=f"m{i}",
+            conversation_id=conversation_id,
+            user_id=user_id,
+            input_message={"role": "user", "content": str(i) * content_size},
+        )
+
+
+@pytest.mark.asyncio
+async def test_get_messages_orders_by_created_at(conversation_client):
+    conversation = await conversation_client.create_conversation("user", "title")
+    await add_messages(conversation_client, "user", conversation["id"], 3)
+    container = conversation_client.container_client
+    container.items[("user", "m0")]["createdAt"] = "9999-01-01T00:00:00"
+
+    messages = await conversation_client.get_messages("user", conversation["id"])
+    assert [m["id"] for m in messages] == ["m1", "m2", "m0"]
+
+
+@pytest.mark.asyncio
+async def test_get_messages_page_follows_continuation(conversation_client):
+    conversation = await conversation_client.create_conversation("user", "title")
+    await add_messages(conversation_client, "user", conversation["id"], 5)
+
+    pages = []
+    token = None
+    while True:
+        page, token = await conversation_client.get_messages_page("user", conversation["id"], page_size=2, continuation_token=token)
+        pages.append([m["id"] for m in page])
+        if token is None:
+            break
+
+    assert pages == [["m0", "m1"], ["m2", "m3"], ["m4"]]
+
+
+@pytest.mark.asyncio
+async def test_iter_messages(conversation_client):
+    conversation = await conversation_client.create_conversation("user", "title")
+    await add_messages(conversation_client, "user", conversation["id"], 3)
+
+    ids = [m["id"] async for m in conversation_client.iter_messages("user", conversation["id"])]
+    assert ids == ["m0", "m1", "m2"]
+
+
+@pytest.mark.asyncio
+async def test_embedded_messages_spill_to_segments(embedded_client):
+    conversation = await embedded_client.create_conversation("user", "title")
+    await add_messages(embedded_client, "user", conversation["id"], 20, content_size=100)
+
+    stored = await embedded_client.get_conversation("user", conversation["id"])
+    assert len(stored["segments"]) > 0
+    assert sum(s["count"] for s in stored["segments"]) + len(stored["messages"]) == 20
+
+    messages = await embedded_client.get_messages("user", conversation["id"])
+    assert [m["id"] for m in messages] == [f"m{i}" for i in range(20)]
+
+    streamed = [m["id"] async for m in embedded_client.iter_messages("user", conversation["id"])]
+    assert streamed == [f"m{i}" for i in range(20)]
+
+
+@pytest.mark.asyncio
+async def test_embedded_messages_page_across_segments(embedded_client):
+    conversation = await embedded_client.create_conversation("user", "title")
+    await add_messages(embedded_client, "user", conversation["id"], 20, content_size=100)
+
+    ids = []
+    token = None
+    while True:
+        page, token = await embedded_client.get_messages_page("user", conversation["id"], page_size=3, continuation_token=token)
+        assert len(page) <= 3
+        ids.extend(m["id"] for m in page)
+        if token is None:
+            break
+
+    assert ids == [f"m{i}" for i in range(20)]
+
+
+@pytest.mark.asyncio
+async def test_embedded_list_excludes_messages(embedded_client):
+    conversation = await embedded_client.create_conversation("user", "title")
+    await add_messages(embedded_client, "user", conversation["id"], 2)
+
+    conversations = await embedded_client.get_conversations("user", limit=25)
+    assert [c["id"] for c in conversations] == [conversation["id"]]
+    assert "messages" not in conversations[0]
+
+
+@pytest.mark.asyncio
+async def test_embedded_feedback_and_delete(embedded_client):
+    conversation = await embedded_client.create_conversation("user", "title")
+    await add_messages(embedded_client, "user", conversation["id"], 20, content_size=100)
+
+    assert await embedded_client.update_message_feedback("user", "m0", "positive")
+    assert await embedded_client.update_message_feedback("user", "m19", "negative")
+    assert not await embedded_client.update_message_feedback("user", "missing", "negative")
+
+    messages = await embedded_client.get_messages("user", conversation["id"])
+    assert messages[0]["feedback"] == "positive"
+    assert messages[-1]["feedback"] == "negative"
+
+    await embedded_client.delete_messages(conversation["id"], "user")
+    assert await embedded_client.get_messages("user", conversation["id"]) == []
+
+    await embedded_client.delete_conversation("user", conversation["id"])
+    assert await embedded_client.get_conversation("user", conversation["id"]) is None
+    assert embedded_client.container_client.items == {}
+
+
+@pytest.mark.asyncio
+async def test_embedded_client_reads_item_layout_conversations():
+    cosmosdb_client = InMemoryCosmosClient()
+    items_client = make_client(CosmosConversationClient, cosmosdb_client)
+    embedded_client = make_client(CosmosEmbeddedConversationClient, cosmosdb_client)
+
+    conversation = await items_client.create_conversation("user", "title")
+    await add_messages(items_client, "user", conversation["id"], 2)
+    await embedded_client.create_message(
+        uuid="m2",
+        conversation_id=conversation["id"],
+        user_id="user",
+        input_message={"role": "assistant", "content": "answer"},
+    )
+
+    messages = await embedded_client.get_messages("user", conversation["id"])
+    assert len(messages) == 3
+    assert "messages" not in await embedded_client.get_conversation("user", conversation["id"])
+
+    source_messages = await items_client.get_messages("user", conversation["id"])
+    await embedded_client.import_conversation(conversation, source_messages)
+    migrated = await embedded_client.get_conversation("user", conversation["id"])
+    assert migrated["layout"] == "embedded"
+    assert [m["id"] for m in await embedded_client.get_messages("user", conversation["id"])] == ["m0", "m1", "m2"]
+
+
+@pytest.mark.asyncio
+async def test_in_place_migration_leaves_nothing_behind_a_deleted_conversation():
+    from tools.migrate_history_layout import migrate
+
+    cosmosdb_client = InMemoryCosmosClient()
+    items_client = make_client(CosmosConversationClient, cosmosdb_client)
+    embedded_client = make_client(CosmosEmbeddedConversationClient, cosmosdb_client, embedded_max_bytes=1024)
+    conversation = await items_client.create_conversation("user", "title")
+    await add_messages(items_client, "user", conversation["id"], 3)
+
+    stats = await migrate(items_client, embedded_client, delete_source_messages=True)
+    assert stats["conversations"] == 1 and stats["messages"] == 3
+    assert [m["id"] for m in await embedded_client.get_messages("user", conversation["id"])] == ["m0", "m1", "m2"]
+
+    await embedded_client.delete_conversation("user", conversation["id"])
+    assert embedded_client.container_client.items == {}
+
+
+@pytest.mark.asyncio
+async def test_operations_record_request_charge_and_diagnostics():
+    client = make_client(
+        CosmosEmbeddedConversationClient,
+        cosmosdb_client=InMemoryCosmosClient(raw_response_hook=record_cosmos_response),
+    )
+    conversation = await client.create_conversation("user", "title")
+    charge_before = operation_request_charge.snapshot(operation="create_message")
+    requests_before = operation_requests.snapshot(operation="create_message")
+
+    start_request_diagnostics()
+    await add_messages(client, "user", conversation["id"], 2)
+    diagnostics = get_request_diagnostics()
+
+    # the nested conversation read and replace are attributed to create_message
+    assert [d["operation"] for d in diagnostics] == ["create_message", "create_message"]
+    assert all(d["requests"] == 2 and d["ru"] > 0 for d in diagnostics)
+    charge = operation_request_charge.snapshot(operation="create_message")
+    assert charge["count"] == charge_before["count"] + 2
+    assert charge["sum"] - charge_before["sum"] == pytest.approx(sum(d["ru"] for d in diagnostics))
+    requests = operation_requests.snapshot(operation="create_message")
+    assert requests["sum"] - requests_before["sum"] == 4
+
+    messages = [m async for m in client.iter_messages("user", conversation["id"])]
+    assert len(messages) == 2
+    assert diagnostics[-1]["operation"] == "iter_messages"
+
+
+@pytest.mark.asyncio
+async def test_retried_requests_are_counted():
+    client = make_client(
+        CosmosEmbeddedConversationClient,
+        cosmosdb_client=InMemoryCosmosClient(raw_response_hook=record_cosmos_response),
+    )
+    conversation = await client.create_conversation("user", "title")
+    retried_before = retried_requests.value(operation="create_message", status_code="412")
+
+    # a concurrent writer changes the document between the read and the replace
+    container = client.container_client
+    replace_item = container.replace_item
+    async def replace_once_concurrently(item, body, **kwargs):
+        container.replace_item = replace_item
+        container.items[("user", conversation["id"])]["_etag"] = "changed"
+        return await replace_item(item, body, **kwargs)
+    container.replace_item = replace_once_concurrently
+
+    await add_messages(client, "user", conversation["id"], 1)
+    assert retried_requests.value(operation="create_message", status_code="412") == retried_before + 1
+    assert len(await client.get_messages("user", conversation["id"])) == 1
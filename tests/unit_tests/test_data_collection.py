@@ -0,0 +1,62 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+import pytest
+
+from tools.load_test import ROOT, start_mock_server, stop
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def mock_url():
+    port = free_port()
+    mock = start_mock_server(port, ttft_ms=0, tokens_per_second=0, completion_tokens=5)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                httpx.get(url + "/stats")
+                break
+            except httpx.TransportError:
+                if time.monotonic() > deadline or mock.poll() is not None:
+                    raise
+                time.sleep(0.2)
+        yield url
+    finally:
+        stop(mock)
+
+
+def test_collects_answers_from_the_mock_server(mock_url, tmp_path):
+    questions = tmp_path / "qa.json"
+    questions.write_text(json.dumps([{"qa_pairs": [{"question": "Who?", "answer": "Contoso"}, {"question": "Where?"}]}]))
+    output = tmp_path / "evaluation.jsonl"
+    env = {
+        **os.environ,
+        "DOTENV_PATH": os.devnull,
+        "AZURE_OPENAI_ENDPOINT": mock_url,
+        "AZURE_OPENAI_KEY": "mock",
+        "AZURE_OPENAI_MODEL": "gpt-mock",
+    }
+
+    result = subprocess.run(
+        [sys.executable, os.path.join(ROOT, "tools", "data_collection.py"), str(questions), str(output)],
+        cwd=ROOT, env=env, capture_output=True, text=True, timeout=120,
+    )
+
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "Answered 2 questions, skipped 0 already answered, 0 failed" in result.stdout
+    records = [json.loads(line) for line in output.read_text().splitlines()]
+    ## answered concurrently, in any order
+    assert sorted(record["messages"][0]["content"] for record in records) == ["Where?", "Who?"]
+    assert all(record["messages"][1]["content"] for record in records)
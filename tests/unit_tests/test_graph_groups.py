@@ -0,0 +1,138 @@
+import asyncio
+import httpx
+import pytest
+from backend.security.graph_groups import (
+    GraphGroupLookupError,
+    UserGroupCache,
+    UserGroups,
+    fetch_user_groups,
+    get_user_groups,
+)
+from backend.security.group_filter import IndexedGroupsSnapshot
+
+
+def graph_transport(pages, status_code=200):
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        if status_code != 200:
+            return httpx.Response(status_code, text="denied")
+        index = int(request.url.params.get("page", "0"))
+        body = {"value": [{"id": group_id} for group_id in pages[index]]}
+        if index + 1 < len(pages):
+            body["@odata.nextLink"] = f"https://graph.microsoft.com/v1.0/me/transitiveMemberOf?page={index + 1}"
+        return httpx.Response(200, json=body)
+
+    return httpx.MockTransport(handler), requests
+
+
+@pytest.mark.asyncio
+async def test_fetch_user_groups_follows_next_links():
+    transport, requests = graph_transport([["a", "b"], ["c"], ["d"]])
+    async with httpx.AsyncClient(transport=transport) as client:
+        groups = await fetch_user_groups("token", client)
+
+    assert groups == ["a", "b", "c", "d"]
+    assert len(requests) == 3
+    assert requests[0].headers["Authorization"] == "bearer token"
+
+
+@pytest.mark.asyncio
+async def test_fetch_user_groups_raises_on_error():
+    transport, _ = graph_transport([], status_code=403)
+    async with httpx.AsyncClient(transport=transport) as client:
+        with pytest.raises(GraphGroupLookupError):
+            await fetch_user_groups("token", client)
+
+
+def test_user_groups_filter_is_compiled_once_per_snapshot():
+    user_groups = UserGroups(["a", "b", "c"])
+
+    first = user_groups.filter("groups", None, 1000, "truncate")
+    assert first == "groups/any(g:search.in(g, 'a,b,c'))"
+    assert user_groups.filter("groups", None, 1000, "truncate") is first
+
+    snapshot = IndexedGroupsSnapshot({"b": 3}, version=1)
+    assert user_groups.filter("groups", snapshot, 1000, "truncate") == "groups/any(g:search.in(g, 'b'))"
+
+
+@pytest.mark.asyncio
+async def test_cache_loads_once_for_concurrent_requests():
+    cache = UserGroupCache(ttl=60)
+    calls = 0
+
+    async def loader():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return "filter"
+
+    results = await asyncio.gather(*(cache.get_or_load("token", loader) for _ in range(10)))
+    assert results == ["filter"] * 10
+    assert calls == 1
+
+    assert await cache.get_or_load("token", loader) == "filter"
+    assert calls == 1
+    assert await cache.get_or_load("other-token", loader) == "filter"
+    assert calls == 2
+
+
+@pytest.mark.asyncio
+async def test_cache_expires_and_evicts():
+    cache = UserGroupCache(ttl=0, max_entries=2)
+    calls = 0
+
+    async def loader():
+        nonlocal calls
+        calls += 1
+        return calls
+
+    assert await cache.get_or_load("token", loader) == 1
+    assert await cache.get_or_load("token", loader) == 2
+
+    cache = UserGroupCache(ttl=60, max_entries=2)
+    for token in ("a", "b", "c"):
+        await cache.get_or_load(token, loader)
+    assert len(cache._cache.memory) == 2
+    assert cache._cache.memory.get(cache.key("a")) is None
+
+
+@pytest.mark.asyncio
+async def test_cache_waiters_retry_when_loading_request_is_cancelled():
+    cache = UserGroupCache(ttl=60)
+    started = asyncio.Event()
+
+    async def slow_loader():
+        started.set()
+        await asyncio.sleep(10)
+
+    async def fast_loader():
+        return "filter"
+
+    first = asyncio.create_task(cache.get_or_load("token", slow_loader))
+    await started.wait()
+    second = asyncio.create_task(cache.get_or_load("token", fast_loader))
+    await asyncio.sleep(0)
+    first.cancel()
+
+    assert await second == "filter"
+    with pytest.raises(asyncio.CancelledError):
+        await first
+
+
+@pytest.mark.asyncio
+async def test_failed_lookups_deny_and_are_not_cached(monkeypatch):
+    cache = UserGroupCache(ttl=60)
+    responses = [GraphGroupLookupError("throttled"), ["a"]]
+
+    async def fake_fetch_user_groups(user_token, http_client=None):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr("backend.security.graph_groups.fetch_user_groups", fake_fetch_user_groups)
+
+    assert (await get_user_groups("token", cache)).group_ids == []
+    assert (await get_user_groups("token", cache)).group_ids == ["a"]
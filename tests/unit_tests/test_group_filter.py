@@ -0,0 +1,109 @@
+import asyncio
+import httpx
+import pytest
+from backend.security.group_filter import (
+    GroupFilterTooLargeError,
+    IndexedGroups,
+    IndexedGroupsSnapshot,
+    compile_group_filter,
+)
+
+
+def facet_transport(responses):
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        response = responses[min(len(requests), len(responses)) - 1]
+        if isinstance(response, int):
+            return httpx.Response(response, text="error")
+        return httpx.Response(200, json={
+            "value": [],
+            "@search.facets": {"groups": [{"value": v, "count": c} for v, c in response.items()]},
+        })
+
+    return httpx.MockTransport(handler), requests
+
+
+def indexed_groups(transport, **kwargs):
+    return IndexedGroups(
+        endpoint="https://search.example",
+        index="docs",
+        column="groups",
+        key="secret",
+        http_client=httpx.AsyncClient(transport=transport),
+        **kwargs
+    )
+
+
+def test_compile_intersects_with_indexed_groups():
+    snapshot = IndexedGroupsSnapshot({"a": 1, "b": 10, "c": 5}, version=1)
+    user_groups = ["c", "x", "y", "b", "z"]
+
+    assert compile_group_filter("groups", user_groups, snapshot, 100) == "groups/any(g:search.in(g, 'b,c'))"
+    # no indexed group in common: the filter matches nothing
+    assert compile_group_filter("groups", ["x"], snapshot, 100) == "groups/any(g:search.in(g, ''))"
+
+
+def test_compile_without_snapshot_keeps_all_groups():
+    assert compile_group_filter("groups", ["b", "a", "b"], None, 100) == "groups/any(g:search.in(g, 'b,a'))"
+
+
+def test_compile_overflow_strategies():
+    snapshot = IndexedGroupsSnapshot({"a": 1, "b": 10, "c": 5}, version=1)
+
+    # truncate keeps the groups granting access to the most documents
+    assert compile_group_filter("groups", ["a", "b", "c"], snapshot, 2, "truncate") == "groups/any(g:search.in(g, 'b,c'))"
+    assert compile_group_filter("groups", ["a", "b", "c"], snapshot, 2, "send_all") == "groups/any(g:search.in(g, 'b,c,a'))"
+    with pytest.raises(GroupFilterTooLargeError):
+        compile_group_filter("groups", ["a", "b", "c"], snapshot, 2, "reject")
+
+
+@pytest.mark.asyncio
+async def test_indexed_groups_loads_facets():
+    transport, requests = facet_transport([{"a": 2, "b": 1}])
+    groups = indexed_groups(transport)
+
+    snapshot = await groups.get()
+    assert snapshot.document_counts == {"a": 2, "b": 1}
+    assert requests[0].headers["api-key"] == "secret"
+    assert requests[0].url.path == "/indexes/docs/docs/search"
+    assert "groups,count:100001" in requests[0].content.decode()
+
+    # within the refresh interval the snapshot is reused
+    assert await groups.get() is snapshot
+    assert len(requests) == 1
+
+
+@pytest.mark.asyncio
+async def test_indexed_groups_refreshes_in_background():
+    transport, requests = facet_transport([{"a": 1}, {"a": 1, "b": 1}])
+    groups = indexed_groups(transport, refresh_interval=0)
+
+    first = await groups.get()
+    # a stale snapshot is still returned while the refresh runs
+    assert await groups.get() is first
+    await asyncio.sleep(0.01)
+    refreshed = await groups.get()
+    assert refreshed.document_counts == {"a": 1, "b": 1}
+    assert refreshed.version > first.version
+
+
+@pytest.mark.asyncio
+async def test_indexed_groups_unavailable():
+    transport, _ = facet_transport([400])
+    assert await indexed_groups(transport).get() is None
+
+    # a truncated facet list can't be used for intersecting
+    transport, _ = facet_transport([{"a": 1, "b": 1, "c": 1}])
+    assert await indexed_groups(transport, max_groups=2).get() is None
+
+
+@pytest.mark.asyncio
+async def test_concurrent_first_requests_share_the_load():
+    transport, requests = facet_transport([{"a": 1}])
+    groups = indexed_groups(transport)
+
+    snapshots = await asyncio.gather(*(groups.get() for _ in range(5)))
+    assert all(snapshot is snapshots[0] for snapshot in snapshots)
+    assert len(requests) == 1
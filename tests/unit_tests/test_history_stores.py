@@ -0,0 +1,213 @@
+import pytest
+import pytest_asyncio
+from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.cosmosdbembeddedservice import CosmosEmbeddedConversationClient
+from tools.mock_cosmosdb import InMemoryCosmosClient
+from backend.history.memoryservice import InMemoryConversationClient
+from backend.history.sqliteservice import SqliteConversationClient
+
+
+def make_cosmos_client(client_class, **kwargs):
+    return client_class(
+        cosmosdb_endpoint="https://dummy",
+        credential="key",
+        database_name="db",
+        container_name="conversations",
+        enable_message_feedback=True,
+        cosmosdb_client=InMemoryCosmosClient(),
+        **kwargs
+    )
+
+
+@pytest_asyncio.fixture(params=["memory", "sqlite", "cosmosdb-items", "cosmosdb-embedded"])
+async def store(request, tmp_path):
+    if request.param == "memory":
+        client = InMemoryConversationClient(enable_message_feedback=True)
+    elif request.param == "sqlite":
+        client = SqliteConversationClient(str(tmp_path / "history.db"), enable_message_feedback=True)
+    elif request.param == "cosmosdb-items":
+        client = make_cosmos_client(CosmosConversationClient)
+    else:
+        client = make_cosmos_client(CosmosEmbeddedConversationClient, embedded_max_bytes=1024)
+
+    yield client
+    await client.close()
+
+
+async def add_messages(client, user_id, conversation_id, count, content_size=10):
+    for i in range(count):
+        await client.create_message(
+            uuid=f"{conversation_id}-m{i}",
+            conversation_id=conversation_id,
+            user_id=user_id,
+            input_message={"role": "user" if i % 2 == 0 else "assistant", "content": str(i) * content_size},
+        )
+
+
+@pytest.mark.asyncio
+async def test_ensure(store):
+    success, _ = await store.ensure()
+    assert success
+
+
+@pytest.mark.asyncio
+async def test_conversation_round_trip(store):
+    conversation = await store.create_conversation("user", "title")
+
+    fetched = await store.get_conversation("user", conversation["id"])
+    assert fetched["title"] == "title"
+    assert fetched["userId"] == "user"
+    assert await store.get_conversation("other-user", conversation["id"]) is None
+
+    fetched["title"] = "renamed"
+    await store.upsert_conversation(fetched)
+    assert (await store.get_conversation("user", conversation["id"]))["title"] == "renamed"
+
+
+@pytest.mark.asyncio
+async def test_get_conversations_sorts_by_updated_at(store):
+    first = await store.create_conversation("user", "first")
+    second = await store.create_conversation("user", "second")
+    await store.create_conversation("other-user", "other")
+    # a new message moves the first conversation back to the top
+    await add_messages(store, "user", first["id"], 1)
+
+    conversations = await store.get_conversations("user", limit=25)
+    assert [c["id"] for c in conversations] == [first["id"], second["id"]]
+
+    conversations = await store.get_conversations("user", limit=25, sort_order="ASC")
+    assert [c["id"] for c in conversations] == [second["id"], first["id"]]
+
+    conversations = await store.get_conversations("user", limit=1, offset=1)
+    assert [c["id"] for c in conversations] == [second["id"]]
+
+
+@pytest.mark.asyncio
+async def test_messages_in_order_and_scoped_to_user(store):
+    conversation = await store.create_conversation("user", "title")
+    await add_messages(store, "user", conversation["id"], 30, content_size=100)
+
+    messages = await store.get_messages("user", conversation["id"])
+    assert [m["id"] for m in messages] == [f"{conversation['id']}-m{i}" for i in range(30)]
+    assert messages[1]["role"] == "assistant"
+    assert messages[1]["content"] == "1" * 100
+
+    streamed = [m async for m in store.iter_messages("user", conversation["id"])]
+    assert [m["id"] for m in streamed] == [m["id"] for m in messages]
+
+    assert await store.get_messages("other-user", conversation["id"]) == []
+
+
+@pytest.mark.asyncio
+async def test_get_messages_page(store):
+    conversation = await store.create_conversation("user", "title")
+    await add_messages(store, "user", conversation["id"], 7, content_size=200)
+
+    ids = []
+    token = None
+    pages = 0
+    while True:
+        page, token = await store.get_messages_page("user", conversation["id"], page_size=3, continuation_token=token)
+        assert len(page) <= 3
+        ids.extend(m["id"] for m in page)
+        pages += 1
+        if token is None:
+            break
+
+    assert ids == [f"{conversation['id']}-m{i}" for i in range(7)]
+    assert pages == 3
+
+
+@pytest.mark.asyncio
+async def test_create_message_requires_conversation(store):
+    result = await store.create_message(
+        uuid="m0",
+        conversation_id="missing",
+        user_id="user",
+        input_message={"role": "user", "content": "hi"},
+    )
+    assert result == "Conversation not found"
+
+
+@pytest.mark.asyncio
+async def test_message_feedback(store):
+    conversation = await store.create_conversation("user", "title")
+    await add_messages(store, "user", conversation["id"], 2)
+    message_id = f"{conversation['id']}-m1"
+
+    updated = await store.update_message_feedback("user", message_id, "positive")
+    assert updated["feedback"] == "positive"
+    messages = await store.get_messages("user", conversation["id"])
+    assert messages[1]["feedback"] == "positive"
+
+    assert not await store.update_message_feedback("other-user", message_id, "negative")
+    assert not await store.update_message_feedback("user", "missing", "negative")
+
+
+@pytest.mark.asyncio
+async def test_delete(store):
+    conversation = await store.create_conversation("user", "title")
+    await add_messages(store, "user", conversation["id"], 3)
+
+    await store.delete_messages(conversation["id"], "user")
+    await store.delete_conversation("user", conversation["id"])
+
+    assert await store.get_conversation("user", conversation["id"]) is None
+    assert await store.get_messages("user", conversation["id"]) == []
+    assert await store.get_conversations("user", limit=25) == []
+    # deleting again is not an error
+    await store.delete_conversation("user", conversation["id"])
+
+
+def usage_record(user_id, conversation_id, day, prompt=10, cached=0, completion=5):
+    return {
+        "userId": user_id,
+        "conversationId": conversation_id,
+        "day": day,
+        "promptTokens": prompt,
+        "cachedTokens": cached,
+        "completionTokens": completion,
+        "requests": 1,
+    }
+
+
+@pytest.mark.asyncio
+async def test_usage_is_added_per_user_conversation_and_day(store):
+    await store.add_usage([
+        usage_record("user", "c1", "2024-05-01"),
+        usage_record("user", None, "2024-05-01"),
+        usage_record("other-user", "c2", "2024-05-02"),
+    ])
+    await store.add_usage([usage_record("user", "c1", "2024-05-01", prompt=20, cached=8, completion=1)])
+
+    usage = await store.get_usage(user_id="user")
+    by_conversation = {u["conversationId"]: u for u in usage}
+    assert set(by_conversation) == {"c1", None}
+    assert by_conversation["c1"]["promptTokens"] == 30
+    assert by_conversation["c1"]["cachedTokens"] == 8
+    assert by_conversation["c1"]["completionTokens"] == 6
+    assert by_conversation["c1"]["requests"] == 2
+
+    assert [u["userId"] for u in await store.get_usage(since="2024-05-02")] == ["other-user"]
+    assert len(await store.get_usage()) == 3
+
+    ## usage documents aren't listed as conversations
+    assert await store.get_conversations("user", limit=None) == []
+
+
+@pytest.mark.asyncio
+async def test_citations_are_stored_once_per_conversation(store):
+    conversation = await store.create_conversation("user", "title")
+    await store.add_citations("user", conversation["id"], {"k1": {"content": "one"}, "k2": {"content": "two"}})
+    await store.add_citations("user", conversation["id"], {"k1": {"content": "one"}})
+    await store.add_citations("user", "other-conversation", {"k3": {"content": "three"}})
+
+    assert await store.get_citations("user", conversation["id"]) == {"k1": {"content": "one"}, "k2": {"content": "two"}}
+    assert await store.get_citation_keys("user", conversation["id"]) == {"k1", "k2"}
+    assert await store.get_citations("other-user", conversation["id"]) == {}
+
+    await store.delete_citations("user", conversation["id"])
+    assert await store.get_citations("user", conversation["id"]) == {}
+    assert await store.get_citation_keys("user", "other-conversation") == {"k3"}
+    ## citation documents aren't listed as conversations or messages
+    assert await store.get_messages("user", "other-conversation") == []
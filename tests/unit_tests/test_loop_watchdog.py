@@ -0,0 +1,50 @@
+import asyncio
+import logging
+import time
+
+import pytest
+import requests
+
+from backend.loop_watchdog import BlockingCallError, LoopWatchdog, event_loop_blocked
+
+
+def busy_wait(seconds):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+
+
+@pytest.mark.asyncio
+async def test_watchdog_reports_blocking_frame(caplog):
+    watchdog = LoopWatchdog(threshold=0.05)
+    watchdog.start()
+    try:
+        await asyncio.sleep(0.05)
+        with caplog.at_level(logging.WARNING):
+            busy_wait(0.4)
+            ## the stall is counted once the loop runs again
+            await asyncio.sleep(0.05)
+    finally:
+        await watchdog.close()
+
+    records = [record for record in caplog.records if getattr(record, "event", None) == "event_loop_blocked"]
+    assert len(records) == 1
+    assert records[0].location.startswith("tests/unit_tests/test_loop_watchdog.py:")
+    assert records[0].location.endswith(" busy_wait")
+    assert "busy_wait(0.4)" in records[0].stack
+    assert event_loop_blocked.value(location=records[0].location) == 1
+
+
+@pytest.mark.asyncio
+async def test_blocking_calls_fail_on_the_event_loop():
+    with pytest.raises(BlockingCallError):
+        time.sleep(0)
+    with pytest.raises(BlockingCallError):
+        requests.get("http://localhost:9")
+
+    ## allowed off the event loop
+    await asyncio.to_thread(time.sleep, 0)
+
+
+def test_blocking_calls_allowed_without_event_loop():
+    time.sleep(0)
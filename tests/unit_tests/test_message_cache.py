@@ -0,0 +1,59 @@
+import pytest
+
+from backend.history.message_cache import ConversationHistoryCache, chat_message
+
+
+def message(id, role="user", content="hi"):
+    return {"id": id, "role": role, "content": content, "createdAt": "t", "conversationId": "c"}
+
+
+@pytest.mark.asyncio
+async def test_entry_is_served_only_while_current():
+    cache = ConversationHistoryCache()
+    await cache.put("user", "c", "t1", [chat_message(message("1"))])
+
+    assert await cache.get("user", "c", "t1") == [{"id": "1", "role": "user", "content": "hi"}]
+    assert await cache.get("user", "c", "t2") is None
+    assert await cache.get("other-user", "c", "t1") is None
+
+
+@pytest.mark.asyncio
+async def test_tool_messages_are_not_kept():
+    cache = ConversationHistoryCache()
+    await cache.put("user", "c", "t1", [message("1"), message("2", role="tool"), message("3", role="assistant")])
+
+    assert [m["id"] for m in await cache.get("user", "c", "t1")] == ["1", "3"]
+
+
+@pytest.mark.asyncio
+async def test_append_requires_the_previous_update():
+    cache = ConversationHistoryCache()
+    await cache.put("user", "c", "t1", [message("1")])
+
+    await cache.append("user", "c", "t1", "t2", message("2", role="assistant"))
+    assert [m["id"] for m in await cache.get("user", "c", "t2")] == ["1", "2"]
+
+    # another worker wrote to the conversation in between
+    await cache.append("user", "c", "t3", "t4", message("4", role="assistant"))
+    assert await cache.get("user", "c", "t2") is None
+    assert await cache.get("user", "c", "t4") is None
+
+
+@pytest.mark.asyncio
+async def test_least_recently_used_conversation_is_evicted():
+    cache = ConversationHistoryCache(max_conversations=2)
+    await cache.put("user", "a", "t", [])
+    await cache.put("user", "b", "t", [])
+    await cache.get("user", "a", "t")
+    await cache.put("user", "c", "t", [])
+
+    assert await cache.get("user", "a", "t") == []
+    assert await cache.get("user", "b", "t") is None
+
+
+@pytest.mark.asyncio
+async def test_size_zero_disables_the_cache():
+    cache = ConversationHistoryCache(max_conversations=0)
+    await cache.put("user", "c", "t", [message("1")])
+
+    assert await cache.get("user", "c", "t") is None
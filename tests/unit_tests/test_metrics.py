@@ -0,0 +1,113 @@
+import asyncio
+import contextvars
+import os
+
+import pytest
+
+from backend.metrics import (
+    EventLoopMonitor,
+    MetricsRegistry,
+    event_loop_lag,
+    observe_phase,
+    process_info,
+    process_resident_memory,
+    request_phase_duration,
+    set_request_labels,
+    time_phase,
+)
+
+
+def test_counter_and_histogram_render_prometheus_text():
+    registry = MetricsRegistry()
+    requests = registry.counter("requests_total", "Requests", ("route",))
+    latency = registry.histogram("latency_seconds", "Latency", ("route",), buckets=(0.1, 1.0))
+
+    requests.inc(route="/history/read")
+    requests.inc(2, route="/history/read")
+    latency.observe(0.05, route="/history/read")
+    latency.observe(0.5, route="/history/read")
+    latency.observe(5, route="/history/read")
+
+    lines = registry.render().splitlines()
+    assert "# TYPE requests_total counter" in lines
+    assert 'requests_total{route="/history/read"} 3' in lines
+    assert 'latency_seconds_bucket{route="/history/read",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{route="/history/read",le="1"} 2' in lines
+    assert 'latency_seconds_bucket{route="/history/read",le="+Inf"} 3' in lines
+    assert 'latency_seconds_count{route="/history/read"} 3' in lines
+    assert latency.snapshot(route="/history/read")["sum"] == 5.55
+
+
+def test_label_values_are_escaped():
+    registry = MetricsRegistry()
+    registry.counter("errors_total", "Errors", ("message",)).inc(message='say "hi"\n')
+
+    assert 'errors_total{message="say \\"hi\\"\\n"} 1' in registry.render().splitlines()
+
+
+def test_gauge_renders_last_value():
+    registry = MetricsRegistry()
+    memory = registry.gauge("memory_bytes", "Memory", ("pid",))
+
+    memory.set(10, pid="1")
+    memory.set(7, pid="1")
+
+    lines = registry.render().splitlines()
+    assert "# TYPE memory_bytes gauge" in lines
+    assert 'memory_bytes{pid="1"} 7' in lines
+
+
+def test_register_returns_existing_metric():
+    registry = MetricsRegistry()
+    assert registry.counter("a_total", "A") is registry.counter("a_total", "A")
+
+
+def test_labels_returns_cached_child():
+    registry = MetricsRegistry()
+    latency = registry.histogram("latency_seconds", "Latency", ("route", "method"))
+
+    child = latency.labels("/conversation", "POST")
+    assert latency.labels(route="/conversation", method="POST") is child
+    child.observe(0.2)
+    assert latency.snapshot(route="/conversation", method="POST") == {"count": 1, "sum": 0.2}
+
+    with pytest.raises(ValueError):
+        latency.labels("/conversation")
+
+
+def test_observe_phase_uses_request_labels():
+    def run():
+        observe_phase("graph", 1.0)
+        set_request_labels("/conversation", "AzureCognitiveSearch", "gpt-4o")
+        with time_phase("prepare_model_args"):
+            pass
+        observe_phase("graph", 0.25)
+
+    before = request_phase_duration.snapshot(
+        route="/conversation", datasource="AzureCognitiveSearch", deployment="gpt-4o", phase="graph"
+    )
+    # outside of a request (no labels set) observations are dropped
+    contextvars.copy_context().run(run)
+
+    graph = request_phase_duration.snapshot(
+        route="/conversation", datasource="AzureCognitiveSearch", deployment="gpt-4o", phase="graph"
+    )
+    assert graph["count"] == before["count"] + 1
+    assert graph["sum"] == pytest.approx(before["sum"] + 0.25)
+    assert request_phase_duration.snapshot(
+        route="/conversation", datasource="AzureCognitiveSearch", deployment="gpt-4o", phase="prepare_model_args"
+    )["count"] >= 1
+
+
+@pytest.mark.asyncio
+async def test_event_loop_monitor_records_lag():
+    before = event_loop_lag.snapshot()["count"]
+    monitor = EventLoopMonitor(interval=0.01)
+    monitor.start()
+    await asyncio.sleep(0.05)
+    await monitor.close()
+
+    assert event_loop_lag.snapshot()["count"] > before
+    assert process_info.value(pid=str(os.getpid())) == 1
+    if os.path.exists("/proc/self/statm"):
+        assert process_resident_memory.value() > 0
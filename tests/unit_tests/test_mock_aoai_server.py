@@ -0,0 +1,63 @@
+import httpx
+import openai
+import pytest
+from openai import AsyncAzureOpenAI
+
+from tools.mock_aoai_server import MockSettings, create_app
+
+FAST = dict(ttft_ms=0, tokens_per_second=0, completion_tokens=5, citations=2, citation_bytes=50, seed=1)
+
+
+def client_for(settings: MockSettings) -> AsyncAzureOpenAI:
+    transport = httpx.ASGITransport(app=create_app(settings))
+    return AsyncAzureOpenAI(
+        api_version="2024-05-01-preview",
+        api_key="mock",
+        azure_endpoint="http://mock",
+        max_retries=0,
+        http_client=httpx.AsyncClient(transport=transport, base_url="http://mock"),
+    )
+
+
+@pytest.mark.asyncio
+async def test_streamed_answer_with_citations_and_usage():
+    client = client_for(MockSettings(**FAST))
+    stream = await client.chat.completions.create(
+        model="gpt-mock",
+        messages=[{"role": "user", "content": "hello"}],
+        stream=True,
+        stream_options={"include_usage": True},
+        extra_body={"data_sources": [{"type": "azure_search"}]},
+    )
+
+    chunks = [chunk async for chunk in stream]
+    assert len(chunks[0].choices[0].delta.context["citations"]) == 2
+    content = "".join(chunk.choices[0].delta.content or "" for chunk in chunks if chunk.choices)
+    assert len(content.split()) == 5
+    assert chunks[-1].choices == []
+    assert chunks[-1].usage.completion_tokens == 5
+
+
+@pytest.mark.asyncio
+async def test_complete_answer_and_tool_call():
+    client = client_for(MockSettings(**FAST))
+    completion = await client.chat.completions.create(model="gpt-mock", messages=[{"role": "user", "content": "hi"}])
+    assert completion.choices[0].message.content
+    assert not hasattr(completion.choices[0].message, "context")
+
+    completion = await client.chat.completions.create(
+        model="gpt-mock",
+        messages=[{"role": "user", "content": "weather?"}],
+        tools=[{"type": "function", "function": {"name": "get_weather", "parameters": {"type": "object"}}}],
+    )
+    assert completion.choices[0].message.tool_calls[0].function.name == "get_weather"
+
+
+@pytest.mark.asyncio
+async def test_injected_rate_limit():
+    client = client_for(MockSettings(**{**FAST, "requests_per_minute": 1}))
+    await client.chat.completions.create(model="gpt-mock", messages=[{"role": "user", "content": "hi"}])
+
+    with pytest.raises(openai.RateLimitError) as error:
+        await client.chat.completions.create(model="gpt-mock", messages=[{"role": "user", "content": "hi"}])
+    assert error.value.response.headers["retry-after-ms"] == "1000"
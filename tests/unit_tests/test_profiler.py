@@ -0,0 +1,52 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from backend.profiler import ProfileStore, StackSampler
+
+
+def busy_wait(seconds):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+
+
+@pytest.mark.asyncio
+async def test_sampler_collapses_event_loop_stacks():
+    sampler = StackSampler(asyncio.get_running_loop(), threading.get_ident(), interval=0.001, max_seconds=5).start()
+    busy_wait(0.2)
+    sampler.stop()
+
+    lines = sampler.collapsed().splitlines()
+    stack, count = lines[0].rsplit(" ", 1)
+    assert stack.endswith("busy_wait (tests/unit_tests/test_profiler.py:10)")
+    assert "test_sampler_collapses_event_loop_stacks" in stack
+    assert int(count) > 10
+    assert sampler.done and sampler.samples == sum(int(line.rsplit(" ", 1)[1]) for line in lines)
+
+
+@pytest.mark.asyncio
+async def test_task_profile_only_counts_the_task():
+    async def profiled():
+        await asyncio.sleep(0.05)
+        busy_wait(0.1)
+
+    async def other():
+        await asyncio.sleep(0.2)
+        busy_wait(0.1)
+
+    store = ProfileStore()
+    other_task = asyncio.ensure_future(other())
+    task = asyncio.ensure_future(profiled())
+    profile_id = store.profile_task(task, interval=0.001)
+    await asyncio.gather(task, other_task)
+    await asyncio.sleep(0.05)
+
+    sampler = store.get(profile_id)
+    assert sampler.done
+    stacks = sampler.collapsed()
+    assert "profiled (" in stacks
+    assert "other (" not in stacks
+    store.close()
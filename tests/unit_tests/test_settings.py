@@ -49,8 +49,13 @@ def test_dotenv_with_azure_search_success(app_settings):
     assert payload["type"] == "azure_search"
     assert payload["parameters"] is not None
     assert payload["parameters"]["endpoint"] == "https://search_service.search.windows.net"
+    assert "filter" not in payload["parameters"]
     print(payload)
 
+    # The per-user security filter is sent with the data source parameters
+    payload = app_settings.datasource.construct_payload_configuration(filter_string="groups/any(g:search.in(g, 'a'))")
+    assert payload["parameters"]["filter"] == "groups/any(g:search.in(g, 'a'))"
+
 
 def test_dotenv_with_elasticsearch_success(app_settings):
     # Validate model object
@@ -70,3 +75,20 @@ def test_dotenv_with_elasticsearch_success(app_settings):
     
     
 
+
+
+def test_dotenv_parsed_once(dotenv_path, monkeypatch):
+    import pydantic_settings.sources
+
+    parsed = []
+    dotenv_values = pydantic_settings.sources.dotenv_values
+    monkeypatch.setattr(
+        pydantic_settings.sources,
+        "dotenv_values",
+        lambda *args, **kwargs: parsed.append(args) or dotenv_values(*args, **kwargs)
+    )
+    monkeypatch.setenv("DOTENV_PATH", os.path.join(os.path.dirname(dotenv_path), "dotenv_with_azure_search_success"))
+    settings_module = reload(import_module("backend.settings"))
+
+    assert settings_module.app_settings.datasource.endpoint == "https://search_service.search.windows.net"
+    assert len(parsed) == 1
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+from backend.stream_replay import ReplayBufferStore, StreamOffsetExpiredError
+
+
+async def lines(count, delay=0.0):
+    for i in range(count):
+        if delay:
+            await asyncio.sleep(delay)
+        yield f"{i}\n"
+
+
+async def read_all(buffer, offset=0):
+    return [line async for line in buffer.read(offset)]
+
+
+@pytest.mark.asyncio
+async def test_resume_from_offset_after_completion():
+    store = ReplayBufferStore()
+    buffer = store.start("user", lines(5))
+
+    assert await read_all(buffer) == ["0\n", "1\n", "2\n", "3\n", "4\n"]
+    assert await read_all(store.get(buffer.stream_id), 3) == ["3\n", "4\n"]
+
+
+@pytest.mark.asyncio
+async def test_resume_follows_live_tail():
+    store = ReplayBufferStore()
+    buffer = store.start("user", lines(6, delay=0.01))
+
+    first = buffer.read(0)
+    received = [await first.__anext__(), await first.__anext__()]
+    await first.aclose()
+
+    ## a second connection picks up where the first one stopped
+    received += await read_all(buffer, len(received))
+    assert received == [f"{i}\n" for i in range(6)]
+
+
+@pytest.mark.asyncio
+async def test_ring_buffer_drops_oldest_lines():
+    store = ReplayBufferStore(max_lines=3)
+    buffer = store.start("user", lines(5))
+    await asyncio.sleep(0.01)
+
+    assert buffer.first_offset == 2
+    assert await read_all(buffer, 2) == ["2\n", "3\n", "4\n"]
+    with pytest.raises(StreamOffsetExpiredError):
+        await read_all(buffer, 0)
+
+
+@pytest.mark.asyncio
+async def test_generation_cancelled_when_nobody_reads():
+    cancelled = asyncio.Event()
+
+    async def endless():
+        try:
+            while True:
+                await asyncio.sleep(0.01)
+                yield "line\n"
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    store = ReplayBufferStore(idle_timeout=0.05)
+    buffer = store.start("user", endless())
+    reader = buffer.read(0)
+    await reader.__anext__()
+    await reader.aclose()
+
+    await asyncio.wait_for(cancelled.wait(), 1)
+    await asyncio.sleep(0)
+    assert buffer.done
+
+
+@pytest.mark.asyncio
+async def test_finished_buffers_expire():
+    store = ReplayBufferStore(ttl=0)
+    buffer = store.start("user", lines(1))
+    await read_all(buffer)
+    await asyncio.sleep(0.01)
+
+    assert store.get(buffer.stream_id) is None
@@ -0,0 +1,123 @@
+import asyncio
+import os
+import time
+
+import pytest
+from azure.core.credentials import AccessToken
+
+from backend import token_cache
+from backend.token_cache import SharedTokenCredential
+
+SCOPE = "https://cognitiveservices.azure.com/.default"
+
+
+class FakeCredential():
+    def __init__(self, lifetime=3600):
+        self.lifetime = lifetime
+        self.calls = 0
+        self.error = None
+
+    async def get_token(self, *scopes, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        if self.error:
+            raise self.error
+        return AccessToken(f"token-{self.calls}", int(time.time()) + self.lifetime)
+
+    async def close(self):
+        pass
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(token_cache.fcntl is None, reason="tokens are only shared through flock")
+async def test_workers_share_tokens(tmp_path):
+    credential = FakeCredential()
+    directory = str(tmp_path / "tokens")
+    first = SharedTokenCredential(credential, directory)
+    second = SharedTokenCredential(credential, directory)
+
+    assert (await first.get_token(SCOPE)).token == "token-1"
+    assert (await second.get_token(SCOPE)).token == "token-1"
+    assert credential.calls == 1
+
+    assert oct(os.stat(directory).st_mode & 0o777) == "0o700"
+    token_files = [name for name in os.listdir(directory) if name.endswith(".json")]
+    assert oct(os.stat(os.path.join(directory, token_files[0])).st_mode & 0o777) == "0o600"
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(token_cache.fcntl is None, reason="tokens are only shared through flock")
+async def test_identities_do_not_share_tokens(tmp_path):
+    credential = FakeCredential()
+    directory = str(tmp_path / "tokens")
+    app = SharedTokenCredential(credential, directory, identity="app")
+    other_app = SharedTokenCredential(credential, directory, identity="other-app")
+
+    assert (await app.get_token(SCOPE)).token == "token-1"
+    assert (await other_app.get_token(SCOPE)).token == "token-2"
+    assert credential.calls == 2
+
+
+def test_default_identity_follows_the_client_id(monkeypatch):
+    monkeypatch.setenv("AZURE_CLIENT_ID", "first")
+    first = token_cache.default_identity()
+    monkeypatch.setenv("AZURE_CLIENT_ID", "second")
+
+    assert token_cache.default_identity() != first
+
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_share_one_refresh(tmp_path):
+    credential = FakeCredential()
+    shared = SharedTokenCredential(credential, str(tmp_path))
+
+    tokens = await asyncio.gather(*(shared.get_token(SCOPE) for _ in range(10)))
+
+    assert {token.token for token in tokens} == {"token-1"}
+    assert credential.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_refreshes_before_expiry_in_background(tmp_path):
+    credential = FakeCredential()
+    shared = SharedTokenCredential(credential, str(tmp_path), refresh_margin=600)
+    await shared.get_token(SCOPE)
+
+    ## the token is due for a refresh but still valid
+    key = shared._key((SCOPE,), None, {})
+    shared._tokens[key] = (shared._tokens[key][0], time.time() - 1)
+    ## and not in the shared file, when there is one (not on Windows)
+    for name in os.listdir(tmp_path):
+        if name.endswith(".json"):
+            os.remove(os.path.join(str(tmp_path), name))
+
+    assert (await shared.get_token(SCOPE)).token == "token-1"
+    await shared._refreshing[key]
+    assert (await shared.get_token(SCOPE)).token == "token-2"
+
+
+@pytest.mark.asyncio
+async def test_failed_refresh_keeps_the_current_token():
+    credential = FakeCredential()
+    shared = SharedTokenCredential(credential, directory=None)
+    await shared.get_token(SCOPE)
+
+    key = shared._key((SCOPE,), None, {})
+    shared._tokens[key] = (shared._tokens[key][0], time.time() - 1)
+    credential.error = ConnectionError("no route to login.microsoftonline.com")
+
+    assert (await shared.get_token(SCOPE)).token == "token-1"
+    with pytest.raises(ConnectionError):
+        await shared._refreshing[key]
+    ## not retried on every request
+    assert (await shared.get_token(SCOPE)).token == "token-1"
+    assert credential.calls == 2
+
+
+@pytest.mark.asyncio
+async def test_short_lived_tokens_refresh_halfway(tmp_path):
+    shared = SharedTokenCredential(FakeCredential(lifetime=300), str(tmp_path), refresh_margin=600)
+    token = await shared.get_token(SCOPE)
+
+    _, refresh_at = shared._tokens[shared._key((SCOPE,), None, {})]
+    assert token.expires_on - refresh_at == pytest.approx(150, abs=2)
@@ -0,0 +1,96 @@
+import pytest
+from azure.cosmos import exceptions
+
+from backend.history.cosmosdbservice import CosmosConversationClient
+from tools.mock_cosmosdb import InMemoryCosmosClient
+from backend.history.memoryservice import InMemoryConversationClient
+from backend.usage import UsageAccumulator, usage_counts
+
+
+def test_usage_counts_reads_cached_tokens():
+    assert usage_counts({"prompt_tokens": 100, "completion_tokens": 20}) == (100, 0, 20)
+    assert usage_counts({
+        "prompt_tokens": 100,
+        "completion_tokens": 20,
+        "prompt_tokens_details": {"cached_tokens": 64},
+    }) == (100, 64, 20)
+
+
+def test_record_aggregates_per_user_and_conversation():
+    accumulator = UsageAccumulator()
+    accumulator.record("user", "c1", {"prompt_tokens": 100, "completion_tokens": 20})
+    accumulator.record("user", "c1", {"prompt_tokens": 50, "completion_tokens": 10})
+    accumulator.record("user", None, {"prompt_tokens": 5, "completion_tokens": 1})
+    accumulator.record("user", "c1", None)
+    accumulator.record(None, "c1", {"prompt_tokens": 5, "completion_tokens": 1})
+
+    records = {r["conversationId"]: r for r in accumulator.drain()}
+    assert records["c1"]["promptTokens"] == 150
+    assert records["c1"]["completionTokens"] == 30
+    assert records["c1"]["requests"] == 2
+    assert records[None]["requests"] == 1
+    assert accumulator.pending() == 0
+
+
+class FailingStore():
+    async def add_usage(self, records):
+        raise RuntimeError("store unavailable")
+
+
+@pytest.mark.asyncio
+async def test_failed_flush_keeps_counts():
+    accumulator = UsageAccumulator()
+    accumulator.record("user", "c1", {"prompt_tokens": 100, "completion_tokens": 20})
+
+    await accumulator.flush(FailingStore())
+    accumulator.record("user", "c1", {"prompt_tokens": 1, "completion_tokens": 1})
+
+    store = InMemoryConversationClient()
+    await accumulator.flush(store)
+    [usage] = await store.get_usage("user")
+    assert usage["promptTokens"] == 101
+    assert usage["requests"] == 2
+
+
+@pytest.mark.asyncio
+async def test_partially_failed_flush_retries_only_the_failed_records():
+    store = CosmosConversationClient(
+        cosmosdb_endpoint="https://dummy",
+        credential="key",
+        database_name="db",
+        container_name="conversations",
+        cosmosdb_client=InMemoryCosmosClient(),
+    )
+    create_item = store.container_client.create_item
+
+    async def fail_for_c2(body, **kwargs):
+        if body.get("conversationId") == "c2":
+            raise exceptions.CosmosHttpResponseError(status_code=503, message="service unavailable")
+        return await create_item(body, **kwargs)
+
+    store.container_client.create_item = fail_for_c2
+    accumulator = UsageAccumulator()
+    for conversation_id in ("c1", "c2", "c3"):
+        accumulator.record("user", conversation_id, {"prompt_tokens": 100, "completion_tokens": 20})
+
+    await accumulator.flush(store)
+    assert accumulator.pending() == 1
+
+    store.container_client.create_item = create_item
+    await accumulator.flush(store)
+    usage = {u["conversationId"]: u for u in await store.get_usage("user")}
+    assert {conversation_id: u["promptTokens"] for conversation_id, u in usage.items()} == {"c1": 100, "c2": 100, "c3": 100}
+    await store.close()
+
+
+@pytest.mark.asyncio
+async def test_close_flushes_pending_counts():
+    store = InMemoryConversationClient()
+    accumulator = UsageAccumulator(flush_interval=3600)
+    accumulator.start(store)
+    accumulator.record("user", "c1", {"prompt_tokens": 100, "completion_tokens": 20})
+
+    await accumulator.close()
+
+    [usage] = await store.get_usage()
+    assert usage["promptTokens"] == 100
@@ -1,5 +1,7 @@
+from types import SimpleNamespace
+
 import pytest
-from backend.utils import format_as_ndjson, parse_multi_columns
+from backend.utils import AssembledAnswer, format_as_ndjson, format_non_streaming_response, parse_multi_columns
 
 
 @pytest.mark.asyncio
@@ -20,6 +22,23 @@ async def test_format_as_ndjson_exception():
     async for event in format_as_ndjson(dummy_generator()):
         assert event == '{"error": "test exception"}'
 
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_closes_source_when_closed():
+    closed = []
+
+    async def dummy_generator():
+        try:
+            yield {"message": "first"}
+            yield {"message": "second"}
+        finally:
+            closed.append(True)
+
+    stream = format_as_ndjson(dummy_generator())
+    assert await stream.__anext__() == '{"message": "first"}\n'
+    await stream.aclose()
+    assert closed == [True]
+
 def test_parse_multi_columns():
     test_pipes = "col1|col2|col3"
     test_commas = "col1,col2,col3"
@@ -27,3 +46,29 @@ def test_parse_multi_columns():
     assert parse_multi_columns(test_pipes) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_commas) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_single) == ["col1"]
+
+
+def test_assembled_answer_from_stream_responses():
+    answer = AssembledAnswer()
+    answer.add({"id": "c1", "choices": [{"messages": [{"role": "tool", "content": '{"citations": []}'}]}]})
+    answer.add({"id": "c1", "choices": [{"messages": [{"role": "assistant", "content": "Hello"}]}]})
+    answer.add({})
+    answer.add({"id": "c1", "choices": [{"messages": [{"role": "assistant", "content": " world"}]}]})
+
+    assert answer.tool_message == {"role": "tool", "content": '{"citations": []}'}
+    assert answer.assistant_message == {"id": "c1", "role": "assistant", "content": "Hello world"}
+
+
+def test_non_streaming_response_carries_usage():
+    completion = SimpleNamespace(
+        id="c1",
+        model="gpt-4o",
+        created=0,
+        object="chat.completion",
+        usage=SimpleNamespace(prompt_tokens=12, completion_tokens=4, prompt_tokens_details=SimpleNamespace(cached_tokens=8)),
+        choices=[SimpleNamespace(message=SimpleNamespace(content="Hello"))],
+    )
+
+    response = format_non_streaming_response(completion, {}, "apim-id")
+    assert response["usage"] == {"prompt_tokens": 12, "cached_tokens": 8, "completion_tokens": 4}
+    assert response["choices"][0]["messages"] == [{"role": "assistant", "content": "Hello"}]
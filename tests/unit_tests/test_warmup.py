@@ -0,0 +1,48 @@
+import asyncio
+import time
+
+import pytest
+
+from backend.warmup import Warmup, warmup_duration
+
+
+@pytest.mark.asyncio
+async def test_steps_run_concurrently():
+    warmup = Warmup(timeout=1)
+    for dependency in ("azure_openai", "chat_history", "datasource"):
+        warmup.add(dependency, lambda: asyncio.sleep(0.1))
+
+    started = time.monotonic()
+    results = await warmup.run()
+
+    assert time.monotonic() - started < 0.25
+    assert warmup.done
+    assert all(result["ok"] for result in results.values())
+    assert warmup_duration.value(dependency="chat_history") >= 0.1
+
+
+@pytest.mark.asyncio
+async def test_failed_and_slow_steps_are_reported():
+    async def fail():
+        raise ConnectionError("name resolution failed")
+
+    warmup = Warmup(timeout=0.05)
+    warmup.add("datasource", fail)
+    warmup.add("chat_history", lambda: asyncio.sleep(1))
+    warmup.add("azure_openai", lambda: asyncio.sleep(0))
+
+    results = await warmup.run()
+
+    assert results["datasource"] == {"ok": False, "seconds": results["datasource"]["seconds"], "error": "name resolution failed"}
+    assert results["chat_history"]["error"] == "timed out after 0.05s"
+    assert results["chat_history"]["seconds"] < 0.5
+    assert results["azure_openai"]["ok"]
+
+
+@pytest.mark.asyncio
+async def test_disabled():
+    warmup = Warmup(timeout=0)
+    warmup.add("azure_openai", lambda: asyncio.sleep(1))
+
+    assert await warmup.run() == {}
+    assert warmup.done
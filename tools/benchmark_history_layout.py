@@ -0,0 +1,267 @@
+"""
+Compare request units and latency of the chat history storage layouts
+(AZURE_COSMOSDB_LAYOUT=items vs embedded) on the same workload.
+
+By default the workload runs against an in-memory stand-in for Cosmos DB
+that estimates request charges and adds --latency-ms per round trip. Pass
+--emulator (or --endpoint/--key) to run it against the Cosmos DB emulator or
+a real account, where the charges come from the x-ms-request-charge headers;
+a temporary container is created and deleted for each layout.
+
+    python tools/benchmark_history_layout.py --conversations 20 --messages 40
+    python tools/benchmark_history_layout.py --emulator --output results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+
+from azure.cosmos import PartitionKey
+from azure.cosmos.aio import CosmosClient
+
+# Add parent directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.cosmosdbembeddedservice import CosmosEmbeddedConversationClient
+from tools.mock_cosmosdb import InMemoryCosmosClient
+
+EMULATOR_ENDPOINT = "https://localhost:8081"
+# Well-known key of the local Cosmos DB emulator
+EMULATOR_KEY = "C2y6yDjf5/R+ob0N8A7Cgv30VRDJIWEHLM+4QDU5DE2nQ9nDuVTqobD4b8mGGyPMbIZnqyMsEcaGQy67XIw/Jw=="
+
+LAYOUTS = {
+    "items": CosmosConversationClient,
+    "embedded": CosmosEmbeddedConversationClient,
+}
+
+
+class RequestChargeMeter():
+    """Sums the request charge of every Cosmos DB response, used as a raw_response_hook."""
+
+    def __init__(self):
+        self.total = 0.0
+        self.requests = 0
+
+    def __call__(self, pipeline_response):
+        charge = pipeline_response.http_response.headers.get("x-ms-request-charge")
+        if charge:
+            self.total += float(charge)
+        self.requests += 1
+
+
+class InMemoryChargeMeter():
+    def __init__(self, container_client):
+        self.container_client = container_client
+
+    @property
+    def total(self):
+        return self.container_client.request_charge_total
+
+    @property
+    def requests(self):
+        return self.container_client.request_count
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class PhaseRecorder():
+    def __init__(self, meter):
+        self.meter = meter
+        self.phases = {}
+
+    async def run(self, phase, operations):
+        """Run the (sequential) coroutine factories of a phase and record charge and latency."""
+        charge_before, requests_before = self.meter.total, self.meter.requests
+        latencies = []
+        for operation in operations:
+            start = time.perf_counter()
+            await operation()
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        charge = self.meter.total - charge_before
+        self.phases[phase] = {
+            "operations": len(latencies),
+            "requests": self.meter.requests - requests_before,
+            "request_units": round(charge, 2),
+            "request_units_per_operation": round(charge / len(latencies), 2) if latencies else None,
+            "latency_ms_p50": round(statistics.median(latencies), 2) if latencies else None,
+            "latency_ms_p95": round(percentile(latencies, 95), 2) if latencies else None,
+        }
+
+
+async def run_workload(client, meter, args):
+    recorder = PhaseRecorder(meter)
+    users = [f"benchmark-user-{i}" for i in range(args.users)]
+    conversations = []
+
+    async def create_conversation(user_id):
+        conversation = await client.create_conversation(user_id=user_id, title="benchmark")
+        conversations.append((user_id, conversation["id"]))
+
+    await recorder.run(
+        "create_conversation",
+        [lambda u=users[i % len(users)]: create_conversation(u) for i in range(args.conversations)]
+    )
+
+    content = "x" * args.message_bytes
+    message_ids = {}
+
+    def create_message(user_id, conversation_id, index):
+        message_id = str(uuid.uuid4())
+        message_ids[conversation_id] = message_id
+        return client.create_message(
+            uuid=message_id,
+            conversation_id=conversation_id,
+            user_id=user_id,
+            input_message={"role": "user" if index % 2 == 0 else "assistant", "content": content},
+        )
+
+    await recorder.run(
+        "create_message",
+        [
+            lambda u=user_id, c=conversation_id, i=index: create_message(u, c, i)
+            for index in range(args.messages)
+            for user_id, conversation_id in conversations
+        ]
+    )
+
+    await recorder.run(
+        "list_conversations",
+        [lambda u=user_id: client.get_conversations(u, offset=0, limit=25) for user_id in users]
+    )
+
+    async def read_conversation(user_id, conversation_id):
+        # what /history/read does
+        await client.get_conversation(user_id, conversation_id)
+        await client.get_messages(user_id, conversation_id)
+
+    await recorder.run(
+        "read_conversation",
+        [lambda u=user_id, c=conversation_id: read_conversation(u, c) for user_id, conversation_id in conversations]
+    )
+
+    await recorder.run(
+        "read_first_page",
+        [
+            lambda u=user_id, c=conversation_id: client.get_messages_page(u, c, page_size=25)
+            for user_id, conversation_id in conversations
+        ]
+    )
+
+    await recorder.run(
+        "message_feedback",
+        [
+            lambda u=user_id, c=conversation_id: client.update_message_feedback(u, message_ids[c], "positive")
+            for user_id, conversation_id in conversations
+        ]
+    )
+
+    async def delete_conversation(user_id, conversation_id):
+        # what /history/delete does
+        await client.delete_messages(conversation_id, user_id)
+        await client.delete_conversation(user_id, conversation_id)
+
+    await recorder.run(
+        "delete_conversation",
+        [lambda u=user_id, c=conversation_id: delete_conversation(u, c) for user_id, conversation_id in conversations]
+    )
+
+    return recorder.phases
+
+
+async def benchmark_layout(layout, args):
+    container_name = f"benchmark-{layout}-{uuid.uuid4().hex[:8]}"
+    client_kwargs = {"embedded_max_bytes": args.embedded_max_bytes} if layout == "embedded" else {}
+
+    if not args.endpoint:
+        cosmosdb_client = InMemoryCosmosClient(latency=args.latency_ms / 1000)
+        client = LAYOUTS[layout](
+            cosmosdb_endpoint="in-memory",
+            credential=None,
+            database_name=args.database,
+            container_name=container_name,
+            enable_message_feedback=True,
+            cosmosdb_client=cosmosdb_client,
+            **client_kwargs
+        )
+        return await run_workload(client, InMemoryChargeMeter(client.container_client), args)
+
+    meter = RequestChargeMeter()
+    cosmosdb_client = CosmosClient(
+        args.endpoint,
+        credential=args.key,
+        raw_response_hook=meter,
+        connection_verify=not args.emulator,
+    )
+    database = await cosmosdb_client.create_database_if_not_exists(args.database)
+    await database.create_container_if_not_exists(container_name, partition_key=PartitionKey(path="/userId"))
+    try:
+        client = LAYOUTS[layout](
+            cosmosdb_endpoint=args.endpoint,
+            credential=args.key,
+            database_name=args.database,
+            container_name=container_name,
+            enable_message_feedback=True,
+            cosmosdb_client=cosmosdb_client,
+            **client_kwargs
+        )
+        return await run_workload(client, meter, args)
+    finally:
+        await database.delete_container(container_name)
+        await cosmosdb_client.close()
+
+
+def print_results(results):
+    phases = list(next(iter(results.values())).keys())
+    print(f"{'phase':<22}" + "".join(f"{layout + ' RU/op':>18}{layout + ' p50 ms':>18}" for layout in results))
+    for phase in phases:
+        row = f"{phase:<22}"
+        for layout in results:
+            stats = results[layout][phase]
+            row += f"{stats['request_units_per_operation']:>18}{stats['latency_ms_p50']:>18}"
+        print(row)
+
+
+async def main(args):
+    results = {}
+    for layout in args.layouts:
+        results[layout] = await benchmark_layout(layout, args)
+
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"parameters": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--layouts", nargs="+", choices=list(LAYOUTS), default=list(LAYOUTS))
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--conversations", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=40, help="Messages written to each conversation")
+    parser.add_argument("--message-bytes", type=int, default=800)
+    parser.add_argument("--embedded-max-bytes", type=int, default=64 * 1024)
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="Simulated round trip of the in-memory stand-in")
+    parser.add_argument("--emulator", action="store_true", help="Run against the local Cosmos DB emulator")
+    parser.add_argument("--endpoint", help="Cosmos DB account endpoint to run against")
+    parser.add_argument("--key", help="Cosmos DB account key")
+    parser.add_argument("--database", default="benchmark")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    if args.emulator:
+        args.endpoint = args.endpoint or EMULATOR_ENDPOINT
+        args.key = args.key or EMULATOR_KEY
+
+    asyncio.run(main(args))
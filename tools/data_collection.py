@@ -1,110 +1,246 @@
-import os
-import sys
+"""
+Collect answers to a set of questions for evaluation in Azure AI Studio.
+
+Every question of the input file is answered through the app's own
+``complete_chat_request``, with the settings of the .env file (or of
+--env-file), several at a time. Each answer is appended to the output JSONL
+as soon as it completes, with its citations, latency and token usage, so an
+interrupted run continues where it stopped when started again with the same
+output file: questions already in it are skipped, matched by hash. Rate
+limited (429) and transient errors are retried after the delay the service
+asks for, which also holds back the other workers.
+
+Input format:
+
+    [
+      {
+        "qa_pairs": [{"question": "...", "answer": "..."}]
+      }
+    ]
+
+    python tools/data_collection.py qa_input_file.json evaluation_data.jsonl --concurrency 8
+    python tools/data_collection.py qa_input_file.json evaluation_data.jsonl --requests-per-minute 60
+"""
+import argparse
 import asyncio
+import hashlib
 import json
+import logging
+import os
+import sys
+import time
 
-from dotenv import load_dotenv
-
-#import the app.py module to gain access to the methods to construct payloads and
-#call the API through the sdk
+import openai
 
 # Add parent directory to sys.path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-import app
-
-#function to enable loading of the .env file into the global variables of the app.py module
-
-def load_env_into_module(module_name, prefix=''):
-    load_dotenv()
-    module = __import__(module_name)
-    for key, value in os.environ.items():
-        if key.startswith(prefix):
-            setattr(module, key[len(prefix):], value)
-
-load_env_into_module("app")
-
-#some settings required in app.py
-
-app.SHOULD_STREAM = False
-app.SHOULD_USE_DATA = app.should_use_data()
-
-#format:
-"""
-[
-  {
-    "qa_pairs":[{"question":"...", "answer":"..."}]
-  }
-]
-"""
-
-generated_data_path = r"path/to/qa_input_file.json"
-
-with open(generated_data_path, 'r') as file:
-    data = json.load(file)
-
-
-"""
-Process a list of q(and a) pairs outputting to a file as we go.
-"""
-async def process(data: list, file):
-  for qa_pairs_obj in data:
-      qa_pairs = qa_pairs_obj["qa_pairs"]
-      for qa_pair in qa_pairs:
-          question = qa_pair["question"]
-          messages = [{"role":"user", "content":question}]
-
-          print("processing question "+question)
-
-          request = {"messages":messages, "id":"1"}
-
-          response = await app.complete_chat_request(request)
-
-          #print(json.dumps(response))
-
-          messages = response["choices"][0]["messages"]
-
-          tool_message = None
-          assistant_message = None
-
-          for message in messages:
-            if message["role"] == "tool":
-              tool_message = message["content"]
-            elif message["role"] == "assistant":
-              assistant_message = message["content"]
-            else:
-              raise ValueError("unknown message role")
-
-          #construct data for ai studio evaluation
-
-          user_message = {"role":"user", "content":question}
-          assistant_message = {"role":"assistant", "content":assistant_message}
-
-          #prepare citations
-          citations = json.loads(tool_message)
-          assistant_message["context"] = citations
-
-          #create output
-          messages = []
-          messages.append(user_message)
-          messages.append(assistant_message)
-
-          evaluation_data = {"messages":messages}
-
-          #incrementally write out to the jsonl file
-          file.write(json.dumps(evaluation_data)+"\n")
-          file.flush()
-
-
-evaluation_data_file_path = r"path/to/output_file.jsonl"  
-
-with open(evaluation_data_file_path, "w") as file:
-  asyncio.run(process(data, file))
-
-
-
-
-
-
-
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+
+def question_hash(question: str) -> str:
+    return hashlib.sha256(question.strip().encode()).hexdigest()[:16]
 
+
+def load_questions(path):
+    """Return the ``(hash, question, answer)`` of every distinct question of the input file."""
+    with open(path, 'r') as file:
+        data = json.load(file)
+
+    questions = {}
+    for qa_pairs_obj in data:
+        for qa_pair in qa_pairs_obj["qa_pairs"]:
+            questions.setdefault(question_hash(qa_pair["question"]), (qa_pair["question"], qa_pair.get("answer")))
+
+    return [(key, question, answer) for key, (question, answer) in questions.items()]
+
+
+def load_completed(path) -> set:
+    """Return the hashes of the questions already answered in an existing output file."""
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+
+    with open(path, 'r') as file:
+        for line in file:
+            try:
+                completed.add(json.loads(line)["question_hash"])
+            except (ValueError, KeyError):
+                # a line cut short by an interrupted run, its question is asked again
+                continue
+
+    return completed
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def retry_after(error, attempt) -> float:
+    """Seconds to wait before retrying, as asked by the service or with exponential backoff."""
+    response = getattr(error, "response", None)
+    if response is not None:
+        if response.headers.get("retry-after-ms"):
+            return float(response.headers["retry-after-ms"]) / 1000
+        if response.headers.get("retry-after"):
+            try:
+                return float(response.headers["retry-after"])
+            except ValueError:
+                pass
+    return min(60.0, 2.0 ** attempt)
+
+
+class Pacer():
+    """Spaces request starts to stay under a requests-per-minute budget, shared by all workers."""
+
+    def __init__(self, requests_per_minute: float = 0):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute > 0 else 0.0
+        self._next_start = 0.0
+
+    async def wait(self):
+        now = time.monotonic()
+        start = max(now, self._next_start)
+        self._next_start = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    def hold(self, seconds: float):
+        ## a rate limited request holds back every worker, not only the one that got the 429
+        self._next_start = max(self._next_start, time.monotonic() + seconds)
+
+
+def evaluation_record(key, question, ground_truth, response, latency):
+    tool_message = None
+    assistant_message = None
+    for message in response["choices"][0]["messages"]:
+        if message["role"] == "tool":
+            tool_message = message["content"]
+        elif message["role"] == "assistant":
+            assistant_message = message["content"]
+        else:
+            raise ValueError("unknown message role")
+
+    #construct data for ai studio evaluation
+    assistant = {"role": "assistant", "content": assistant_message}
+    if tool_message:
+        assistant["context"] = json.loads(tool_message)
+
+    record = {
+        "messages": [{"role": "user", "content": question}, assistant],
+        "question_hash": key,
+        "latency": latency,
+        "usage": response.get("usage"),
+    }
+    if ground_truth is not None:
+        record["ground_truth"] = ground_truth
+    return record
+
+
+class Collector():
+    def __init__(self, app, output, pacer: Pacer, max_retries: int):
+        self.app = app
+        self.output = output
+        self.pacer = pacer
+        self.max_retries = max_retries
+        self.latencies = []
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.failed = 0
+
+    async def answer(self, question):
+        for attempt in range(self.max_retries + 1):
+            await self.pacer.wait()
+            start = time.perf_counter()
+            try:
+                request = {"messages": [{"role": "user", "content": question}]}
+                response = await self.app.complete_chat_request(request, {})
+                return response, time.perf_counter() - start
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = retry_after(e, attempt)
+                logging.warning(f"{type(e).__name__}, retrying in {delay:.1f}s")
+                self.pacer.hold(delay)
+
+    async def worker(self, queue: asyncio.Queue):
+        while True:
+            try:
+                key, question, ground_truth = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+
+            try:
+                response, latency = await self.answer(question)
+                record = evaluation_record(key, question, ground_truth, response, latency)
+            except Exception:
+                ## not written to the output, a later run asks it again
+                logging.exception(f"Failed to answer question {key}: {question}")
+                self.failed += 1
+                continue
+
+            #incrementally write out to the jsonl file
+            self.output.write(json.dumps(record) + "\n")
+            self.output.flush()
+            self.latencies.append(latency)
+            usage = record["usage"] or {}
+            self.prompt_tokens += usage.get("prompt_tokens", 0)
+            self.completion_tokens += usage.get("completion_tokens", 0)
+            logging.info(f"Answered question {key} in {latency:.2f}s")
+
+
+def print_summary(collector: Collector, skipped: int, elapsed: float):
+    answered = len(collector.latencies)
+    print(f"Answered {answered} questions, skipped {skipped} already answered, {collector.failed} failed, in {elapsed:.1f}s")
+    if not answered:
+        return
+
+    print(f"Throughput: {answered / elapsed:.2f} questions/s, {collector.completion_tokens / elapsed:.1f} completion tokens/s")
+    print(
+        "Latency: "
+        + ", ".join(f"p{pct} {percentile(collector.latencies, pct):.2f}s" for pct in (50, 95, 99))
+        + f", max {max(collector.latencies):.2f}s"
+    )
+    print(f"Tokens: {collector.prompt_tokens} prompt, {collector.completion_tokens} completion")
+
+
+async def main(args):
+    if args.env_file:
+        os.environ["DOTENV_PATH"] = os.path.abspath(args.env_file)
+    # imported here, the app reads its settings from DOTENV_PATH when it is imported
+    import app
+
+    questions = load_questions(args.input)
+    completed = load_completed(args.output)
+    queue = asyncio.Queue()
+    for key, question, answer in questions:
+        if key not in completed:
+            queue.put_nowait((key, question, answer))
+    skipped = len(questions) - queue.qsize()
+
+    start = time.perf_counter()
+    with open(args.output, 'a') as output:
+        collector = Collector(app, output, Pacer(args.requests_per_minute), args.max_retries)
+        await asyncio.gather(*(collector.worker(queue) for _ in range(max(1, args.concurrency))))
+    await app.close_openai_client()
+
+    print_summary(collector, skipped, time.perf_counter() - start)
+    return 1 if collector.failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="JSON file with the qa_pairs to ask")
+    parser.add_argument("output", help="JSONL file the evaluation data is appended to; questions already in it are skipped")
+    parser.add_argument("--env-file", help="Read the app settings from this file instead of .env")
+    parser.add_argument("--concurrency", type=int, default=4, help="Questions answered at the same time")
+    parser.add_argument("--requests-per-minute", type=float, default=0, help="Most chat requests started per minute, 0 for no limit")
+    parser.add_argument("--max-retries", type=int, default=5, help="Retries of a question after a 429 or a transient error")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    sys.exit(asyncio.run(main(args)))
@@ -0,0 +1,380 @@
+"""
+End-to-end load test of the app under gunicorn and uvicorn workers, against mocked upstreams.
+
+Starts tools/mock_aoai_server.py, then for every combination of --workers
+and --stream starts the app with gunicorn.conf.py (WEB_CONCURRENCY set to
+the worker count, SQLite chat history in a temporary file) and drives it
+with --concurrency virtual users for --duration seconds. Each virtual user
+keeps asking /conversation, or starts a conversation with /history/generate
+and reads it back with /history/read and /history/list.
+
+The report gives the throughput, the latency percentiles of every route,
+the time to first answer line of streamed answers, and the event loop lag
+and resident memory of every worker, read from /metrics. Write it with
+--output and compare a later run with --baseline:
+
+    python tools/load_test.py --workers 1,2,4 --stream on,off --concurrency 32 --duration 30 --output load.json
+    python tools/load_test.py --workers 2 --stream on --baseline load.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+
+import httpx
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+_SAMPLE_RE = re.compile(r'^(?P<name>[a-z_]+)(?:\{(?P<labels>[^}]*)\})? (?P<value>\S+)$')
+_LABEL_RE = re.compile(r'(\w+)="([^"]*)"')
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def parse_metrics(text):
+    """Return ``{name: [(labels, value)]}`` of a Prometheus text exposition."""
+    samples = defaultdict(list)
+    for line in text.splitlines():
+        match = _SAMPLE_RE.match(line)
+        if match:
+            labels = dict(_LABEL_RE.findall(match.group("labels") or ""))
+            samples[match.group("name")].append((labels, float(match.group("value"))))
+    return samples
+
+
+def histogram_quantile(buckets, quantile):
+    """Upper bound of the bucket holding ``quantile`` of the observations, from (le, cumulative count) pairs."""
+    buckets = sorted(buckets)
+    if not buckets or buckets[-1][1] == 0:
+        return None
+    target = quantile * buckets[-1][1]
+    for bound, count in buckets:
+        if count >= target:
+            return bound
+    return buckets[-1][0]
+
+
+async def wait_until_ready(url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"{' '.join(process.args)} exited with {process.returncode}")
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} was not ready after {timeout}s")
+
+
+def start_mock_server(port, ttft_ms, tokens_per_second, completion_tokens):
+    return subprocess.Popen([
+        sys.executable, os.path.join(ROOT, "tools", "mock_aoai_server.py"), "--port", str(port),
+        "--ttft-ms", str(ttft_ms), "--tokens-per-second", str(tokens_per_second),
+        "--completion-tokens", str(completion_tokens),
+    ])
+
+
+def start_app(port, mock_url, workers, stream, directory):
+    """Start the app under gunicorn with gunicorn.conf.py, answering from the mock server and keeping history in ``directory``."""
+    env = {
+        **os.environ,
+        "DOTENV_PATH": os.devnull,
+        "WEB_CONCURRENCY": str(workers),
+        "AZURE_OPENAI_ENDPOINT": mock_url,
+        "AZURE_OPENAI_KEY": "mock",
+        "AZURE_OPENAI_MODEL": "gpt-mock",
+        "AZURE_OPENAI_STREAM": "true" if stream else "false",
+        "AZURE_OPENAI_STREAM_INCLUDE_USAGE": "true",
+        "METRICS_ENABLED": "true",
+        "CHAT_HISTORY_BACKEND": "sqlite",
+        "CHAT_HISTORY_SQLITE_PATH": os.path.join(directory, "chat_history.db"),
+    }
+    return subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "app:app", "-c", "gunicorn.conf.py",
+         "--bind", f"127.0.0.1:{port}", "--log-level", "warning"],
+        cwd=ROOT, env=env,
+    )
+
+
+def stop(process):
+    if process.poll() is None:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+class Recorder():
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.first_lines = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def summary(self, duration):
+        routes = {}
+        for route in sorted(set(self.latencies) | set(self.errors)):
+            latencies = self.latencies[route]
+            routes[route] = {
+                "requests": len(latencies),
+                "errors": self.errors[route],
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+            }
+            if self.first_lines[route]:
+                routes[route]["ttft_p50"] = percentile(self.first_lines[route], 50)
+                routes[route]["ttft_p99"] = percentile(self.first_lines[route], 99)
+        requests = sum(len(latencies) for latencies in self.latencies.values())
+        return {
+            "requests": requests,
+            "errors": sum(self.errors.values()),
+            "throughput": requests / duration,
+            "routes": routes,
+        }
+
+
+async def timed(recorder, client, route, method, url, **kwargs):
+    """Send a request, reading NDJSON answers line by line; return the decoded lines or JSON body."""
+    start = time.perf_counter()
+    try:
+        async with client.stream(method, url, **kwargs) as response:
+            if response.status_code >= 400:
+                await response.aread()
+                recorder.errors[route] += 1
+                return None
+            if response.headers.get("content-type", "").startswith("application/json-lines"):
+                lines = []
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    if not lines:
+                        recorder.first_lines[route].append(time.perf_counter() - start)
+                    lines.append(json.loads(line))
+                body = lines
+            else:
+                body = json.loads(await response.aread())
+    except (httpx.HTTPError, ValueError):
+        recorder.errors[route] += 1
+        return None
+    recorder.latencies[route].append(time.perf_counter() - start)
+    return body
+
+
+async def virtual_user(client, recorder, deadline, history_ratio, rng):
+    headers = {"X-Ms-Client-Principal-Id": str(uuid.uuid4())}
+    while time.monotonic() < deadline:
+        question = {"role": "user", "content": f"Question {rng.randrange(1000)} about the documents?"}
+        if rng.random() >= history_ratio:
+            await timed(recorder, client, "/conversation", "POST", "/conversation",
+                        json={"messages": [{"id": str(uuid.uuid4()), **question}]}, headers=headers)
+            continue
+
+        answer = await timed(recorder, client, "/history/generate", "POST", "/history/generate",
+                             json={"message": question, "persist_answer": True}, headers=headers)
+        if not answer:
+            continue
+        lines = answer if isinstance(answer, list) else [answer]
+        conversation_id = next(
+            (line["history_metadata"]["conversation_id"] for line in lines
+             if line.get("history_metadata", {}).get("conversation_id")),
+            None,
+        )
+        if conversation_id:
+            await timed(recorder, client, "/history/read", "POST", "/history/read",
+                        json={"conversation_id": conversation_id}, headers=headers)
+        await timed(recorder, client, "/history/list", "GET", "/history/list?offset=0", headers=headers)
+
+
+async def sample_workers(client, workers, stop_event):
+    """Scrape /metrics until stopped, keeping the latest sample of every worker process by pid."""
+    while not stop_event.is_set():
+        try:
+            samples = parse_metrics((await client.get("/metrics")).text)
+            pid = samples["process_info"][0][0]["pid"]
+            workers[pid] = {
+                "memory_bytes": max(
+                    [value for _, value in samples.get("process_resident_memory_bytes", [])] +
+                    [workers.get(pid, {}).get("memory_bytes", 0)]
+                ),
+                "lag_buckets": [
+                    (float(labels["le"]), value) for labels, value in samples.get("event_loop_lag_seconds_bucket", [])
+                ],
+                "lag_sum": sum(value for _, value in samples.get("event_loop_lag_seconds_sum", [])),
+                "lag_count": sum(value for _, value in samples.get("event_loop_lag_seconds_count", [])),
+            }
+        except (httpx.HTTPError, KeyError, IndexError):
+            pass
+        try:
+            await asyncio.wait_for(stop_event.wait(), 0.25)
+        except asyncio.TimeoutError:
+            pass
+
+
+def worker_summary(workers):
+    memory = [worker["memory_bytes"] / 2**20 for worker in workers.values() if worker["memory_bytes"]]
+    lag_p99 = [histogram_quantile(worker["lag_buckets"], 0.99) for worker in workers.values()]
+    lag_p99 = [lag for lag in lag_p99 if lag is not None]
+    lag_count = sum(worker["lag_count"] for worker in workers.values())
+    return {
+        "workers_seen": len(workers),
+        "memory_mb_max": max(memory) if memory else None,
+        "memory_mb_mean": sum(memory) / len(memory) if memory else None,
+        "event_loop_lag_mean": sum(worker["lag_sum"] for worker in workers.values()) / lag_count if lag_count else None,
+        "event_loop_lag_p99_max": max(lag_p99) if lag_p99 else None,
+    }
+
+
+async def run(args, workers, stream, mock_url):
+    with tempfile.TemporaryDirectory() as directory:
+        app = start_app(args.port, mock_url, workers, stream, directory)
+        try:
+            base_url = f"http://127.0.0.1:{args.port}"
+            await wait_until_ready(base_url + "/frontend_settings", app)
+            limits = httpx.Limits(max_connections=args.concurrency + 4, max_keepalive_connections=args.concurrency + 4)
+            async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+                rng = random.Random(args.seed)
+                if args.warmup:
+                    await asyncio.gather(*(
+                        virtual_user(client, Recorder(), time.monotonic() + args.warmup, args.history_ratio, rng)
+                        for _ in range(args.concurrency)
+                    ))
+
+                recorder = Recorder()
+                worker_samples = {}
+                stop_sampling = asyncio.Event()
+                sampler = asyncio.ensure_future(sample_workers(client, worker_samples, stop_sampling))
+                start = time.perf_counter()
+                deadline = time.monotonic() + args.duration
+                await asyncio.gather(*(
+                    virtual_user(client, recorder, deadline, args.history_ratio, rng) for _ in range(args.concurrency)
+                ))
+                elapsed = time.perf_counter() - start
+                stop_sampling.set()
+                await sampler
+        finally:
+            stop(app)
+
+    return {
+        "workers": workers,
+        "stream": stream,
+        "concurrency": args.concurrency,
+        "duration": elapsed,
+        **recorder.summary(elapsed),
+        **worker_summary(worker_samples),
+    }
+
+
+def run_key(run):
+    return (run["workers"], run["stream"], run["concurrency"])
+
+
+def change(new, old):
+    if new is None or not old:
+        return "n/a"
+    return f"{(new - old) / old * 100:+.1f}%"
+
+
+def print_report(report, baseline=None):
+    baseline_runs = {run_key(run): run for run in (baseline or {}).get("runs", [])}
+    for run in report["runs"]:
+        print(
+            f"workers={run['workers']} stream={'on' if run['stream'] else 'off'} concurrency={run['concurrency']}: "
+            f"{run['throughput']:.1f} req/s, {run['errors']} errors, "
+            f"memory/worker {run['memory_mb_max'] or 0:.0f} MB max, "
+            f"loop lag p99 {(run['event_loop_lag_p99_max'] or 0) * 1000:.1f} ms"
+        )
+        previous = baseline_runs.get(run_key(run))
+        if previous:
+            print(f"  vs baseline: throughput {change(run['throughput'], previous['throughput'])}")
+        for route, stats in run["routes"].items():
+            line = f"  {route}: {stats['requests']} ok, {stats['errors']} errors"
+            if stats["p50"] is not None:
+                line += f", p50 {stats['p50'] * 1000:.0f} ms, p95 {stats['p95'] * 1000:.0f} ms, p99 {stats['p99'] * 1000:.0f} ms"
+            if "ttft_p50" in stats:
+                line += f", first line p50 {stats['ttft_p50'] * 1000:.0f} ms, p99 {stats['ttft_p99'] * 1000:.0f} ms"
+            if previous and route in previous["routes"]:
+                line += f" (p99 {change(stats['p99'], previous['routes'][route]['p99'])})"
+            print(line)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args):
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    mock = start_mock_server(args.mock_port, args.ttft_ms, args.tokens_per_second, args.completion_tokens)
+    report = {
+        "revision": git_revision(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "mock": {"ttft_ms": args.ttft_ms, "tokens_per_second": args.tokens_per_second, "completion_tokens": args.completion_tokens},
+        "history_ratio": args.history_ratio,
+        "runs": [],
+    }
+    try:
+        await wait_until_ready(mock_url + "/stats", mock)
+        for workers in args.workers:
+            for stream in args.stream:
+                report["runs"].append(await run(args, workers, stream, mock_url))
+    finally:
+        stop(mock)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+def stream_list(value):
+    return [v.strip().lower() in ("on", "true", "1") for v in value.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int_list, default=[1, 2, 4], help="Comma separated gunicorn worker counts to compare")
+    parser.add_argument("--stream", type=stream_list, default=[True, False], help="on, off or on,off")
+    parser.add_argument("--concurrency", type=int, default=16, help="Virtual users sending requests at the same time")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds measured for each combination")
+    parser.add_argument("--warmup", type=float, default=3, help="Seconds of load before measuring")
+    parser.add_argument("--history-ratio", type=float, default=0.5, help="Share of iterations using /history/* instead of /conversation")
+    parser.add_argument("--ttft-ms", type=float, default=300, help="Median time to first token of the mock")
+    parser.add_argument("--tokens-per-second", type=float, default=50, help="Median generation speed of the mock")
+    parser.add_argument("--completion-tokens", type=int, default=120, help="Tokens of every mocked answer")
+    parser.add_argument("--port", type=int, default=8200, help="Port of the app")
+    parser.add_argument("--mock-port", type=int, default=8100, help="Port of the mock Azure OpenAI server")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    parser.add_argument("--baseline", help="Report of an earlier run to compare with")
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
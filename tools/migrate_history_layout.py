@@ -0,0 +1,136 @@
+"""
+Convert chat history conversations from the per-message item layout
+(AZURE_COSMOSDB_LAYOUT=items) to the embedded layout (AZURE_COSMOSDB_LAYOUT=embedded).
+
+The Cosmos DB account, database and container are read from the same .env /
+environment variables the app uses. Conversations are rewritten in place
+unless --target-container is given; conversations already using the embedded
+layout are skipped, so the tool can be re-run safely.
+
+In place, the per-message items are deleted once their conversation was
+migrated: the embedded layout doesn't delete them with the conversation, so
+they would outlive it. Items left by an interrupted run are deleted when the
+tool is run again. With --target-container they are kept unless
+--delete-source-messages is given.
+
+    python tools/migrate_history_layout.py --dry-run
+    python tools/migrate_history_layout.py
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+
+from azure.identity.aio import DefaultAzureCredential
+
+# Add parent directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.cosmosdbembeddedservice import CosmosEmbeddedConversationClient
+
+
+async def migrate(source, target, user_id=None, delete_source_messages=False, dry_run=False):
+    query = "SELECT * FROM c WHERE c.type='conversation'"
+    parameters = []
+    if user_id:
+        query += " AND c.userId = @userId"
+        parameters.append({'name': '@userId', 'value': user_id})
+
+    # collect the conversations first so in-place rewrites don't disturb the query
+    conversations = []
+    async for conversation in source.container_client.query_items(query=query, parameters=parameters):
+        conversations.append(conversation)
+
+    stats = {"conversations": 0, "messages": 0, "skipped": 0, "failed": 0}
+    for conversation in conversations:
+        if conversation.get("layout") == "embedded":
+            stats["skipped"] += 1
+            if delete_source_messages and not dry_run:
+                try:
+                    ## left by a run that failed after the conversation was migrated
+                    for message in await source.get_messages(conversation["userId"], conversation["id"]):
+                        await source.container_client.delete_item(item=message["id"], partition_key=conversation["userId"])
+                except Exception:
+                    logging.exception(f"Failed to delete the source messages of conversation {conversation['id']}")
+                    stats["failed"] += 1
+            continue
+
+        try:
+            messages = await source.get_messages(conversation["userId"], conversation["id"])
+            if not dry_run:
+                await target.import_conversation(conversation, messages)
+                if delete_source_messages:
+                    for message in messages:
+                        await source.container_client.delete_item(item=message["id"], partition_key=conversation["userId"])
+        except Exception:
+            logging.exception(f"Failed to migrate conversation {conversation['id']}")
+            stats["failed"] += 1
+            continue
+
+        stats["conversations"] += 1
+        stats["messages"] += len(messages)
+        logging.info(f"{'Checked' if dry_run else 'Migrated'} conversation {conversation['id']} ({len(messages)} messages)")
+
+    return stats
+
+
+async def main(args):
+    from backend.settings import app_settings
+
+    chat_history = app_settings.chat_history
+    if not chat_history:
+        raise ValueError("Chat history is not configured, set the AZURE_COSMOSDB_* variables")
+
+    cosmos_endpoint = f"https://{chat_history.account}.documents.azure.com:443/"
+    credential = chat_history.account_key or DefaultAzureCredential()
+
+    source = CosmosConversationClient(
+        cosmosdb_endpoint=cosmos_endpoint,
+        credential=credential,
+        database_name=chat_history.database,
+        container_name=chat_history.conversations_container,
+    )
+    target = CosmosEmbeddedConversationClient(
+        cosmosdb_endpoint=cosmos_endpoint,
+        credential=credential,
+        database_name=chat_history.database,
+        container_name=args.target_container or chat_history.conversations_container,
+        embedded_max_bytes=args.embedded_max_bytes or chat_history.embedded_max_bytes,
+        cosmosdb_client=source.cosmosdb_client,
+    )
+
+    try:
+        stats = await migrate(
+            source,
+            target,
+            user_id=args.user_id,
+            ## the source items of a conversation migrated in place would outlive its deletion
+            delete_source_messages=args.delete_source_messages or not (args.target_container or args.keep_source_messages),
+            dry_run=args.dry_run,
+        )
+    finally:
+        await source.cosmosdb_client.close()
+        if not isinstance(credential, str):
+            await credential.close()
+
+    print(
+        f"{'Would migrate' if args.dry_run else 'Migrated'} {stats['conversations']} conversations "
+        f"({stats['messages']} messages), skipped {stats['skipped']} already embedded, {stats['failed']} failed"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--user-id", help="Only migrate the conversations of this user")
+    parser.add_argument("--target-container", help="Write the embedded conversations to this container instead of rewriting them in place")
+    parser.add_argument("--embedded-max-bytes", type=int, help="Override AZURE_COSMOSDB_EMBEDDED_MAX_BYTES for the migrated documents")
+    parser.add_argument("--delete-source-messages", action="store_true", help="With --target-container, delete the per-message items once their conversation was migrated")
+    parser.add_argument("--keep-source-messages", action="store_true", help="Keep the per-message items of conversations migrated in place; deleting such a conversation then leaves them behind")
+    parser.add_argument("--dry-run", action="store_true", help="Read the conversations without writing anything")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    asyncio.run(main(args))
@@ -0,0 +1,277 @@
+"""
+Mock Azure OpenAI, Prompt Flow and Azure Functions tool endpoints for offline load tests.
+
+Serves the chat completions route used by ``AsyncAzureOpenAI``, streamed
+(server-sent events) and not, with ``context`` citations when the request
+has ``data_sources``, tool calls when it has ``tools``, usage (and the
+trailing usage chunk with ``stream_options.include_usage``) and the
+x-ratelimit-* headers. Time to first token and tokens per second follow
+lognormal distributions around the configured medians, and 429s can be
+injected at random or by a requests-per-minute limit.
+
+    python tools/mock_aoai_server.py --port 8100 --ttft-ms 400 --tokens-per-second 60
+
+and point the app at it:
+
+    AZURE_OPENAI_ENDPOINT=http://localhost:8100
+    AZURE_OPENAI_KEY=mock
+    AZURE_OPENAI_MODEL=gpt-mock
+    # Prompt Flow
+    PROMPTFLOW_ENDPOINT=http://localhost:8100/promptflow
+    PROMPTFLOW_API_KEY=mock
+    # function calling through Azure Functions
+    AZURE_OPENAI_FUNCTION_CALL_AZURE_FUNCTIONS_TOOLS_BASE_URL=http://localhost:8100/tools
+    AZURE_OPENAI_FUNCTION_CALL_AZURE_FUNCTIONS_TOOL_BASE_URL=http://localhost:8100/tool
+
+GET /stats returns the number of requests served and 429s returned.
+"""
+import argparse
+import asyncio
+import dataclasses
+import json
+import random
+import time
+import uuid
+from collections import deque
+
+from quart import Quart, jsonify, make_response, request
+
+WORDS = (
+    "the service answers questions about the documents in the index and cites the passages "
+    "it used so the reader can check every statement against its source"
+).split()
+
+MOCK_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "get_weather",
+            "description": "Return the weather of a city",
+            "parameters": {
+                "type": "object",
+                "properties": {"city": {"type": "string"}},
+                "required": ["city"],
+            },
+        },
+    }
+]
+
+
+@dataclasses.dataclass
+class MockSettings():
+    ttft_ms: float = 300.0
+    ttft_sigma: float = 0.3
+    tokens_per_second: float = 50.0
+    tokens_per_second_sigma: float = 0.2
+    completion_tokens: int = 120
+    citations: int = 3
+    citation_bytes: int = 1500
+    error_rate: float = 0.0
+    requests_per_minute: int = 0
+    retry_after_ms: int = 1000
+    seed: int = None
+
+
+def lognormal(median, sigma, rng: random.Random):
+    if median <= 0:
+        return 0.0
+    return median * rng.lognormvariate(0, sigma) if sigma > 0 else median
+
+
+def estimate_tokens(messages) -> int:
+    return sum(len(str(message.get("content") or "")) // 4 + 4 for message in messages)
+
+
+def make_citations(settings: MockSettings, rng: random.Random):
+    citations = []
+    for i in range(settings.citations):
+        document = rng.randrange(1000)
+        words = []
+        while sum(len(w) + 1 for w in words) < settings.citation_bytes:
+            words.append(rng.choice(WORDS))
+        citations.append({
+            "content": " ".join(words),
+            "title": f"Document {document}",
+            "url": f"https://example.com/documents/{document}.pdf",
+            "filepath": f"{document}.pdf",
+            "chunk_id": str(i),
+        })
+    return {"citations": citations, "intent": "[]"}
+
+
+def create_app(settings: MockSettings = None) -> Quart:
+    settings = settings or MockSettings()
+    rng = random.Random(settings.seed)
+    app = Quart(__name__)
+    app.config["RESPONSE_TIMEOUT"] = None
+    stats = {"requests": 0, "rate_limited": 0, "streams": 0, "tool_calls": 0}
+    recent_requests = deque()
+
+    def rate_limited():
+        now = time.monotonic()
+        while recent_requests and now - recent_requests[0] > 60:
+            recent_requests.popleft()
+        if settings.requests_per_minute and len(recent_requests) >= settings.requests_per_minute:
+            return True
+        if settings.error_rate and rng.random() < settings.error_rate:
+            return True
+        recent_requests.append(now)
+        return False
+
+    def rate_limit_headers():
+        remaining = max(0, settings.requests_per_minute - len(recent_requests)) if settings.requests_per_minute else 1000
+        return {
+            "x-ratelimit-remaining-requests": str(remaining),
+            "x-ratelimit-remaining-tokens": str(remaining * 1000),
+            "apim-request-id": str(uuid.uuid4()),
+        }
+
+    def completion_tokens():
+        return [rng.choice(WORDS) + " " for _ in range(max(1, settings.completion_tokens))]
+
+    def usage(body, completion):
+        prompt = estimate_tokens(body.get("messages", []))
+        return {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion}
+
+    def wants_tool_call(body):
+        messages = body.get("messages", [])
+        return bool(body.get("tools")) and messages and messages[-1].get("role") == "user"
+
+    def tool_call(body):
+        function = body["tools"][0]["function"]
+        return {
+            "id": f"call_{uuid.uuid4().hex[:12]}",
+            "type": "function",
+            "function": {"name": function["name"], "arguments": json.dumps({"city": "Seattle"})},
+        }
+
+    @app.route("/openai/deployments/<deployment>/chat/completions", methods=["POST"])
+    async def chat_completions(deployment):
+        stats["requests"] += 1
+        if rate_limited():
+            stats["rate_limited"] += 1
+            headers = {**rate_limit_headers(), "retry-after-ms": str(settings.retry_after_ms), "retry-after": str(max(1, settings.retry_after_ms // 1000))}
+            error = {"error": {"code": "429", "message": "Requests to the deployment have exceeded the rate limit of the mock server."}}
+            return jsonify(error), 429, headers
+
+        body = await request.get_json()
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        context = make_citations(settings, rng) if body.get("data_sources") else None
+        ttft = lognormal(settings.ttft_ms, settings.ttft_sigma, rng) / 1000
+        tokens_per_second = lognormal(settings.tokens_per_second, settings.tokens_per_second_sigma, rng)
+        call = tool_call(body) if wants_tool_call(body) else None
+        if call:
+            stats["tool_calls"] += 1
+
+        if not body.get("stream"):
+            tokens = completion_tokens()
+            await asyncio.sleep(ttft + (len(tokens) / tokens_per_second if tokens_per_second else 0))
+            message = {"role": "assistant", "content": None if call else "".join(tokens)}
+            if call:
+                message["tool_calls"] = [call]
+            if context:
+                message["context"] = context
+            return jsonify({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": deployment,
+                "choices": [{"index": 0, "finish_reason": "tool_calls" if call else "stop", "message": message}],
+                "usage": usage(body, 0 if call else len(tokens)),
+            }), 200, rate_limit_headers()
+
+        stats["streams"] += 1
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+
+        def chunk(delta, finish_reason=None):
+            return "data: " + json.dumps({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": deployment,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }) + "\n\n"
+
+        async def events():
+            await asyncio.sleep(ttft)
+            sent = 0
+            if call:
+                yield chunk({"role": "assistant", "tool_calls": [{"index": 0, **call, "function": {"name": call["function"]["name"], "arguments": ""}}]})
+                yield chunk({"tool_calls": [{"index": 0, "function": {"arguments": call["function"]["arguments"]}}]})
+                yield chunk({}, "tool_calls")
+            else:
+                if context:
+                    yield chunk({"role": "assistant", "context": context})
+                for token in completion_tokens():
+                    if sent and tokens_per_second:
+                        await asyncio.sleep(1 / tokens_per_second)
+                    yield chunk({"content": token})
+                    sent += 1
+                yield chunk({}, "stop")
+            if include_usage:
+                yield "data: " + json.dumps({
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": deployment,
+                    "choices": [],
+                    "usage": usage(body, sent),
+                }) + "\n\n"
+            yield "data: [DONE]\n\n"
+
+        response = await make_response(events(), 200, rate_limit_headers())
+        response.timeout = None
+        response.mimetype = "text/event-stream"
+        return response
+
+    @app.route("/promptflow", methods=["POST"])
+    async def promptflow():
+        stats["requests"] += 1
+        await request.get_json()
+        tokens = completion_tokens()
+        await asyncio.sleep(
+            lognormal(settings.ttft_ms, settings.ttft_sigma, rng) / 1000
+            + (len(tokens) / settings.tokens_per_second if settings.tokens_per_second else 0)
+        )
+        return jsonify({"reply": "".join(tokens), "documents": make_citations(settings, rng)["citations"]})
+
+    @app.route("/tools", methods=["GET"])
+    async def tools():
+        return jsonify(MOCK_TOOLS)
+
+    @app.route("/tool", methods=["POST"])
+    async def call_tool():
+        body = json.loads(await request.get_data(as_text=True))
+        return json.dumps({"tool_name": body["tool_name"], "result": "Sunny, 21 degrees"})
+
+    @app.route("/stats", methods=["GET"])
+    async def get_stats():
+        return jsonify(stats)
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--ttft-ms", type=float, default=300.0, help="Median time to first token")
+    parser.add_argument("--ttft-sigma", type=float, default=0.3, help="Sigma of the lognormal time to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="Median generation speed of an answer")
+    parser.add_argument("--tokens-per-second-sigma", type=float, default=0.2)
+    parser.add_argument("--completion-tokens", type=int, default=120, help="Tokens of every answer")
+    parser.add_argument("--citations", type=int, default=3, help="Citations of answers to requests with data_sources")
+    parser.add_argument("--citation-bytes", type=int, default=1500, help="Size of the content of each citation")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with a 429")
+    parser.add_argument("--requests-per-minute", type=int, default=0, help="Answer with a 429 above this rate, 0 for no limit")
+    parser.add_argument("--retry-after-ms", type=int, default=1000)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    settings = MockSettings(**{
+        field.name: getattr(args, field.name) for field in dataclasses.fields(MockSettings)
+    })
+    uvicorn.run(create_app(settings), host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,337 @@
+"""
+In-memory stand-in for Cosmos DB, for the unit tests and tools/benchmark_history_layout.py.
+
+Holds the documents of each container in process memory, answers the
+queries of the chat history clients and estimates their request charges,
+so the storage layouts can be tested and compared without an account.
+"""
+import asyncio
+import copy
+import json
+import math
+import operator
+import re
+import time
+import uuid
+from azure.cosmos import exceptions
+
+# Rough request unit model used to compare storage layouts without a live
+# account: point reads cost ~1 RU per KB, writes ~5.5 RU per KB and queries
+# pay a fixed overhead plus a small per-document and per-KB cost.
+POINT_READ_RU_PER_KB = 1.0
+WRITE_RU_PER_KB = 5.5
+DELETE_RU = 5.5
+QUERY_BASE_RU = 2.8
+QUERY_RU_PER_DOCUMENT = 0.1
+QUERY_RU_PER_KB = 0.5
+
+_QUERY_RE = re.compile(
+    r"^\s*SELECT\s+(?P<select>.+?)\s+FROM\s+c"
+    r"(?:\s+WHERE\s+(?P<where>.+?))?"
+    r"(?:\s+ORDER\s+BY\s+c\.(?P<order_field>\w+)(?:\s+(?P<order_dir>ASC|DESC))?)?"
+    r"(?:\s+OFFSET\s+(?P<offset>\d+)\s+LIMIT\s+(?P<limit>\d+))?\s*$",
+    re.IGNORECASE | re.DOTALL,
+)
+_COMPARISON_RE = re.compile(r"^c\.(\w+)\s*(=|>=|<=|>|<)\s*(@\w+|'[^']*')$")
+_COMPARISONS = {"=": operator.eq, ">=": operator.ge, "<=": operator.le, ">": operator.gt, "<": operator.lt}
+_ARRAY_CONTAINS_RE = re.compile(r"^ARRAY_CONTAINS\(\s*c\.(\w+)\s*,\s*(@\w+|'[^']*')\s*\)$", re.IGNORECASE)
+_NOT_DEFINED_RE = re.compile(r"^NOT\s+IS_DEFINED\(\s*c\.(\w+)\s*\)$", re.IGNORECASE)
+_AND_RE = re.compile(r"\s+AND\s+", re.IGNORECASE)
+
+
+def _size_kb(document) -> float:
+    return max(1.0, math.ceil(len(json.dumps(document)) / 1024))
+
+
+class InMemoryCosmosClient():
+    """Stand-in for ``azure.cosmos.aio.CosmosClient`` holding containers in process memory.
+
+    Only the subset of the SDK used by the conversation history clients is
+    implemented. Every request is charged an estimated RU cost and can be
+    delayed by ``latency`` seconds to model the network round trip. Like the
+    SDK, ``raw_response_hook`` is called with every response, carrying the
+    x-ms-request-charge, x-ms-request-duration-ms and x-ms-item-count headers.
+    """
+
+    def __init__(self, latency: float = 0.0, partition_key_path: str = "/userId", raw_response_hook=None):
+        self.latency = latency
+        self.partition_key_path = partition_key_path
+        self.raw_response_hook = raw_response_hook
+        self.databases = {}
+
+    def get_database_client(self, database_name):
+        if database_name not in self.databases:
+            self.databases[database_name] = InMemoryDatabaseClient(self, database_name)
+        return self.databases[database_name]
+
+    async def close(self):
+        pass
+
+
+class InMemoryDatabaseClient():
+    def __init__(self, cosmos_client: InMemoryCosmosClient, database_name: str):
+        self.cosmos_client = cosmos_client
+        self.id = database_name
+        self.containers = {}
+
+    async def read(self):
+        return {"id": self.id}
+
+    def get_container_client(self, container_name):
+        if container_name not in self.containers:
+            self.containers[container_name] = InMemoryContainerClient(
+                container_name,
+                latency=self.cosmos_client.latency,
+                partition_key_path=self.cosmos_client.partition_key_path,
+                raw_response_hook=self.cosmos_client.raw_response_hook,
+            )
+        return self.containers[container_name]
+
+
+class InMemoryContainerClient():
+    def __init__(self, container_name: str, latency: float = 0.0, partition_key_path: str = "/userId", raw_response_hook=None):
+        self.id = container_name
+        self.latency = latency
+        self.raw_response_hook = raw_response_hook
+        self.partition_key_field = partition_key_path.lstrip("/")
+        self.items = {}
+        self.request_count = 0
+        self.request_charge_total = 0.0
+        self.last_request_charge = 0.0
+
+    async def read(self):
+        return {"id": self.id, "partitionKey": {"paths": [f"/{self.partition_key_field}"]}}
+
+    async def _round_trip(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def _charge(self, request_charge, status_code=200, item_count=None):
+        await self._round_trip()
+        self._record(request_charge, status_code, item_count)
+
+    def _record(self, request_charge, status_code=200, item_count=None):
+        self.request_count += 1
+        self.request_charge_total += request_charge
+        self.last_request_charge = request_charge
+        if self.raw_response_hook:
+            headers = {
+                "x-ms-request-charge": str(round(request_charge, 2)),
+                "x-ms-request-duration-ms": str(self.latency * 1000),
+            }
+            if item_count is not None:
+                headers["x-ms-item-count"] = str(item_count)
+            self.raw_response_hook(_InMemoryPipelineResponse(status_code, headers))
+
+    def reset_metrics(self):
+        self.request_count = 0
+        self.request_charge_total = 0.0
+        self.last_request_charge = 0.0
+
+    def _not_found(self, item_id):
+        return exceptions.CosmosResourceNotFoundError(
+            status_code=404,
+            message=f"Entity with the specified id {item_id} does not exist in the system."
+        )
+
+    def _store(self, body):
+        document = copy.deepcopy(body)
+        document["_etag"] = str(uuid.uuid4())
+        document["_ts"] = int(time.time())
+        self.items[(document[self.partition_key_field], document["id"])] = document
+        return copy.deepcopy(document)
+
+    async def read_item(self, item, partition_key, **kwargs):
+        await self._round_trip()
+        document = self.items.get((partition_key, item))
+        self._record(
+            POINT_READ_RU_PER_KB * _size_kb(document) if document else POINT_READ_RU_PER_KB,
+            status_code=200 if document else 404
+        )
+        if document is None:
+            raise self._not_found(item)
+        return copy.deepcopy(document)
+
+    async def create_item(self, body, **kwargs):
+        await self._round_trip()
+        exists = (body[self.partition_key_field], body["id"]) in self.items
+        self._record(WRITE_RU_PER_KB * _size_kb(body), status_code=409 if exists else 201)
+        if exists:
+            raise exceptions.CosmosResourceExistsError(
+                status_code=409,
+                message=f"Entity with the specified id {body['id']} already exists in the system."
+            )
+        return self._store(body)
+
+    async def upsert_item(self, body, **kwargs):
+        await self._charge(WRITE_RU_PER_KB * _size_kb(body))
+        return self._store(body)
+
+    async def replace_item(self, item, body, etag=None, match_condition=None, **kwargs):
+        await self._round_trip()
+        item_id = item["id"] if isinstance(item, dict) else item
+        current = self.items.get((body[self.partition_key_field], item_id))
+        precondition_failed = (
+            current is not None and etag is not None and match_condition is not None and current["_etag"] != etag
+        )
+        self._record(
+            WRITE_RU_PER_KB * _size_kb(body),
+            status_code=404 if current is None else 412 if precondition_failed else 200
+        )
+        if current is None:
+            raise self._not_found(item_id)
+        if precondition_failed:
+            raise exceptions.CosmosAccessConditionFailedError(
+                status_code=412,
+                message="One of the specified pre-condition is not met."
+            )
+        return self._store(body)
+
+    async def patch_item(self, item, partition_key, patch_operations, **kwargs):
+        ## only the "set" and "incr" operations are supported
+        await self._round_trip()
+        current = self.items.get((partition_key, item))
+        self._record(
+            WRITE_RU_PER_KB * _size_kb(current) if current else POINT_READ_RU_PER_KB,
+            status_code=200 if current else 404
+        )
+        if current is None:
+            raise self._not_found(item)
+
+        document = copy.deepcopy(current)
+        for patch in patch_operations:
+            field = patch["path"].lstrip("/")
+            if patch["op"] == "incr":
+                document[field] = document.get(field, 0) + patch["value"]
+            elif patch["op"] == "set":
+                document[field] = patch["value"]
+            else:
+                raise NotImplementedError(f"Unsupported patch operation for the in-memory container: {patch['op']}")
+        return self._store(document)
+
+    async def delete_item(self, item, partition_key, **kwargs):
+        await self._round_trip()
+        item_id = item["id"] if isinstance(item, dict) else item
+        deleted = self.items.pop((partition_key, item_id), None)
+        self._record(DELETE_RU, status_code=204 if deleted is not None else 404)
+        if deleted is None:
+            raise self._not_found(item_id)
+
+    def query_items(self, query, parameters=None, partition_key=None, max_item_count=None, **kwargs):
+        return _InMemoryQueryIterable(self, query, parameters or [], partition_key, max_item_count)
+
+    def _execute_query(self, query, parameters, partition_key):
+        match = _QUERY_RE.match(query)
+        if not match:
+            raise NotImplementedError(f"Unsupported query for the in-memory container: {query}")
+
+        values = {p["name"]: p["value"] for p in parameters}
+
+        def resolve(token):
+            return values[token] if token.startswith("@") else token.strip("'")
+
+        predicates = []
+        for condition in _AND_RE.split(match.group("where") or ""):
+            condition = condition.strip()
+            if not condition:
+                continue
+            if m := _COMPARISON_RE.match(condition):
+                field, compare, value = m.group(1), _COMPARISONS[m.group(2)], resolve(m.group(3))
+                predicates.append(lambda doc, f=field, c=compare, v=value: f in doc and c(doc[f], v))
+            elif m := _ARRAY_CONTAINS_RE.match(condition):
+                field, value = m.group(1), resolve(m.group(2))
+                predicates.append(lambda doc, f=field, v=value: v in (doc.get(f) or []))
+            elif m := _NOT_DEFINED_RE.match(condition):
+                predicates.append(lambda doc, f=m.group(1): f not in doc)
+            else:
+                raise NotImplementedError(f"Unsupported condition for the in-memory container: {condition}")
+
+        results = [
+            copy.deepcopy(doc)
+            for (pk, _), doc in self.items.items()
+            if (partition_key is None or pk == partition_key) and all(p(doc) for p in predicates)
+        ]
+
+        if match.group("order_field"):
+            field = match.group("order_field")
+            results.sort(
+                key=lambda doc: (field in doc, doc.get(field)),
+                reverse=(match.group("order_dir") or "ASC").upper() == "DESC"
+            )
+
+        if match.group("limit") is not None:
+            offset = int(match.group("offset"))
+            results = results[offset:offset + int(match.group("limit"))]
+
+        select = match.group("select").strip()
+        if select != "*":
+            fields = [f.strip()[2:] for f in select.split(",")]
+            results = [{f: doc[f] for f in fields if f in doc} for doc in results]
+
+        return results
+
+
+class _InMemoryQueryIterable():
+    def __init__(self, container, query, parameters, partition_key, max_item_count):
+        self._container = container
+        self._query = query
+        self._parameters = parameters
+        self._partition_key = partition_key
+        self._max_item_count = max_item_count
+
+    async def __aiter__(self):
+        async for page in self.by_page():
+            async for item in page:
+                yield item
+
+    def by_page(self, continuation_token=None):
+        return _InMemoryQueryPager(self, continuation_token)
+
+
+class _InMemoryQueryPager():
+    def __init__(self, iterable, continuation_token):
+        self._iterable = iterable
+        self._offset = int(continuation_token) if continuation_token else 0
+        self.continuation_token = continuation_token
+
+    async def __aiter__(self):
+        iterable = self._iterable
+        results = iterable._container._execute_query(
+            iterable._query,
+            iterable._parameters,
+            iterable._partition_key
+        )
+        page_size = iterable._max_item_count or len(results) or 1
+        while True:
+            page = results[self._offset:self._offset + page_size]
+            await iterable._container._charge(
+                QUERY_BASE_RU
+                + QUERY_RU_PER_DOCUMENT * len(page)
+                + QUERY_RU_PER_KB * (len(json.dumps(page)) / 1024),
+                item_count=len(page)
+            )
+            self._offset += len(page)
+            self.continuation_token = str(self._offset) if self._offset < len(results) else None
+            yield _InMemoryPage(page)
+            if self.continuation_token is None:
+                break
+
+
+class _InMemoryPage():
+    def __init__(self, items):
+        self._items = items
+
+    async def __aiter__(self):
+        for item in self._items:
+            yield item
+
+
+class _InMemoryHttpResponse():
+    def __init__(self, status_code, headers):
+        self.status_code = status_code
+        self.headers = headers
+
+
+class _InMemoryPipelineResponse():
+    def __init__(self, status_code, headers):
+        self.http_response = _InMemoryHttpResponse(status_code, headers)
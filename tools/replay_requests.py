@@ -0,0 +1,200 @@
+"""
+Replay chat requests captured with REQUEST_CAPTURE_ENABLED=True.
+
+Sends the captured /conversation and /history/generate requests again, in
+the order and at the pace they arrived, --speed times faster, or as fast as
+--concurrency allows with --max-rate. Each request is sent as the hashed
+user it was captured for. A conversation started by a captured request is
+started again, and the following requests of that conversation are sent to
+the new one; they wait for it to exist, so at high speed-ups a follow-up
+can be sent later than scheduled.
+
+Without --target the app is started under gunicorn answering from
+tools/mock_aoai_server.py, like tools/load_test.py does; with --target the
+requests go to a running app and whatever upstream it is configured with.
+
+    python tools/replay_requests.py request_captures/*.jsonl --speed 2
+    python tools/replay_requests.py request_captures/*.jsonl --max-rate --concurrency 64 --workers 4
+    python tools/replay_requests.py request_captures/*.jsonl --target http://localhost:50505 --output replay.json
+"""
+import argparse
+import asyncio
+import copy
+import glob
+import json
+import tempfile
+import time
+
+import httpx
+
+from load_test import Recorder, percentile, start_app, start_mock_server, stop, timed, wait_until_ready
+
+
+def load_records(patterns, limit=None):
+    records = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            with open(path, "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        ## the last line of a file a worker was writing when it stopped
+                        continue
+    records.sort(key=lambda record: record["time"])
+    return records[:limit] if limit else records
+
+
+def answered_conversation(body):
+    lines = body if isinstance(body, list) else [body]
+    for line in lines:
+        if isinstance(line, dict) and line.get("history_metadata", {}).get("conversation_id"):
+            return line["history_metadata"]["conversation_id"]
+    return None
+
+
+class Replayer():
+    def __init__(self, client, recorder, concurrency=0):
+        self.client = client
+        self.recorder = recorder
+        self.limit = asyncio.Semaphore(concurrency) if concurrency else None
+        ## captured conversation id -> future of the id of the conversation the replay created for it
+        self.conversations = {}
+        self.skipped = 0
+        self.schedule_lag = []
+
+    def plan(self, record):
+        """Decide, in arrival order, which request starts each captured conversation in the replay."""
+        body = copy.deepcopy(record["body"])
+        captured = body.get("conversation_id") if isinstance(body, dict) else None
+        creates = None
+        if record["route"] == "/history/generate":
+            if captured and captured not in self.conversations:
+                ## started before the capture or not sampled, this request starts it instead
+                del body["conversation_id"]
+                creates = captured
+            elif not captured and record.get("conversation"):
+                creates = record["conversation"]
+            if creates:
+                self.conversations[creates] = asyncio.get_running_loop().create_future()
+        return body, captured if creates is None else None, creates
+
+    async def send(self, record, body, waits_for, creates):
+        if waits_for:
+            conversation_id = await self.conversations[waits_for]
+            if conversation_id is None:
+                self.skipped += 1
+                return
+            body["conversation_id"] = conversation_id
+
+        headers = {"X-Ms-Client-Principal-Id": record.get("user") or "replay"}
+        if self.limit:
+            async with self.limit:
+                answer = await timed(self.recorder, self.client, record["route"], "POST", record["route"], json=body, headers=headers)
+        else:
+            answer = await timed(self.recorder, self.client, record["route"], "POST", record["route"], json=body, headers=headers)
+
+        if creates:
+            self.conversations[creates].set_result(answered_conversation(answer) if answer else None)
+
+    async def replay(self, records, speed, max_rate):
+        tasks = []
+        start = time.monotonic()
+        first = records[0]["time"] if records else 0
+        for record in records:
+            if not max_rate:
+                scheduled = start + (record["time"] - first) / speed
+                if scheduled > time.monotonic():
+                    await asyncio.sleep(scheduled - time.monotonic())
+                self.schedule_lag.append(time.monotonic() - scheduled)
+            body, waits_for, creates = self.plan(record)
+            tasks.append(asyncio.ensure_future(self.send(record, body, waits_for, creates)))
+        await asyncio.gather(*tasks)
+        return time.monotonic() - start
+
+
+async def main(args):
+    records = load_records(args.captures, args.limit)
+    if not records:
+        print("No captured requests found")
+        return 1
+    captured_duration = records[-1]["time"] - records[0]["time"]
+
+    mock = app = directory = None
+    target = args.target
+    try:
+        if not target:
+            mock_url = f"http://127.0.0.1:{args.mock_port}"
+            mock = start_mock_server(args.mock_port, args.ttft_ms, args.tokens_per_second, args.completion_tokens)
+            await wait_until_ready(mock_url + "/stats", mock)
+            directory = tempfile.TemporaryDirectory()
+            app = start_app(args.port, mock_url, args.workers, args.stream, directory.name)
+            target = f"http://127.0.0.1:{args.port}"
+            await wait_until_ready(target + "/frontend_settings", app)
+
+        limits = httpx.Limits(max_connections=args.concurrency or None, max_keepalive_connections=100)
+        async with httpx.AsyncClient(base_url=target, timeout=args.timeout, limits=limits) as client:
+            recorder = Recorder()
+            replayer = Replayer(client, recorder, args.concurrency if args.max_rate else 0)
+            elapsed = await replayer.replay(records, args.speed, args.max_rate)
+    finally:
+        for process in (app, mock):
+            if process is not None:
+                stop(process)
+        if directory is not None:
+            directory.cleanup()
+
+    report = {
+        "captured": {
+            "requests": len(records),
+            "duration": captured_duration,
+            "throughput": len(records) / captured_duration if captured_duration else None,
+        },
+        "replay": {
+            "target": args.target or "local app and mock server",
+            "speed": None if args.max_rate else args.speed,
+            "duration": elapsed,
+            "skipped": replayer.skipped,
+            "schedule_lag_p99": percentile(replayer.schedule_lag, 99),
+            **recorder.summary(elapsed),
+        },
+    }
+
+    replay = report["replay"]
+    print(
+        f"Replayed {len(records)} requests captured over {captured_duration:.1f}s in {elapsed:.1f}s: "
+        f"{replay['throughput']:.1f} req/s, {replay['errors']} errors, {replay['skipped']} skipped"
+    )
+    if replay["schedule_lag_p99"] is not None:
+        print(f"  sent up to {replay['schedule_lag_p99'] * 1000:.0f} ms (p99) later than scheduled")
+    for route, stats in replay["routes"].items():
+        line = f"  {route}: {stats['requests']} ok, {stats['errors']} errors"
+        if stats["p50"] is not None:
+            line += f", p50 {stats['p50'] * 1000:.0f} ms, p95 {stats['p95'] * 1000:.0f} ms, p99 {stats['p99'] * 1000:.0f} ms"
+        print(line)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("captures", nargs="+", help="Capture files or glob patterns")
+    parser.add_argument("--target", help="URL of a running app; without it the app is started against the mock server")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay this many times faster than captured")
+    parser.add_argument("--max-rate", action="store_true", help="Ignore the captured arrival times and send as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=32, help="Requests in flight with --max-rate")
+    parser.add_argument("--limit", type=int, help="Replay only the first requests")
+    parser.add_argument("--timeout", type=float, default=230, help="Seconds to wait for an answer")
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers of the local app")
+    parser.add_argument("--stream", type=lambda v: v.lower() in ("on", "true", "1"), default=True, help="on or off, for the local app")
+    parser.add_argument("--port", type=int, default=8200, help="Port of the local app")
+    parser.add_argument("--mock-port", type=int, default=8100, help="Port of the mock Azure OpenAI server")
+    parser.add_argument("--ttft-ms", type=float, default=300, help="Median time to first token of the mock")
+    parser.add_argument("--tokens-per-second", type=float, default=50, help="Median generation speed of the mock")
+    parser.add_argument("--completion-tokens", type=int, default=120, help="Tokens of every mocked answer")
+    args = parser.parse_args()
+
+    raise SystemExit(asyncio.run(main(args)))
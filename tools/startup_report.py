@@ -0,0 +1,100 @@
+"""
+Report how long a gunicorn worker takes to import the app.
+
+Imports app.py in a fresh interpreter with ``python -X importtime``, --runs
+times, and reports the median time to import it, the median time to build
+the settings from the environment and DOTENV_PATH, and, for the fastest
+run, the import time of every top level package, largest first. With
+--budget-ms it exits with 1 when the median import time is over budget,
+for use in CI:
+
+    python tools/startup_report.py
+    python tools/startup_report.py --budget-ms 1500 --output startup.json
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+from collections import Counter
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+## import time: self [us] | cumulative | imported package
+_IMPORT_RE = re.compile(r'^import time:\s+(?P<self>\d+) \|\s+(?P<cumulative>\d+) \|(?P<indent>\s+)(?P<module>\S+)$')
+
+_CHILD = """
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter() - started
+from backend import settings
+settings._dotenv_values.clear()
+started = time.perf_counter()
+settings._AppSettings()
+print(json.dumps({"import": imported, "settings": time.perf_counter() - started}))
+"""
+
+
+def measure(env):
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _CHILD],
+        cwd=ROOT, env=env, capture_output=True, text=True,
+    )
+    if process.returncode != 0:
+        ## the error without the import times interleaved with it
+        error = "\n".join(line for line in process.stderr.splitlines() if not line.startswith("import time:"))
+        print(error, file=sys.stderr)
+        print("Could not import the app, is the environment or --dotenv set up? See the error above.", file=sys.stderr)
+        raise SystemExit(1)
+    packages = Counter()
+    for line in process.stderr.splitlines():
+        match = _IMPORT_RE.match(line)
+        if match:
+            packages[match["module"].split(".")[0]] += int(match["self"]) / 1e6
+    times = json.loads(process.stdout.strip().splitlines()[-1])
+    return times["import"], times["settings"], packages
+
+
+def main(args):
+    env = dict(os.environ)
+    if args.dotenv:
+        env["DOTENV_PATH"] = os.path.abspath(args.dotenv)
+
+    runs = [measure(env) for _ in range(args.runs)]
+    import_time = statistics.median(run[0] for run in runs)
+    settings_time = statistics.median(run[1] for run in runs)
+    packages = min(runs, key=lambda run: run[0])[2]
+
+    print(f"import app: {import_time * 1000:.0f} ms (median of {args.runs}), settings: {settings_time * 1000:.1f} ms")
+    for package, seconds in packages.most_common(args.top):
+        print(f"  {package}: {seconds * 1000:.1f} ms")
+
+    if args.output:
+        report = {
+            "import": import_time,
+            "settings": settings_time,
+            "packages": dict(packages.most_common()),
+            "budget": args.budget_ms / 1000 if args.budget_ms else None,
+        }
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if args.budget_ms and import_time * 1000 > args.budget_ms:
+        print(f"Over the budget of {args.budget_ms:.0f} ms")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters to import the app in")
+    parser.add_argument("--dotenv", help="DOTENV_PATH of the settings to start with, instead of the environment's")
+    parser.add_argument("--top", type=int, default=15, help="Packages to list")
+    parser.add_argument("--budget-ms", type=float, help="Exit with 1 when importing the app takes longer")
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    args = parser.parse_args()
+
+    raise SystemExit(main(args))